@@ -1,4 +1,4 @@
-from flask import Flask, request, jsonify, abort, make_response, send_file
+from flask import Flask, Response, request, jsonify, abort, make_response, send_file, stream_with_context
 from werkzeug.exceptions import HTTPException
 import os
 import sys
@@ -6,6 +6,7 @@ import time
 import rq
 import json
 import io
+import math
 from functools import wraps
 import base64
 import traceback
@@ -18,6 +19,9 @@ from datetime import datetime
 from contextlib import contextmanager
 
 from . import form_management
+from . import metrics
+from . import scheduler
+from . import estimates
 
 DOTENVFILE = os.path.join(os.path.dirname(os.path.dirname(__file__)), ".env")
 dotenv.load_dotenv(dotenv_path=DOTENVFILE)
@@ -25,6 +29,16 @@ dotenv.load_dotenv(dotenv_path=DOTENVFILE)
 ERROR_LOG = os.environ.get("ERROR_LOG")
 ACCESS_LOG = os.environ.get("ACCESS_LOG")
 SETTINGS_JOB_TIMEOUT = os.environ.get("SETTINGS_JOB_TIMEOUT", 1200)
+AUTH_CACHE_TTL = int(os.environ.get("AUTH_CACHE_TTL", 60))
+RATE_LIMIT = float(os.environ.get("RATE_LIMIT", 20))
+RATE_LIMIT_BURST = float(os.environ.get("RATE_LIMIT_BURST", RATE_LIMIT))
+PREDICTED_TIMEOUT_FACTOR = float(os.environ.get("PREDICTED_TIMEOUT_FACTOR", 3))
+RESULTS_BATCH_SIZE = 500
+SETTINGS_KEY = "autotest:settings:{}"
+SETTINGS_SPEC_KEY = "autotest:settings_spec:{}:{}"
+SETTINGS_SPEC_TTL = 3600
+LEGACY_SETTINGS_KEY = "autotest:settings"
+FINAL_JOB_STATUSES = {"finished", "failed", "stopped", "canceled"}
 REDIS_URL = os.environ["REDIS_URL"]
 
 REDIS_CONNECTION = redis.Redis.from_url(
@@ -36,6 +50,80 @@ REDIS_CONNECTION = redis.Redis.from_url(
 
 app = Flask(__name__)
 
+# Token bucket rate limiter. Each API key has a bucket holding up to <burst> tokens that is refilled at
+# <limit> tokens per minute; every request takes one token and is rejected if the bucket is empty.
+#
+# KEYS: bucket hash, per-key limit (tokens per minute), per-key burst
+# ARGV: default limit, default burst
+# Returns: {1 if the request is allowed else 0, seconds until the next token is available}
+RATE_LIMIT_SCRIPT = REDIS_CONNECTION.register_script("""
+local limit = tonumber(redis.call('GET', KEYS[2]) or ARGV[1])
+local burst = tonumber(redis.call('GET', KEYS[3]) or ARGV[2])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+if limit <= 0 or burst < 1 then
+    return {0, '60'}
+end
+local refill = limit / 60
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'timestamp')
+local tokens = tonumber(bucket[1]) or burst
+local timestamp = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - timestamp) * refill)
+local allowed = 0
+local retry_after = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+else
+    retry_after = (1 - tokens) / refill
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'timestamp', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / refill) + 1)
+return {allowed, tostring(retry_after)}
+""")
+
+
+class _TTLCache:
+    """
+    A small in-process cache whose entries expire ttl seconds after they are set.
+
+    Once the cache holds maxsize entries, expired entries are removed and, if it is still full,
+    the cache is cleared before a new entry is added.
+    """
+
+    def __init__(self, ttl, maxsize=10000):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data = {}
+
+    def get(self, key):
+        value, expiry = self._data.get(key, (None, 0))
+        if expiry < time.monotonic():
+            self._data.pop(key, None)
+            return None
+        return value
+
+    def set(self, key, value):
+        if self.ttl <= 0:
+            return
+        if len(self._data) >= self.maxsize:
+            now = time.monotonic()
+            self._data = {k: v for k, v in self._data.items() if v[1] >= now}
+            if len(self._data) >= self.maxsize:
+                self._data.clear()
+        self._data[key] = (value, time.monotonic() + self.ttl)
+
+    def pop(self, key):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+
+# api keys that have been verified to exist and the owner of each settings id
+_API_KEY_CACHE = _TTLCache(AUTH_CACHE_TTL)
+_SETTINGS_OWNER_CACHE = _TTLCache(AUTH_CACHE_TTL)
+
 
 @contextmanager
 def _open_log(log, mode="a", fallback=sys.stdout):
@@ -65,32 +153,37 @@ def _handle_error(e):
 
 
 def _check_rate_limit(api_key):
-    key = f"autotest:ratelimit:{api_key}:{datetime.now().minute}"
-    n_requests = REDIS_CONNECTION.get(key) or 0
-    user_limit = REDIS_CONNECTION.get(f"autotest:ratelimit:{api_key}:limit") or 20  # TODO: make default configurable
-    if int(n_requests) > int(user_limit):
-        abort(make_response(jsonify(message="Too many requests"), 429))
-    else:
-        with REDIS_CONNECTION.pipeline() as pipe:
-            pipe.incr(key)
-            pipe.expire(key, 59)
-            pipe.execute()
+    keys = [f"autotest:ratelimit:{api_key}:{k}" for k in ("bucket", "limit", "burst")]
+    allowed, retry_after = RATE_LIMIT_SCRIPT(keys=keys, args=[RATE_LIMIT, RATE_LIMIT_BURST], client=REDIS_CONNECTION)
+    if not allowed:
+        REDIS_CONNECTION.hincrby(metrics.RATE_LIMIT_REJECTIONS_KEY, metrics.api_key_label(api_key), 1)
+        response = make_response(jsonify(message="Too many requests"), 429)
+        response.headers["Retry-After"] = str(max(1, math.ceil(float(retry_after))))
+        abort(response)
 
 
 def _authorize_user():
     api_key = request.headers.get("Api-Key")
-    if api_key is None or (REDIS_CONNECTION.hgetall("autotest:user_credentials") or {}).get(api_key.encode()) is None:
+    if api_key is None:
         abort(make_response(jsonify(message="Unauthorized"), 401))
+    if _API_KEY_CACHE.get(api_key) is None:
+        if not REDIS_CONNECTION.hexists("autotest:user_credentials", api_key):
+            abort(make_response(jsonify(message="Unauthorized"), 401))
+        _API_KEY_CACHE.set(api_key, True)
     _check_rate_limit(api_key)
     return api_key
 
 
 def _authorize_settings(user, settings_id=None, **_kw):
     if settings_id:
-        settings_ = REDIS_CONNECTION.hget("autotest:settings", settings_id)
-        if settings_ is None:
-            abort(make_response(jsonify(message="Settings not found"), 404))
-        if json.loads(settings_).get("_user") != user:
+        owner = _SETTINGS_OWNER_CACHE.get(str(settings_id))
+        if owner is None:
+            owner = REDIS_CONNECTION.hget(SETTINGS_KEY.format(settings_id), "_user")
+            owner = owner.decode() if owner is not None else _get_legacy_settings(settings_id).get("_user")
+            if owner is None:
+                abort(make_response(jsonify(message="Settings not found"), 404))
+            _SETTINGS_OWNER_CACHE.set(str(settings_id), owner)
+        if owner != user:
             abort(make_response(jsonify(message="Unauthorized"), 401))
 
 
@@ -103,6 +196,43 @@ def _authorize_tests(tests_id=None, settings_id=None, **_kw):
             abort(make_response(jsonify(message="Unauthorized"), 401))
 
 
+def _get_legacy_settings(settings_id):
+    """
+    Return the test settings for settings_id stored as a single json string in the LEGACY_SETTINGS_KEY hash by
+    previous versions of the autotester (the workers convert them to the current format when they first load them).
+    Return an empty dict if there are no such settings.
+    """
+    legacy = REDIS_CONNECTION.hget(LEGACY_SETTINGS_KEY, str(settings_id))
+    return {} if legacy is None else json.loads(legacy)
+
+
+def _get_settings(settings_id):
+    """
+    Return the test settings for settings_id: the settings spec for the current version of the
+    settings combined with the fields in the settings hash (_user, _last_access, _env_status, _error
+    and _version). Return an empty dict if the settings do not exist.
+    """
+    fields = {k.decode(): v.decode() for k, v in REDIS_CONNECTION.hgetall(SETTINGS_KEY.format(settings_id)).items()}
+    if not fields:
+        return _get_legacy_settings(settings_id)
+    spec = REDIS_CONNECTION.get(SETTINGS_SPEC_KEY.format(settings_id, fields.get("_version", 0)))
+    return {**json.loads(spec or "{}"), **fields}
+
+
+def _parse_deadline(deadline):
+    """
+    Return deadline (a unix timestamp or an ISO 8601 date string) as a unix timestamp, or None if deadline is None.
+    """
+    if deadline is None:
+        return None
+    try:
+        if isinstance(deadline, str):
+            return datetime.fromisoformat(deadline).timestamp()
+        return float(deadline)
+    except (TypeError, ValueError):
+        abort(make_response(jsonify(message=f"Invalid deadline: {deadline}"), 422))
+
+
 def _update_settings(settings_id, user):
     test_settings = request.json.get("settings") or {}
     file_url = request.json.get("file_url")
@@ -117,13 +247,34 @@ def _update_settings(settings_id, user):
     if error:
         abort(make_response(jsonify(message=error), 422))
 
-    test_settings["_user"] = user
-    test_settings["_last_access"] = int(time.time())
-    test_settings["_env_status"] = "setup"
-    REDIS_CONNECTION.hset("autotest:settings", key=settings_id, value=json.dumps(test_settings))
-
+    # each update creates a new version of the settings spec, the previous version is kept for a
+    # while for jobs that have already loaded it. The new version number, its spec and its status are written
+    # in a single transaction so that workers never see the new version without its spec.
+    key = SETTINGS_KEY.format(settings_id)
+    fields = {"_user": user, "_last_access": int(time.time()), "_env_status": "setup"}
+
+    def _new_version(pipe):
+        version = int(pipe.hget(key, "_version") or 0) + 1
+        pipe.multi()
+        pipe.set(SETTINGS_SPEC_KEY.format(settings_id, version), json.dumps(test_settings))
+        pipe.expire(SETTINGS_SPEC_KEY.format(settings_id, version - 1), SETTINGS_SPEC_TTL)
+        pipe.hset(key, mapping={**fields, "_version": version})
+        pipe.hdel(key, "_error")
+        pipe.hdel(LEGACY_SETTINGS_KEY, str(settings_id))
+        return version
+
+    version = REDIS_CONNECTION.transaction(_new_version, key, value_from_callable=True)
+    _SETTINGS_OWNER_CACHE.pop(str(settings_id))
+
+    test_settings.update(fields)
     queue = rq.Queue("settings", connection=REDIS_CONNECTION)
-    data = {"user": user, "settings_id": settings_id, "test_settings": test_settings, "file_url": file_url}
+    data = {
+        "user": user,
+        "settings_id": settings_id,
+        "test_settings": test_settings,
+        "file_url": file_url,
+        "version": version,
+    }
     queue.enqueue_call(
         "autotest_server.update_test_settings",
         kwargs=data,
@@ -144,6 +295,53 @@ def _get_jobs(test_ids, settings_id):
                 yield None
 
 
+def _format_result(job, test_result):
+    job_status = job.get_status(refresh=False)
+    result = {"status": job_status}
+    if job_status == "finished":
+        try:
+            result.update(json.loads(test_result))
+        except (TypeError, json.JSONDecodeError):
+            result.update({"error": f"invalid json: {test_result}"})
+    elif job_status == "failed":
+        result.update({"error": str(job.exc_info)})
+    return result
+
+
+def _get_results(test_ids, settings_id):
+    """
+    Yield a (test_id, result) tuple for each test id in test_ids. The result is None if the test does
+    not exist or does not belong to settings_id.
+
+    Jobs and results are read with a single pipeline (and removed with another) for each batch
+    of RESULTS_BATCH_SIZE test ids. Jobs that have not completed yet are not removed.
+    """
+    for start in range(0, len(test_ids), RESULTS_BATCH_SIZE):
+        stop = start + RESULTS_BATCH_SIZE
+        batch_ids = test_ids[start:stop]
+        batch = [str(id_) for id_ in batch_ids]
+        with REDIS_CONNECTION.pipeline(transaction=False) as pipe:
+            pipe.hmget("autotest:tests", batch)
+            for id_ in batch:
+                pipe.hgetall(rq.job.Job.key_for(id_))
+                pipe.get(f"autotest:test_result:{id_}")
+            test_settings, *data = pipe.execute()
+        results = []
+        with REDIS_CONNECTION.pipeline(transaction=False) as pipe:
+            for id_, test_setting, job_data, test_result in zip(batch, test_settings, data[::2], data[1::2]):
+                if test_setting is None or int(test_setting) != int(settings_id) or not job_data:
+                    results.append(None)
+                    continue
+                job = rq.job.Job(id_, connection=REDIS_CONNECTION)
+                job.restore(job_data)
+                results.append(_format_result(job, test_result))
+                if results[-1]["status"] in FINAL_JOB_STATUSES:
+                    job.delete(pipeline=pipe)
+                    pipe.delete(f"autotest:test_result:{id_}")
+            pipe.execute()
+        yield from zip(batch_ids, results)
+
+
 def authorize(func):
     # non-secure authorization
     @wraps(func)
@@ -190,6 +388,7 @@ def reset_credentials(user):
     credentials = request.json.get("credentials")
     data = {"auth_type": auth_type, "credentials": credentials}
     REDIS_CONNECTION.hset("autotest:user_credentials", key=user, value=json.dumps(data))
+    _API_KEY_CACHE.pop(user)
     return jsonify(success=True)
 
 
@@ -202,7 +401,7 @@ def schema(**_kwargs):
 @app.route("/settings/<settings_id>", methods=["GET"])
 @authorize
 def settings(settings_id, **_kw):
-    settings_ = json.loads(REDIS_CONNECTION.hget("autotest:settings", key=settings_id) or "{}")
+    settings_ = _get_settings(settings_id)
     if settings_.get("_error"):
         raise Exception(f"Settings Error: {settings_['_error']}")
     return {k: v for k, v in settings_.items() if not k.startswith("_")}
@@ -212,9 +411,7 @@ def settings(settings_id, **_kw):
 @authorize
 def create_settings(user):
     settings_id = REDIS_CONNECTION.incr("autotest:settings_id")
-    REDIS_CONNECTION.hset(
-        "autotest:settings", key=settings_id, value=json.dumps({"_user": user, "_env_status": "setup"})
-    )
+    REDIS_CONNECTION.hset(SETTINGS_KEY.format(settings_id), mapping={"_user": user, "_env_status": "setup"})
     _update_settings(settings_id, user)
     return {"settings_id": settings_id}
 
@@ -229,7 +426,7 @@ def update_settings(settings_id, user):
 @app.route("/settings/<settings_id>/test", methods=["PUT"])
 @authorize
 def run_tests(settings_id, user):
-    test_settings = json.loads(REDIS_CONNECTION.hget("autotest:settings", key=settings_id))
+    test_settings = _get_settings(settings_id)
     env_status = test_settings.get("_env_status")
     if env_status == "setup":
         abort(make_response(jsonify(message="Setting up test environment. Please try again later."), 503))
@@ -243,22 +440,23 @@ def run_tests(settings_id, user):
     test_data = request.json["test_data"]
     categories = request.json["categories"]
     high_priority = request.json.get("request_high_priority")
+    deadline = _parse_deadline(request.json.get("deadline"))
     queue_name = "batch" if len(test_data) > 1 else ("high" if high_priority else "low")
     queue = rq.Queue(queue_name, connection=REDIS_CONNECTION)
+    timeout = estimates.predict_timeout(
+        REDIS_CONNECTION, settings_id, test_settings, categories, PREDICTED_TIMEOUT_FACTOR
+    )
 
-    timeout = 0
-
-    for settings_ in test_settings["testers"]:
-        for data in settings_["test_data"]:
-            timeout += data["timeout"]
+    if not test_data:
+        return {"test_ids": []}
 
-    ids = []
-    for data in test_data:
+    # allocate ids for all tests at once and then create and enqueue all jobs in a single pipeline
+    last_id = REDIS_CONNECTION.incrby("autotest:tests_id", len(test_data))
+    ids = list(range(last_id - len(test_data) + 1, last_id + 1))
+    jobs = []
+    for id_, data in zip(ids, test_data):
         url = data["file_url"]
         test_env_vars = data.get("env_vars", {})
-        id_ = REDIS_CONNECTION.incr("autotest:tests_id")
-        REDIS_CONNECTION.hset("autotest:tests", key=id_, value=settings_id)
-        ids.append(id_)
         data = {
             "settings_id": settings_id,
             "test_id": id_,
@@ -267,14 +465,26 @@ def run_tests(settings_id, user):
             "user": user,
             "test_env_vars": test_env_vars,
         }
-        queue.enqueue_call(
-            "autotest_server.run_test",
-            kwargs=data,
-            job_id=str(id_),
-            timeout=int(timeout * 1.5),
-            failure_ttl=3600,
-            result_ttl=3600,
-        )  # TODO: make this configurable
+        jobs.append(
+            rq.Queue.prepare_data(
+                "autotest_server.run_test",
+                kwargs=data,
+                job_id=str(id_),
+                timeout=timeout,
+                failure_ttl=3600,
+                result_ttl=3600,
+            )  # TODO: make this configurable
+        )
+    # batch jobs are added to the scheduler queue for these settings instead of the rq queue (see scheduler.py)
+    with REDIS_CONNECTION.pipeline() as pipe:
+        pipe.hset("autotest:tests", mapping={id_: settings_id for id_ in ids})
+        if queue_name == "batch":
+            scheduler.schedule(queue, jobs, settings_id, deadline, pipe)
+        else:
+            queue.enqueue_many(jobs, pipeline=pipe)
+        pipe.execute()
+    if queue_name == "batch":
+        scheduler.dispatch(REDIS_CONNECTION)
 
     return {"test_ids": ids}
 
@@ -282,22 +492,29 @@ def run_tests(settings_id, user):
 @app.route("/settings/<settings_id>/test/<tests_id>", methods=["GET"])
 @authorize
 def get_result(settings_id, tests_id, **_kw):
+    start = time.monotonic()
     job = rq.job.Job.fetch(tests_id, connection=REDIS_CONNECTION)
-    job_status = job.get_status()
-    result = {"status": job_status}
-    if job_status == "finished":
-        test_result = REDIS_CONNECTION.get(f"autotest:test_result:{tests_id}")
-        try:
-            result.update(json.loads(test_result))
-        except json.JSONDecodeError:
-            result.update({"error": f"invalid json: {test_result}"})
-    elif job_status == "failed":
-        result.update({"error": str(job.exc_info)})
+    result = _format_result(job, REDIS_CONNECTION.get(f"autotest:test_result:{tests_id}"))
     job.delete()
     REDIS_CONNECTION.delete(f"autotest:test_result:{tests_id}")
+    metrics.observe(REDIS_CONNECTION, metrics.RESULT_FETCH_KEY, "result", time.monotonic() - start)
     return result
 
 
+@app.route("/settings/<settings_id>/tests/results", methods=["POST"])
+@authorize
+def get_results(settings_id, **_kw):
+    test_ids = request.json["test_ids"]
+    if request.json.get("stream"):
+
+        def _stream():
+            for id_, result in _get_results(test_ids, settings_id):
+                yield json.dumps({"test_id": id_, "result": result}) + "\n"
+
+        return Response(stream_with_context(_stream()), mimetype="application/x-ndjson")
+    return {id_: result for id_, result in _get_results(test_ids, settings_id)}
+
+
 @app.route("/settings/<settings_id>/test/<tests_id>/feedback/<feedback_id>", methods=["GET"])
 @authorize
 def get_feedback_file(settings_id, tests_id, feedback_id, **_kw):
@@ -313,9 +530,16 @@ def get_feedback_file(settings_id, tests_id, feedback_id, **_kw):
 @authorize
 def get_statuses(settings_id, **_kw):
     test_ids = request.json["test_ids"]
+    estimator = None
+    if request.json.get("include_eta"):
+        version = REDIS_CONNECTION.hget(SETTINGS_KEY.format(settings_id), "_version") or b"0"
+        estimator = estimates.CompletionEstimator(REDIS_CONNECTION, settings_id, version.decode())
     result = {}
     for id_, job in zip(test_ids, _get_jobs(test_ids, settings_id)):
-        result[id_] = job if job is None else job.get_status()
+        if job is None or estimator is None:
+            result[id_] = job if job is None else job.get_status()
+        else:
+            result[id_] = {"status": job.get_status(), "eta": estimator.estimate(job)}
     return result
 
 
@@ -332,3 +556,10 @@ def cancel_tests(settings_id, **_kw):
 @app.route("/status", methods=["GET"])
 def status():
     return jsonify(success=True)
+
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    response = make_response(metrics.render_metrics(REDIS_CONNECTION))
+    response.mimetype = "text/plain; version=0.0.4"
+    return response
@@ -0,0 +1,157 @@
+"""
+Estimates of how long test runs will take, based on the durations recorded by the workers.
+
+For each version of the test settings, the workers keep the most recent durations of each test group, of the time
+spent outside of test groups ("overhead") and of the whole test run ("total") (see _record_durations in
+autotest_server). These are used to predict a timeout for each test run that is much closer to how long the tests
+actually take than the sum of the test group timeouts, and to estimate when a test run will be completed.
+"""
+
+import math
+import time
+import redis
+import rq
+from typing import Dict, List, Optional, Union
+
+from . import metrics
+from . import scheduler
+
+DURATIONS_KEY = "autotest:durations:{}:{}:{}"
+MIN_SAMPLES = 20
+MIN_PREDICTED_TIMEOUT = 60
+QUEUE_ORDER = ("high", "low", "batch")
+FINAL_JOB_STATUSES = {"finished", "failed", "stopped", "canceled"}
+
+# set to False once the redis server has rejected LPOS, which requires Redis 6.0.6 or later
+_lpos_supported = True
+
+
+def percentile(samples: List[float], q: float) -> Optional[float]:
+    """
+    Return the q-percentile (0 <= q <= 1) of samples using the nearest rank method, or None if samples is empty.
+    """
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[max(math.ceil(q * len(ordered)) - 1, 0)]
+
+
+def _samples(
+    connection: redis.Redis, settings_id: Union[int, str], version: Union[int, str], names: List[str]
+) -> Dict[str, List[float]]:
+    with connection.pipeline(transaction=False) as pipe:
+        for name in names:
+            pipe.lrange(DURATIONS_KEY.format(settings_id, version, name), 0, -1)
+        return {name: [float(s) for s in samples] for name, samples in zip(names, pipe.execute())}
+
+
+def predict_timeout(
+    connection: redis.Redis, settings_id: Union[int, str], test_settings: Dict, categories: List[str], factor: float
+) -> int:
+    """
+    Return the timeout in seconds for a test run of test_settings (for settings_id) for categories.
+
+    By default, the timeout is 1.5 times the sum of the timeouts of all test groups. If factor is positive and
+    at least MIN_SAMPLES durations have been recorded for each test group that will be run (and for the time spent
+    outside of test groups), the timeout is lowered to factor times the 99th percentile of these durations (where the
+    timeout for each test group is no more than its own timeout). Predicted timeouts are never lower than
+    MIN_PREDICTED_TIMEOUT.
+    """
+    testers = test_settings["testers"]
+    timeout = int(sum(data["timeout"] for settings in testers for data in settings["test_data"]) * 1.5)
+    if factor <= 0:
+        return timeout
+    groups = {
+        f"{i}:{j}": data["timeout"]
+        for i, settings in enumerate(testers)
+        for j, data in enumerate(settings["test_data"])
+        if set(data.get("category", [])) & set(categories)
+    }
+    samples = _samples(connection, settings_id, test_settings.get("_version", 0), [*groups, "overhead"])
+    if any(len(group_samples) < MIN_SAMPLES for group_samples in samples.values()):
+        return timeout
+    predicted = factor * percentile(samples["overhead"], 0.99)
+    predicted += sum(min(group_timeout, factor * percentile(samples[g], 0.99)) for g, group_timeout in groups.items())
+    return min(timeout, max(math.ceil(predicted), MIN_PREDICTED_TIMEOUT))
+
+
+class CompletionEstimator:
+    """
+    Estimates the time (as a unix timestamp) that test runs for a version of the test settings will be completed.
+
+    The duration of a test run is estimated as the median duration of recent test runs for the same settings (or the
+    mean duration of all test runs if none have been recorded for these settings yet). A test run that is waiting to
+    be run will be started once all jobs ahead of it have been run by the workers, where jobs in higher priority queues
+    are always ahead and jobs waiting in the scheduler queue (see scheduler.py) share the workers with the scheduler
+    queues for other settings.
+    """
+
+    def __init__(
+        self,
+        connection: redis.Redis,
+        settings_id: Union[int, str],
+        version: Union[int, str],
+        now: Optional[float] = None,
+    ) -> None:
+        self._connection = connection
+        self._settings_id = settings_id
+        self._now = time.time() if now is None else now
+        self._duration = percentile(_samples(connection, settings_id, version, ["total"])["total"], 0.5)
+        with connection.pipeline(transaction=False) as pipe:
+            pipe.hmget(metrics.ALL_TIMINGS_KEY, "total:sum", "total:count")
+            for name in QUEUE_ORDER:
+                pipe.llen(rq.Queue(name, connection=connection).key)
+            pipe.zcard(scheduler.TENANTS_KEY)
+            (total, count), *lengths, tenants = pipe.execute()
+        if self._duration is None and count and int(count):
+            self._duration = float(total) / int(count)
+        self._lengths = dict(zip(QUEUE_ORDER, lengths))
+        self._tenants = max(tenants, 1)
+        self._workers = max(rq.Worker.count(connection=connection), 1)
+
+    def _position(self, key: str, job_id: str) -> Optional[int]:
+        """
+        Return the index of job_id in the list at key, or None if it is not in the list.
+
+        The whole list is read if the redis server does not support LPOS.
+        """
+        global _lpos_supported
+        if _lpos_supported:
+            try:
+                return self._connection.lpos(key, job_id)
+            except redis.ResponseError:
+                _lpos_supported = False
+        job_ids = [i.decode() if isinstance(i, bytes) else i for i in self._connection.lrange(key, 0, -1)]
+        return job_ids.index(job_id) if job_id in job_ids else None
+
+    def _jobs_ahead(self, job: rq.job.Job) -> Optional[int]:
+        if job.origin not in QUEUE_ORDER:
+            return None
+        stop = QUEUE_ORDER.index(job.origin)
+        higher = sum(self._lengths[name] for name in QUEUE_ORDER[:stop])
+        position = self._position(rq.Queue(job.origin, connection=self._connection).key, job.id)
+        if position is not None:
+            return higher + position
+        if job.origin == "batch":
+            position = self._position(scheduler.JOBS_KEY.format(self._settings_id), job.id)
+            if position is not None:
+                return higher + self._lengths["batch"] + position * self._tenants
+        return None
+
+    def estimate(self, job: rq.job.Job) -> Optional[float]:
+        """
+        Return the estimated time that job will be completed (or the time it was completed), or None if there
+        is not enough information to estimate it.
+        """
+        status = job.get_status()
+        if status in FINAL_JOB_STATUSES:
+            return None if job.ended_at is None else job.ended_at.timestamp()
+        if self._duration is None:
+            return None
+        if status == "started" and job.started_at is not None:
+            return round(max(job.started_at.timestamp() + self._duration, self._now), 3)
+        if status == "queued":
+            ahead = self._jobs_ahead(job)
+            if ahead is not None:
+                return round(self._now + (ahead / self._workers + 1) * self._duration, 3)
+        return None
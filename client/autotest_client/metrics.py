@@ -0,0 +1,191 @@
+import time
+import hashlib
+import math
+import rq
+import redis
+from typing import Dict, List, Tuple, Optional, Iterable
+
+QUEUE_NAMES = ("high", "low", "batch", "settings")
+QUANTILES = (0.5, 0.95, 0.99)
+BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1200, 3600)
+
+JOB_COUNTS_KEY = "autotest:metrics:jobs"
+JOB_COUNTS_PER_MINUTE_KEY = "autotest:metrics:jobs:{}:{}"
+KILLED_GROUPS_KEY = "autotest:metrics:killed_groups"
+ALL_TIMINGS_KEY = "autotest:timings"
+RESULT_FETCH_KEY = "autotest:metrics:result_fetch"
+RATE_LIMIT_REJECTIONS_KEY = "autotest:metrics:rate_limit_rejections"
+
+
+def api_key_label(api_key: str) -> str:
+    """
+    Return a label that identifies api_key in the metrics without revealing it.
+    """
+    return hashlib.sha256(api_key.encode()).hexdigest()[:12]
+
+
+def observe(connection: redis.Redis, key: str, name: str, seconds: float) -> None:
+    """
+    Add seconds to the histogram called name stored in the hash at key.
+
+    Histograms are stored in the same format as the test run timings written by the server:
+        - <name>:<bound>  the number of observations of at most <bound> seconds (and more than the previous bound)
+        - <name>:+Inf     the number of observations of more than the largest bound
+        - <name>:sum      the total of all observations
+        - <name>:count    the number of observations
+    """
+    bucket = next((str(bound) for bound in BUCKETS if seconds <= bound), "+Inf")
+    with connection.pipeline(transaction=False) as pipe:
+        pipe.hincrby(key, f"{name}:{bucket}", 1)
+        pipe.hincrbyfloat(key, f"{name}:sum", seconds)
+        pipe.hincrby(key, f"{name}:count", 1)
+        pipe.execute()
+
+
+def _load_histogram(connection: redis.Redis, key: str, name: str) -> Tuple[List[Tuple[float, int]], float, int]:
+    """
+    Return the cumulative buckets (sorted by upper bound), sum and count of the histogram called name stored at key.
+    """
+    buckets = {}
+    total, count = 0.0, 0
+    for field, value in (connection.hgetall(key) or {}).items():
+        field = field.decode() if isinstance(field, bytes) else field
+        hist_name, _, bound = field.rpartition(":")
+        if hist_name != name:
+            continue
+        if bound == "sum":
+            total = float(value)
+        elif bound == "count":
+            count = int(value)
+        else:
+            buckets[float(bound)] = int(value)
+    cumulative = []
+    running = 0
+    for bound in sorted(buckets):
+        running += buckets[bound]
+        cumulative.append((bound, running))
+    return cumulative, total, count
+
+
+def quantile(q: float, buckets: List[Tuple[float, int]]) -> Optional[float]:
+    """
+    Estimate the q-quantile of a histogram from its cumulative buckets by linear interpolation within the
+    bucket that contains it (as Prometheus' histogram_quantile does). Return None if the histogram is empty.
+    """
+    if not buckets or buckets[-1][1] == 0:
+        return None
+    rank = q * buckets[-1][1]
+    lower_bound, lower_count = 0.0, 0
+    for bound, count in buckets:
+        if count >= rank:
+            if math.isinf(bound):
+                return lower_bound
+            if count == lower_count:
+                return bound
+            return lower_bound + (bound - lower_bound) * (rank - lower_count) / (count - lower_count)
+        lower_bound, lower_count = bound, count
+    return lower_bound
+
+
+def _format_value(value: float) -> str:
+    value = float(value)
+    if math.isnan(value):
+        return "NaN"
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels.items()) + "}"
+
+
+class _Metrics:
+    def __init__(self) -> None:
+        self._lines = []
+
+    def add(self, name: str, metric_type: str, help_: str, samples: Iterable[Tuple[Dict[str, str], float]]) -> None:
+        self._lines.append(f"# HELP {name} {help_}")
+        self._lines.append(f"# TYPE {name} {metric_type}")
+        for labels, value in samples:
+            self._lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+
+    def add_summary(self, name: str, help_: str, connection: redis.Redis, key: str, hist_name: str) -> None:
+        buckets, total, count = _load_histogram(connection, key, hist_name)
+        samples = []
+        for q in QUANTILES:
+            value = quantile(q, buckets)
+            samples.append(({"quantile": str(q)}, float("nan") if value is None else value))
+        self.add(name, "summary", help_, samples)
+        self._lines.append(f"{name}_sum {_format_value(total)}")
+        self._lines.append(f"{name}_count {count}")
+
+    def render(self) -> str:
+        return "\n".join(self._lines) + "\n"
+
+
+def render_metrics(connection: redis.Redis) -> str:
+    """
+    Return the current metrics in the Prometheus text exposition format.
+    """
+    metrics = _Metrics()
+    now = time.time()
+
+    depths, ages, failed = [], [], []
+    for name in QUEUE_NAMES:
+        queue = rq.Queue(name, connection=connection)
+        labels = {"queue": name}
+        depths.append((labels, queue.count))
+        failed.append((labels, queue.failed_job_registry.count))
+        age = 0.0
+        oldest = queue.get_job_ids(0, 1)
+        job = queue.fetch_job(oldest[0]) if oldest else None
+        if job is not None and job.enqueued_at is not None:
+            age = max(now - job.enqueued_at.timestamp(), 0.0)
+        ages.append((labels, age))
+    metrics.add("autotest_queue_depth", "gauge", "Number of jobs waiting in the queue.", depths)
+    metrics.add("autotest_queue_oldest_job_age_seconds", "gauge", "Age of the oldest job waiting in the queue.", ages)
+    metrics.add("autotest_queue_failed_jobs", "gauge", "Number of jobs in the failed job registry.", failed)
+
+    counts = {k.decode(): int(v) for k, v in (connection.hgetall(JOB_COUNTS_KEY) or {}).items()}
+    last_minute = int(now // 60) - 1
+    statuses = ("finished", "failed")
+    per_minute = connection.mget([JOB_COUNTS_PER_MINUTE_KEY.format(status, last_minute) for status in statuses])
+    metrics.add(
+        "autotest_jobs_total",
+        "counter",
+        "Number of test runs completed by the workers.",
+        [({"status": status}, counts.get(status, 0)) for status in statuses],
+    )
+    metrics.add(
+        "autotest_jobs_per_minute",
+        "gauge",
+        "Number of test runs completed by the workers during the last full minute.",
+        [({"status": status}, int(value or 0)) for status, value in zip(statuses, per_minute)],
+    )
+
+    killed = connection.hgetall(KILLED_GROUPS_KEY) or {}
+    metrics.add(
+        "autotest_test_groups_killed_total",
+        "counter",
+        "Number of test groups killed because they timed out or ran out of memory.",
+        [({"reason": reason}, int(killed.get(reason.encode(), 0))) for reason in ("timeout", "oom")],
+    )
+
+    metrics.add_summary("autotest_job_duration_seconds", "Duration of test runs.", connection, ALL_TIMINGS_KEY, "total")
+    metrics.add_summary(
+        "autotest_result_fetch_duration_seconds",
+        "Time taken to fetch a test result.",
+        connection,
+        RESULT_FETCH_KEY,
+        "result",
+    )
+
+    rejections = connection.hgetall(RATE_LIMIT_REJECTIONS_KEY) or {}
+    metrics.add(
+        "autotest_rate_limit_rejections_total",
+        "counter",
+        "Number of requests rejected by the rate limit for each API key.",
+        [({"api_key": k.decode()}, int(v)) for k, v in sorted(rejections.items())],
+    )
+    return metrics.render()
@@ -0,0 +1,89 @@
+"""
+Fair share scheduling of batch test runs (see autotest_server/scheduler.py for details).
+
+The jobs for a batch test run are saved but are not pushed to the rq batch queue. Instead their ids are added to the
+scheduler queue for their test settings id and the dispatch script moves them to the rq batch queue when there are
+workers available to run them. The dispatch script is stored in redis when the workers are started.
+"""
+
+from datetime import datetime, timezone
+from typing import List, Optional, Union
+
+import redis
+import rq
+
+TENANTS_KEY = "autotest:scheduler:tenants"
+DEADLINES_KEY = "autotest:scheduler:deadlines"
+VIRTUAL_TIME_KEY = "autotest:scheduler:vtime"
+WEIGHTS_KEY = "autotest:scheduler:weights"
+CONFIG_KEY = "autotest:scheduler:config"
+SCRIPT_KEY = "autotest:scheduler:script"
+JOBS_KEY = "autotest:scheduler:jobs:{}"
+RQ_QUEUES_KEY = "rq:queues"
+
+
+def schedule(
+    queue: rq.Queue,
+    job_datas: List,
+    settings_id: Union[int, str],
+    deadline: Optional[float],
+    pipeline: redis.client.Pipeline,
+) -> List[rq.job.Job]:
+    """
+    Save a job in queue for each of job_datas (created by rq.Queue.prepare_data) and add them to the scheduler queue
+    for settings_id using pipeline. If deadline is not None, the jobs for settings_id are dispatched in order of
+    deadline (earliest first) once the deadline is close.
+
+    Settings ids that did not have any jobs waiting start with the current virtual time so that they are not given
+    more than their share of the workers to make up for the time they had nothing to run.
+    """
+    vtime = float(queue.connection.get(VIRTUAL_TIME_KEY) or 0)
+    enqueued_at = datetime.now(timezone.utc)
+    jobs = []
+    for data in job_datas:
+        job = queue.create_job(
+            data.func,
+            args=data.args,
+            kwargs=data.kwargs,
+            timeout=data.timeout,
+            result_ttl=data.result_ttl,
+            ttl=data.ttl,
+            failure_ttl=data.failure_ttl,
+            description=data.description,
+            job_id=data.job_id,
+            meta=data.meta,
+        )
+        job.enqueued_at = enqueued_at
+        job.save(pipeline=pipeline)
+        jobs.append(job)
+    if jobs:
+        pipeline.rpush(JOBS_KEY.format(settings_id), *(job.id for job in jobs))
+        pipeline.zadd(TENANTS_KEY, {str(settings_id): vtime}, nx=True)
+        if deadline is not None:
+            pipeline.zadd(DEADLINES_KEY, {str(settings_id): deadline}, lt=True)
+    return jobs
+
+
+def dispatch(connection: redis.Redis) -> int:
+    """
+    Move jobs from the scheduler queues to the rq batch queue (using the depth last set by the workers) and
+    return the number of jobs moved.
+
+    Nothing is moved if the dispatch script has not been stored yet (the workers dispatch any waiting jobs
+    when they are started).
+    """
+    source = connection.get(SCRIPT_KEY)
+    if source is None:
+        return 0
+    queue = rq.Queue("batch", connection=connection)
+    keys = [TENANTS_KEY, DEADLINES_KEY, VIRTUAL_TIME_KEY, WEIGHTS_KEY, CONFIG_KEY, queue.key, RQ_QUEUES_KEY]
+    args = ["", "", JOBS_KEY.format(""), rq.job.Job.key_for("")]
+    script = connection.register_script(source)
+    # the script returns the keys it needs to move the next job, if any (see autotest_server/scheduler.py)
+    moved, needed = 0, []
+    while True:
+        result = script(keys=[*keys, *needed], args=args)
+        moved += int(result[0])
+        needed = [key.decode() if isinstance(key, bytes) else key for key in result[1:]]
+        if not needed:
+            return moved
@@ -1,7 +1,19 @@
+import ast
+import os
+
 import autotest_client
 import pytest
 import fakeredis
 import json
+import redis
+import rq
+import time
+from datetime import datetime, timezone
+
+
+def _set_settings(conn, settings_id, spec=None, **fields):
+    conn.hset(f"autotest:settings:{settings_id}", mapping={"_version": 1, **fields})
+    conn.set(f"autotest:settings_spec:{settings_id}:1", json.dumps(spec or {}))
 
 
 @pytest.fixture
@@ -16,9 +28,29 @@ def fake_redis_conn():
     yield fakeredis.FakeStrictRedis()
 
 
+@pytest.fixture
+def dispatch_script(fake_redis_conn):
+    """Store the dispatch script from the server's scheduler module as the workers would"""
+    server_scheduler = os.path.join(
+        os.path.dirname(__file__), "..", "..", "..", "server", "autotest_server", "scheduler.py"
+    )
+    if not os.path.isfile(server_scheduler):
+        pytest.skip("the server is not in this source tree")
+    with open(server_scheduler) as f:
+        module = ast.parse(f.read())
+    (script,) = [
+        node.value.value
+        for node in module.body
+        if isinstance(node, ast.Assign) and [t.id for t in node.targets] == ["DISPATCH_SCRIPT"]
+    ]
+    fake_redis_conn.set(autotest_client.scheduler.SCRIPT_KEY, script)
+
+
 @pytest.fixture(autouse=True)
 def fake_redis_db(monkeypatch, fake_redis_conn):
     monkeypatch.setattr(autotest_client, "REDIS_CONNECTION", fake_redis_conn)
+    autotest_client._API_KEY_CACHE.clear()
+    autotest_client._SETTINGS_OWNER_CACHE.clear()
 
 
 class TestRegister:
@@ -51,3 +83,422 @@ class TestStatus:
 
     def test_success(self, response):
         assert response.json["success"] is True
+
+
+class TestMetrics:
+    @pytest.fixture
+    def response(self, client):
+        return client.get("/metrics")
+
+    def _samples(self, response):
+        return dict(line.rsplit(" ", 1) for line in response.text.splitlines() if not line.startswith("#"))
+
+    def test_status_code(self, response):
+        assert response.status_code == 200
+
+    def test_content_type(self, response):
+        assert response.mimetype == "text/plain"
+
+    def test_queue_depth(self, client, fake_redis_conn):
+        rq.Queue("high", connection=fake_redis_conn).enqueue_call("autotest_server.run_test")
+        samples = self._samples(client.get("/metrics"))
+        assert samples['autotest_queue_depth{queue="high"}'] == "1"
+        assert samples['autotest_queue_depth{queue="low"}'] == "0"
+        assert float(samples['autotest_queue_oldest_job_age_seconds{queue="high"}']) >= 0
+
+    def test_oldest_job_age(self, client, fake_redis_conn):
+        queue = rq.Queue("high", connection=fake_redis_conn)
+        old_job = queue.enqueue_call("autotest_server.run_test")
+        old_job.enqueued_at = datetime.fromtimestamp(time.time() - 600, timezone.utc)
+        old_job.save()
+        queue.enqueue_call("autotest_server.run_test")
+        samples = self._samples(client.get("/metrics"))
+        assert 600 <= float(samples['autotest_queue_oldest_job_age_seconds{queue="high"}']) < 610
+
+    def test_job_counts(self, client, fake_redis_conn):
+        fake_redis_conn.hset("autotest:metrics:jobs", mapping={"finished": 5, "failed": 2})
+        samples = self._samples(client.get("/metrics"))
+        assert samples['autotest_jobs_total{status="finished"}'] == "5"
+        assert samples['autotest_jobs_total{status="failed"}'] == "2"
+
+    def test_killed_groups(self, client, fake_redis_conn):
+        fake_redis_conn.hset("autotest:metrics:killed_groups", mapping={"oom": 3})
+        samples = self._samples(client.get("/metrics"))
+        assert samples['autotest_test_groups_killed_total{reason="timeout"}'] == "0"
+        assert samples['autotest_test_groups_killed_total{reason="oom"}'] == "3"
+
+    def test_job_duration_quantiles(self, client, fake_redis_conn):
+        fake_redis_conn.hset("autotest:timings", mapping={"total:10": 50, "total:30": 50, "total:count": 100})
+        samples = self._samples(client.get("/metrics"))
+        assert float(samples['autotest_job_duration_seconds{quantile="0.5"}']) == 10
+        assert float(samples['autotest_job_duration_seconds{quantile="0.95"}']) == 28
+        assert samples["autotest_job_duration_seconds_count"] == "100"
+
+    def test_empty_histogram(self, response):
+        assert self._samples(response)['autotest_job_duration_seconds{quantile="0.5"}'] == "NaN"
+
+    def test_rate_limit_rejections(self, client, fake_redis_conn):
+        credentials = client.post("/register", json={"auth_type": "test", "credentials": "12345"}).json
+        headers = {"Api-Key": credentials["api_key"]}
+        for _ in range(21):
+            client.get("/schema", headers=headers)
+        label = autotest_client.metrics.api_key_label(credentials["api_key"])
+        samples = self._samples(client.get("/metrics"))
+        assert samples[f'autotest_rate_limit_rejections_total{{api_key="{label}"}}'] == "1"
+
+
+class TestGetResults:
+    @pytest.fixture
+    def headers(self, client, fake_redis_conn):
+        api_key = client.post("/register", json={"auth_type": "test", "credentials": "12345"}).json["api_key"]
+        _set_settings(fake_redis_conn, 1, _user=api_key)
+        _set_settings(fake_redis_conn, 2, _user=api_key)
+        return {"Api-Key": api_key}
+
+    @pytest.fixture
+    def jobs(self, fake_redis_conn):
+        queue = rq.Queue("high", connection=fake_redis_conn)
+        for id_, settings_id, status in ((1, 1, "finished"), (2, 1, "queued"), (3, 2, "finished")):
+            fake_redis_conn.hset("autotest:tests", key=id_, value=settings_id)
+            job = queue.enqueue_call("autotest_server.run_test", job_id=str(id_))
+            if status == "finished":
+                job.set_status(rq.job.JobStatus.FINISHED)
+                fake_redis_conn.set(f"autotest:test_result:{id_}", json.dumps({"test_groups": [id_], "error": None}))
+
+    def test_results(self, client, headers, jobs):
+        response = client.post("/settings/1/tests/results", json={"test_ids": [1, 2, 3, 4]}, headers=headers)
+        assert response.json == {
+            "1": {"status": "finished", "test_groups": [1], "error": None},
+            "2": {"status": "queued"},
+            "3": None,
+            "4": None,
+        }
+
+    def test_finished_jobs_removed(self, client, headers, jobs, fake_redis_conn):
+        client.post("/settings/1/tests/results", json={"test_ids": [1, 2]}, headers=headers)
+        assert not fake_redis_conn.exists("autotest:test_result:1")
+        assert not fake_redis_conn.exists(rq.job.Job.key_for("1"))
+        assert fake_redis_conn.exists(rq.job.Job.key_for("2"))
+
+    def test_stream(self, client, headers, jobs):
+        response = client.post("/settings/1/tests/results", json={"test_ids": [1, 2], "stream": True}, headers=headers)
+        assert response.mimetype == "application/x-ndjson"
+        lines = [json.loads(line) for line in response.text.splitlines()]
+        assert lines == [
+            {"test_id": 1, "result": {"status": "finished", "test_groups": [1], "error": None}},
+            {"test_id": 2, "result": {"status": "queued"}},
+        ]
+
+
+class TestRunTests:
+    @pytest.fixture
+    def headers(self, client, fake_redis_conn, dispatch_script):
+        api_key = client.post("/register", json={"auth_type": "test", "credentials": "12345"}).json["api_key"]
+        spec = {"testers": [{"test_data": [{"timeout": 10}]}]}
+        _set_settings(fake_redis_conn, 1, spec, _user=api_key, _env_status="ready")
+        fake_redis_conn.hset("autotest:scheduler:config", mapping={"depth": 10, "deadline_window": 3600})
+        return {"Api-Key": api_key}
+
+    @pytest.fixture
+    def response(self, client, headers):
+        test_data = [{"file_url": f"http://example.com/{i}"} for i in range(3)]
+        return client.put(
+            "/settings/1/test", json={"test_data": test_data, "categories": ["instructor"]}, headers=headers
+        )
+
+    def test_test_ids(self, response):
+        assert response.json["test_ids"] == [1, 2, 3]
+
+    def test_tests_belong_to_settings(self, response, fake_redis_conn):
+        assert fake_redis_conn.hgetall("autotest:tests") == {b"1": b"1", b"2": b"1", b"3": b"1"}
+
+    def test_jobs_enqueued(self, response, fake_redis_conn):
+        queue = rq.Queue("batch", connection=fake_redis_conn)
+        assert queue.job_ids == ["1", "2", "3"]
+        job = queue.fetch_job("2")
+        assert job.kwargs["files_url"] == "http://example.com/1"
+        assert job.timeout == 15
+
+    def test_ids_not_reused(self, client, headers, response):
+        test_data = [{"file_url": "http://example.com/a"}]
+        response = client.put("/settings/1/test", json={"test_data": test_data, "categories": []}, headers=headers)
+        assert response.json["test_ids"] == [4]
+
+
+class TestEstimates:
+    @pytest.fixture
+    def headers(self, client, fake_redis_conn, dispatch_script):
+        api_key = client.post("/register", json={"auth_type": "test", "credentials": "12345"}).json["api_key"]
+        spec = {"testers": [{"test_data": [{"timeout": 600, "category": ["student"]}, {"timeout": 600}]}]}
+        _set_settings(fake_redis_conn, 1, spec, _user=api_key, _env_status="ready")
+        fake_redis_conn.hset("autotest:scheduler:config", mapping={"depth": 1, "deadline_window": 3600})
+        return {"Api-Key": api_key}
+
+    @staticmethod
+    def _add_samples(conn, name, samples):
+        conn.rpush(f"autotest:durations:1:1:{name}", *samples)
+
+    def _run(self, client, headers, n=1):
+        test_data = [{"file_url": f"http://example.com/{i}"} for i in range(n)]
+        json_ = {"test_data": test_data, "categories": ["student"]}
+        return client.put("/settings/1/test", json=json_, headers=headers).json["test_ids"]
+
+    def test_percentile(self):
+        assert autotest_client.estimates.percentile(list(range(1, 101)), 0.99) == 99
+        assert autotest_client.estimates.percentile([5], 0.5) == 5
+        assert autotest_client.estimates.percentile([], 0.5) is None
+
+    def test_default_timeout(self, client, headers, fake_redis_conn):
+        (test_id,) = self._run(client, headers)
+        assert rq.job.Job.fetch(str(test_id), connection=fake_redis_conn).timeout == 1800
+
+    def test_predicted_timeout(self, client, headers, fake_redis_conn):
+        self._add_samples(fake_redis_conn, "0:0", [40] * 99 + [100])
+        self._add_samples(fake_redis_conn, "overhead", [5] * 20)
+        (test_id,) = self._run(client, headers)
+        assert rq.job.Job.fetch(str(test_id), connection=fake_redis_conn).timeout == 135
+
+    def test_predicted_timeout_capped_by_group_timeout(self, client, headers, fake_redis_conn):
+        self._add_samples(fake_redis_conn, "0:0", [500] * 20)
+        self._add_samples(fake_redis_conn, "overhead", [5] * 20)
+        (test_id,) = self._run(client, headers)
+        assert rq.job.Job.fetch(str(test_id), connection=fake_redis_conn).timeout == 615
+
+    def test_not_enough_samples(self, client, headers, fake_redis_conn):
+        self._add_samples(fake_redis_conn, "0:0", [10] * 19)
+        self._add_samples(fake_redis_conn, "overhead", [5] * 20)
+        (test_id,) = self._run(client, headers)
+        assert rq.job.Job.fetch(str(test_id), connection=fake_redis_conn).timeout == 1800
+
+    def test_status_without_eta(self, client, headers):
+        test_ids = self._run(client, headers)
+        response = client.get("/settings/1/tests/status", json={"test_ids": test_ids}, headers=headers)
+        assert response.json == {str(test_ids[0]): "queued"}
+
+    def test_status_with_eta(self, client, headers, fake_redis_conn):
+        self._add_samples(fake_redis_conn, "total", [10, 20, 30])
+        test_ids = self._run(client, headers, 3)
+        start = time.time()
+        response = client.get(
+            "/settings/1/tests/status", json={"test_ids": test_ids, "include_eta": True}, headers=headers
+        )
+        etas = [response.json[str(id_)]["eta"] for id_ in test_ids]
+        assert all(response.json[str(id_)]["status"] == "queued" for id_ in test_ids)
+        assert [round(eta - start) for eta in etas] == [20, 40, 60]
+
+    def test_status_with_eta_without_lpos(self, client, headers, fake_redis_conn, monkeypatch):
+        def lpos(*args, **kwargs):
+            raise redis.ResponseError("unknown command 'LPOS'")
+
+        monkeypatch.setattr(fake_redis_conn, "lpos", lpos)
+        monkeypatch.setattr(autotest_client.estimates, "_lpos_supported", True)
+        self._add_samples(fake_redis_conn, "total", [10, 20, 30])
+        test_ids = self._run(client, headers, 2)
+        start = time.time()
+        response = client.get(
+            "/settings/1/tests/status", json={"test_ids": test_ids, "include_eta": True}, headers=headers
+        )
+        assert [round(response.json[str(id_)]["eta"] - start) for id_ in test_ids] == [20, 40]
+        assert autotest_client.estimates._lpos_supported is False
+
+    def test_status_eta_unknown(self, client, headers):
+        test_ids = self._run(client, headers)
+        response = client.get(
+            "/settings/1/tests/status", json={"test_ids": test_ids, "include_eta": True}, headers=headers
+        )
+        assert response.json == {str(test_ids[0]): {"status": "queued", "eta": None}}
+
+
+class TestScheduler:
+    @pytest.fixture
+    def headers(self, client, fake_redis_conn, dispatch_script):
+        api_key = client.post("/register", json={"auth_type": "test", "credentials": "12345"}).json["api_key"]
+        for settings_id in (1, 2):
+            spec = {"testers": [{"test_data": [{"timeout": 10}]}]}
+            _set_settings(fake_redis_conn, settings_id, spec, _user=api_key, _env_status="ready")
+        return {"Api-Key": api_key}
+
+    @staticmethod
+    def _run(client, headers, settings_id, n, **kwargs):
+        test_data = [{"file_url": f"http://example.com/{i}"} for i in range(n)]
+        json_ = {"test_data": test_data, "categories": [], **kwargs}
+        return client.put(f"/settings/{settings_id}/test", json=json_, headers=headers)
+
+    @staticmethod
+    def _dispatch_all(conn):
+        dispatched = []
+        while True:
+            autotest_client.scheduler.dispatch(conn)
+            job_id = conn.lpop("rq:queue:batch")
+            if job_id is None:
+                return dispatched
+            dispatched.append(job_id.decode())
+
+    def test_batch_queue_depth(self, client, headers, fake_redis_conn):
+        fake_redis_conn.hset("autotest:scheduler:config", mapping={"depth": 2, "deadline_window": 3600})
+        self._run(client, headers, 1, 3)
+        assert rq.Queue("batch", connection=fake_redis_conn).job_ids == ["1", "2"]
+        assert fake_redis_conn.lrange("autotest:scheduler:jobs:1", 0, -1) == [b"3"]
+
+    def test_fair_share(self, client, headers, fake_redis_conn):
+        self._run(client, headers, 1, 4)
+        self._run(client, headers, 2, 2)
+        assert self._dispatch_all(fake_redis_conn) == ["1", "2", "5", "3", "6", "4"]
+
+    def test_weights(self, client, headers, fake_redis_conn):
+        fake_redis_conn.hset("autotest:scheduler:weights", "2", 2)
+        self._run(client, headers, 1, 3)
+        self._run(client, headers, 2, 4)
+        assert self._dispatch_all(fake_redis_conn) == ["1", "2", "4", "5", "3", "6", "7"]
+
+    def test_deadline(self, client, headers, fake_redis_conn):
+        self._run(client, headers, 1, 3)
+        self._run(client, headers, 2, 2, deadline=datetime.now().isoformat())
+        assert self._dispatch_all(fake_redis_conn) == ["1", "4", "5", "2", "3"]
+
+    def test_invalid_deadline(self, client, headers):
+        assert self._run(client, headers, 1, 2, deadline="tomorrow").status_code == 422
+
+    def test_canceled_jobs_skipped(self, client, headers, fake_redis_conn):
+        self._run(client, headers, 1, 3)
+        rq.job.Job.fetch("2", connection=fake_redis_conn).cancel()
+        assert self._dispatch_all(fake_redis_conn) == ["1", "3"]
+
+    def test_not_dispatched_without_script(self, client, headers, fake_redis_conn):
+        fake_redis_conn.delete(autotest_client.scheduler.SCRIPT_KEY)
+        self._run(client, headers, 1, 2)
+        assert not fake_redis_conn.exists("rq:queue:batch")
+        assert fake_redis_conn.lrange("autotest:scheduler:jobs:1", 0, -1) == [b"1", b"2"]
+
+    def test_single_test_not_scheduled(self, client, headers, fake_redis_conn):
+        self._run(client, headers, 1, 1)
+        assert rq.Queue("low", connection=fake_redis_conn).job_ids == ["1"]
+        assert not fake_redis_conn.exists("autotest:scheduler:tenants")
+
+
+class TestAuthorization:
+    @pytest.fixture
+    def api_key(self, client, fake_redis_conn):
+        api_key = client.post("/register", json={"auth_type": "test", "credentials": "12345"}).json["api_key"]
+        _set_settings(fake_redis_conn, 1, {"testers": []}, _user=api_key)
+        return api_key
+
+    def test_missing_api_key(self, client):
+        assert client.get("/schema").status_code == 401
+
+    def test_unknown_api_key(self, client, api_key):
+        assert client.get("/schema", headers={"Api-Key": "unknown"}).status_code == 401
+
+    def test_known_api_key(self, client, api_key):
+        assert client.get("/schema", headers={"Api-Key": api_key}).status_code == 200
+
+    def test_api_key_cached(self, client, api_key, fake_redis_conn):
+        client.get("/schema", headers={"Api-Key": api_key})
+        fake_redis_conn.hdel("autotest:user_credentials", api_key)
+        assert client.get("/schema", headers={"Api-Key": api_key}).status_code == 200
+
+    def test_settings_not_found(self, client, api_key):
+        assert client.get("/settings/2", headers={"Api-Key": api_key}).status_code == 404
+
+    def test_settings_other_user(self, client, api_key, fake_redis_conn):
+        _set_settings(fake_redis_conn, 2, _user="other")
+        assert client.get("/settings/2", headers={"Api-Key": api_key}).status_code == 401
+
+    def test_settings_owner_cached(self, client, api_key, fake_redis_conn):
+        client.get("/settings/1", headers={"Api-Key": api_key})
+        fake_redis_conn.hset("autotest:settings:1", "_user", "other")
+        assert client.get("/settings/1", headers={"Api-Key": api_key}).status_code == 200
+
+    def test_cache_expires(self, monkeypatch):
+        cache = autotest_client._TTLCache(10)
+        cache.set("a", 1)
+        assert cache.get("a") == 1
+        monkeypatch.setattr(autotest_client.time, "monotonic", lambda: float("inf"))
+        assert cache.get("a") is None
+
+
+class TestRateLimit:
+    @pytest.fixture
+    def api_key(self, client):
+        return client.post("/register", json={"auth_type": "test", "credentials": "12345"}).json["api_key"]
+
+    def _requests(self, client, api_key, n):
+        return [client.get("/schema", headers={"Api-Key": api_key}) for _ in range(n)]
+
+    def test_default_burst(self, client, api_key):
+        responses = self._requests(client, api_key, 21)
+        assert [r.status_code for r in responses] == [200] * 20 + [429]
+
+    def test_retry_after(self, client, api_key):
+        response = self._requests(client, api_key, 21)[-1]
+        assert 1 <= int(response.headers["Retry-After"]) <= 3
+
+    def test_per_key_burst(self, client, api_key, fake_redis_conn):
+        fake_redis_conn.set(f"autotest:ratelimit:{api_key}:burst", 2)
+        responses = self._requests(client, api_key, 3)
+        assert [r.status_code for r in responses] == [200, 200, 429]
+
+    def test_per_key_limit(self, client, api_key, fake_redis_conn):
+        fake_redis_conn.set(f"autotest:ratelimit:{api_key}:limit", 6)
+        fake_redis_conn.set(f"autotest:ratelimit:{api_key}:burst", 1)
+        response = self._requests(client, api_key, 2)[-1]
+        assert response.status_code == 429
+        assert 9 <= int(response.headers["Retry-After"]) <= 10
+
+    def test_tokens_refill(self, client, api_key, fake_redis_conn):
+        fake_redis_conn.set(f"autotest:ratelimit:{api_key}:burst", 1)
+        self._requests(client, api_key, 1)
+        fake_redis_conn.hset(f"autotest:ratelimit:{api_key}:bucket", "timestamp", 0)
+        assert self._requests(client, api_key, 1)[0].status_code == 200
+
+
+class TestSettings:
+    @pytest.fixture
+    def headers(self, client, fake_redis_conn):
+        api_key = client.post("/register", json={"auth_type": "test", "credentials": "12345"}).json["api_key"]
+        schema = {"type": "object", "definitions": {"files_list": {}, "test_data_categories": {"enum": []}}}
+        fake_redis_conn.set("autotest:schema", json.dumps(schema))
+        return {"Api-Key": api_key}
+
+    def test_get_settings(self, client, headers, fake_redis_conn):
+        _set_settings(fake_redis_conn, 1, {"testers": [], "_files": "x"}, _user=headers["Api-Key"])
+        assert client.get("/settings/1", headers=headers).json == {"testers": []}
+
+    def test_get_legacy_settings(self, client, headers, fake_redis_conn):
+        legacy = {"testers": [], "_user": headers["Api-Key"], "_env_status": "ready"}
+        fake_redis_conn.hset("autotest:settings", "1", json.dumps(legacy))
+        assert client.get("/settings/1", headers=headers).json == {"testers": []}
+
+    def test_update_legacy_settings(self, client, headers, fake_redis_conn):
+        fake_redis_conn.hset("autotest:settings", "1", json.dumps({"testers": [], "_user": headers["Api-Key"]}))
+        client.put("/settings/1", json={"settings": {"testers": [], "a": 1}}, headers=headers)
+        assert fake_redis_conn.hget("autotest:settings:1", "_version") == b"1"
+        assert not fake_redis_conn.hexists("autotest:settings", "1")
+
+    def test_get_settings_error(self, client, headers, fake_redis_conn):
+        _set_settings(fake_redis_conn, 1, {"testers": []}, _user=headers["Api-Key"], _error="bad")
+        assert client.get("/settings/1", headers=headers).status_code == 500
+
+    def test_create_settings(self, client, headers, fake_redis_conn):
+        response = client.post("/settings", json={"settings": {"testers": []}}, headers=headers)
+        settings_id = response.json["settings_id"]
+        fields = fake_redis_conn.hgetall(f"autotest:settings:{settings_id}")
+        assert fields[b"_user"] == headers["Api-Key"].encode()
+        assert fields[b"_env_status"] == b"setup"
+        assert fields[b"_version"] == b"1"
+        assert json.loads(fake_redis_conn.get(f"autotest:settings_spec:{settings_id}:1")) == {"testers": []}
+
+    def test_update_settings_creates_version(self, client, headers, fake_redis_conn):
+        _set_settings(fake_redis_conn, 1, {"testers": []}, _user=headers["Api-Key"], _error="bad")
+        client.put("/settings/1", json={"settings": {"testers": [], "a": 1}}, headers=headers)
+        fields = fake_redis_conn.hgetall("autotest:settings:1")
+        assert fields[b"_version"] == b"2"
+        assert b"_error" not in fields
+        assert json.loads(fake_redis_conn.get("autotest:settings_spec:1:2")) == {"testers": [], "a": 1}
+        assert fake_redis_conn.ttl("autotest:settings_spec:1:1") > 0
+
+    def test_update_job_version(self, client, headers, fake_redis_conn):
+        _set_settings(fake_redis_conn, 1, {"testers": []}, _user=headers["Api-Key"])
+        client.put("/settings/1", json={"settings": {"testers": []}}, headers=headers)
+        job = rq.Queue("settings", connection=fake_redis_conn).fetch_job("settings_1")
+        assert job.kwargs["version"] == 2
@@ -10,15 +10,24 @@ import socket
 import getpass
 import requests
 import gzip
+import tempfile
 import redis
 import importlib
+import functools
 import psycopg2
 import mimetypes
 import rq
+import threading
 import traceback
-from typing import Optional, Dict, Union, List, Tuple, Callable, Type
+import uuid
+import fcntl
+import glob
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Dict, Union, List, Tuple, Callable, Type, Set, Collection
 from types import TracebackType
+from rq.timeouts import JobTimeoutException
 
+from . import cleanup
 from .config import config
 from .utils import (
     loads_partial_json,
@@ -26,10 +35,39 @@ from .utils import (
     extract_zip_stream,
     recursive_iglob,
     copy_tree,
+    PhaseTimer,
 )
+from .cleanup import clear_directory, clear_tmp
+from .runners import RunnerPool
+from .archive_cache import ArchiveCache
+from .cgroups import TestCgroup
+from . import databases
+from . import scheduler
 
 DEFAULT_ENV_DIR = "defaultvenv"
 TEST_SCRIPT_DIR = os.path.join(config["workspace"], "scripts")
+ARCHIVE_CACHE_DIR = os.path.join(config["workspace"], "archive_cache")
+TRASH_DIR = os.path.join(config["workspace"], "trash")
+CLEANUP_HELPER = os.path.join(config["workspace"], "cleanup.py")
+ARCHIVE_SPOOL_SIZE = 16 * 1024 * 1024
+ARCHIVE_CHUNK_SIZE = 1024 * 1024
+SETTINGS_KEY = "autotest:settings:{}"
+SETTINGS_SPEC_KEY = "autotest:settings_spec:{}:{}"
+LEGACY_SETTINGS_KEY = "autotest:settings"
+SETTINGS_FIELDS = ("_user", "_last_access", "_env_status", "_error", "_version")
+TIMINGS_KEY = "autotest:timings:{}"
+ALL_TIMINGS_KEY = "autotest:timings"
+JOB_COUNTS_KEY = "autotest:metrics:jobs"
+JOB_COUNTS_PER_MINUTE_KEY = "autotest:metrics:jobs:{}:{}"
+KILLED_GROUPS_KEY = "autotest:metrics:killed_groups"
+DURATIONS_KEY = "autotest:durations:{}:{}:{}"
+DURATION_SAMPLES = 200
+DURATIONS_TTL = 7 * 24 * 3600
+TIMING_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1200, 3600)
+_PORT_LOCK = threading.Lock()
+_SETTINGS_CACHE: Dict[str, Tuple[int, Dict]] = {}
+_TEST_PROCESS_GROUPS: Set[int] = set()
+_RUNNING_GROUPS: Set[Callable[[], None]] = set()
 
 ResultData = Dict[str, Union[str, int, type(None), Dict]]
 
@@ -38,6 +76,132 @@ def redis_connection() -> redis.Redis:
     return rq.get_current_job().connection
 
 
+def _get_settings_fields(settings_id: Union[int, str], connection: Optional[redis.Redis] = None) -> Dict:
+    """
+    Return the fields stored in the settings hash for settings_id (see SETTINGS_FIELDS).
+    """
+    connection = connection or redis_connection()
+    fields = {}
+    for key, value in (connection.hgetall(SETTINGS_KEY.format(settings_id)) or {}).items():
+        key = key.decode() if isinstance(key, bytes) else key
+        value = value.decode() if isinstance(value, bytes) else value
+        fields[key] = int(value) if key in ("_last_access", "_version") else value
+    return fields
+
+
+def migrate_legacy_settings(settings_id: Union[int, str], connection: Optional[redis.Redis] = None) -> bool:
+    """
+    Move the test settings for settings_id stored as a single json string in the LEGACY_SETTINGS_KEY hash
+    (used by previous versions of the autotester) to a settings hash and a settings spec (version 1).
+
+    Return True if there were legacy settings for settings_id. Legacy settings are not migrated if the settings
+    hash already exists (the settings have been updated since) but they are still removed.
+    """
+    connection = connection or redis_connection()
+    key = SETTINGS_KEY.format(settings_id)
+
+    def _migrate(pipeline: redis.client.Pipeline) -> bool:
+        legacy = pipeline.hget(LEGACY_SETTINGS_KEY, str(settings_id))
+        if legacy is None:
+            pipeline.reset()
+            return False
+        exists = pipeline.exists(key)
+        settings = json.loads(legacy)
+        fields = {k: settings.pop(k) for k in SETTINGS_FIELDS if k in settings}
+        fields = {k: v for k, v in fields.items() if v is not None}
+        pipeline.multi()
+        if not exists:
+            pipeline.set(SETTINGS_SPEC_KEY.format(settings_id, 1), json.dumps(settings))
+            pipeline.hset(key, mapping={**fields, "_version": 1})
+        pipeline.hdel(LEGACY_SETTINGS_KEY, str(settings_id))
+        return True
+
+    return connection.transaction(_migrate, LEGACY_SETTINGS_KEY, key, value_from_callable=True)
+
+
+def load_settings(settings_id: Union[int, str], connection: Optional[redis.Redis] = None) -> Dict:
+    """
+    Return the test settings for settings_id: the settings spec for the current version of the
+    settings combined with the fields in the settings hash.
+
+    Settings specs are immutable once their environment is ready so ready specs are decoded once
+    and cached in this process by settings_id and version. Specs that are missing (or whose environment
+    is not ready) are never cached. The returned spec may be shared with
+    later callers and must not be modified.
+
+    Settings that are still stored in the format used by previous versions of the autotester are migrated
+    the first time they are loaded (see migrate_legacy_settings).
+    """
+    connection = connection or redis_connection()
+    fields = _get_settings_fields(settings_id, connection)
+    if not fields and migrate_legacy_settings(settings_id, connection):
+        fields = _get_settings_fields(settings_id, connection)
+    if not fields:
+        raise Exception(f"settings with id {settings_id} not found")
+    version = fields.get("_version", 0)
+    cached_version, spec = _SETTINGS_CACHE.get(str(settings_id), (None, None))
+    if cached_version != version:
+        raw_spec = connection.get(SETTINGS_SPEC_KEY.format(settings_id, version))
+        spec = json.loads(raw_spec or "{}")
+        if raw_spec is not None and fields.get("_env_status") == "ready":
+            _SETTINGS_CACHE[str(settings_id)] = (version, spec)
+    return {**spec, **fields}
+
+
+def _save_settings(settings_id: Union[int, str], version: Optional[int], test_settings: Dict) -> None:
+    """
+    Save test_settings as the settings spec for version and update the settings hash fields for settings_id.
+
+    Nothing is saved if the settings have been updated again since version was created (another
+    update_test_settings job for the newer version will save them instead).
+    """
+    key = SETTINGS_KEY.format(settings_id)
+    spec = {k: v for k, v in test_settings.items() if k not in SETTINGS_FIELDS}
+    fields = {k: v for k, v in test_settings.items() if k in SETTINGS_FIELDS and v is not None}
+
+    def _save(pipeline: redis.client.Pipeline) -> None:
+        current = pipeline.hget(key, "_version")
+        current_version = int(current) if current is not None else 0
+        if version is not None and current_version != version:
+            pipeline.reset()
+            return
+        pipeline.multi()
+        pipeline.set(SETTINGS_SPEC_KEY.format(settings_id, current_version), json.dumps(spec))
+        pipeline.hset(key, mapping={**fields, "_version": current_version})
+        if "_error" not in fields:
+            pipeline.hdel(key, "_error")
+
+    redis_connection().transaction(_save, key)
+
+
+def invalidate_settings(settings_id: Union[int, str]) -> None:
+    """
+    Remove the settings for settings_id from the settings cache in this process.
+    """
+    _SETTINGS_CACHE.pop(str(settings_id), None)
+
+
+def prepare_settings(settings_id: Union[int, str], connection: redis.Redis) -> None:
+    """
+    Load the test settings for settings_id and build the commands used to run each of its testers so that
+    they are cached in this process.
+
+    This is called by the worker before it forks the process that runs a test job (see worker.py) so that
+    the cached settings and commands are inherited by every test job instead of being rebuilt for each one.
+    Settings that are missing required keys are removed from the cache so that they are loaded again for
+    the next test job.
+    """
+    settings = load_settings(settings_id, connection)
+    if "_files" not in settings:
+        # never keep settings in the cache that every test job would fail to run with
+        invalidate_settings(settings_id)
+        raise Exception(f"settings with id {settings_id} are incomplete")
+    for tester_settings in settings.get("testers", []):
+        _create_test_script_command(tester_settings["tester_type"])
+        if config.get("warm_runners"):
+            _create_runner_command(tester_settings["tester_type"])
+
+
 def run_test_command(test_username: Optional[str] = None) -> str:
     """
     Return a command used to run test scripts as a the test_username
@@ -58,6 +222,48 @@ def run_test_command(test_username: Optional[str] = None) -> str:
     return cmd
 
 
+def _worker_config(test_username: str) -> Dict:
+    """
+    Return the config for the worker user test_username (or an empty dict if there is none).
+    """
+    return next((w for w in config.get("workers", []) if w["user"] == test_username), {})
+
+
+def _shared_user(test_username: str) -> bool:
+    """
+    Return True if test_username runs tests for several worker slots at the same time.
+
+    Processes run by a shared user must never be killed by killing all of the user's processes
+    and its files in /tmp must never be removed since they may belong to a test run in another slot.
+    """
+    return int(_worker_config(test_username).get("concurrency", 1)) > 1
+
+
+def _slot_tmp_dir(test_username: str) -> Optional[str]:
+    """
+    Return the temporary directory used by tests run in the current worker slot (set by the WORKERSLOT
+    environment variable) if test_username is shared by several slots. Otherwise return None since tests
+    can use /tmp.
+    """
+    slot = os.environ.get("WORKERSLOT")
+    if slot is None or not _shared_user(test_username):
+        return None
+    return os.path.join(config["workspace"], "workers", test_username, "tmp", slot)
+
+
+def _slot_port_range(min_: int, max_: int, concurrency: int) -> Tuple[int, int]:
+    """
+    Return the range of ports (inclusive) available to the current worker slot (set by the WORKERSLOT
+    environment variable) when the ports from min_ to max_ are split evenly between concurrency slots.
+    """
+    slot = os.environ.get("WORKERSLOT")
+    if concurrency <= 1 or slot is None:
+        return min_, max_
+    size = (max_ - min_ + 1) // concurrency
+    start = min_ + int(slot) * size
+    return start, start + size - 1
+
+
 def _create_test_group_result(
     stdout: str, stderr: str, run_time: int, extra_info: Dict, feedback: List, timeout: Optional[int] = None
 ) -> ResultData:
@@ -126,6 +332,52 @@ def _kill_pgid_children(proc: subprocess.Popen) -> None:
         proc.kill()
 
 
+def _kill_test_processes(proc: subprocess.Popen, test_username: str) -> None:
+    """
+    Kill the processes started to run a test group after it has timed out.
+    """
+    if test_username != getpass.getuser():
+        _kill_user_processes(test_username)
+    else:
+        _kill_pgid_children(proc)
+        proc.wait()
+
+
+def _cgroup_root() -> Optional[str]:
+    """
+    Return the directory that test group cgroups are created in or None if test groups are not run in cgroups.
+    """
+    return (config.get("cgroups") or {}).get("root")
+
+
+def _kill_process_group(proc: subprocess.Popen, test_username: str) -> None:
+    """
+    Kill all processes in the process group started by proc after it has timed out.
+
+    This is used instead of _kill_test_processes when several test groups are run at
+    the same time, or when the test user is shared by several worker slots, so that
+    other test groups are not killed as well.
+    """
+    if test_username != getpass.getuser():
+        subprocess.run(f"sudo -u {test_username} -- bash -c 'kill -KILL -- -{proc.pid}'", shell=True)
+    else:
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+    proc.wait()
+
+
+@functools.lru_cache(maxsize=None)
+def _resource_settings() -> Tuple[Tuple[int, Tuple[int, int]], ...]:
+    """
+    Return the rlimit settings from the config file. These are looked up once per process
+    since neither the config file nor the worker's own rlimits change while it is running.
+    """
+    return tuple(get_resource_settings(config))
+
+
+@functools.lru_cache(maxsize=None)
 def _create_test_script_command(tester_type: str) -> str:
     """
     Return string representing a command line command to
@@ -137,15 +389,35 @@ def _create_test_script_command(tester_type: str) -> str:
         f'sys.path.append("{os.path.dirname(os.path.abspath(__file__))}")',
         import_line,
         "from testers.specs import TestSpecs",
-        f"Tester(resource_settings={get_resource_settings(config)}, specs=TestSpecs.from_json(sys.stdin.read())).run()",
+        f"Tester(resource_settings={list(_resource_settings())}, specs=TestSpecs.from_json(sys.stdin.read())).run()",
     ]
     python_str = "; ".join(python_lines)
     return f"\"${{PYTHON}}\" -c '{python_str}'"
 
 
-def get_available_port(min_, max_, host: str = "localhost") -> str:
-    """Return the next available open port on host."""
+@functools.lru_cache(maxsize=None)
+def _create_runner_command(tester_type: str) -> str:
+    """
+    Return string representing a command line command to
+    start a warm tester runner (see testers/runner.py).
+    """
+    import_line = f"from testers.{tester_type}.{tester_type}_tester import {tester_type.capitalize()}Tester as Tester"
+    python_lines = [
+        "import sys",
+        f'sys.path.append("{os.path.dirname(os.path.abspath(__file__))}")',
+        import_line,
+        "from testers.runner import serve",
+        f"serve(Tester, resource_settings={list(_resource_settings())})",
+    ]
+    python_str = "; ".join(python_lines)
+    return f"\"${{PYTHON}}\" -c '{python_str}'"
+
+
+def get_available_port(min_, max_, host: str = "localhost", exclude: Collection[str] = ()) -> str:
+    """Return the next available open port on host that is not in exclude."""
     for next_port in range(min_, max_ + 1):
+        if str(next_port) in exclude:
+            continue
         try:
             with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
                 s.bind((host, next_port))
@@ -156,17 +428,44 @@ def get_available_port(min_, max_, host: str = "localhost") -> str:
             continue
 
 
-def _get_env_vars(test_username: str) -> Dict[str, str]:
-    """Return a dictionary containing all environment variables to pass to the next test"""
+def _get_env_vars(
+    test_username: str, reserved_ports: Optional[Set[str]] = None, database_template: Optional[str] = None
+) -> Dict[str, str]:
+    """
+    Return a dictionary containing all environment variables to pass to the next test
+
+    If test_username is shared by several worker slots, the PORT is chosen from the ports reserved
+    for the current slot and TMPDIR is set to a temporary directory for the current slot.
+
+    If reserved_ports is not None, the PORT assigned to the next test will not be one
+    of reserved_ports and will be added to reserved_ports.
+
+    If database_template is not None, the DATABASE_URL points to a new copy of the
+    database_template database instead of the (emptied) database at the worker's postgresql_url.
+    """
     env_vars = {}
-    worker_config = [w for w in config["workers"] if w["user"] == test_username][0]
+    worker_config = _worker_config(test_username)
+    tmp_dir = _slot_tmp_dir(test_username)
+    if tmp_dir is not None:
+        env_vars["TMPDIR"] = tmp_dir
     resources_config = worker_config.get("resources", {})
     if resources_config:
         port_config = resources_config.get("port")
         if port_config:
-            env_vars["PORT"] = get_available_port(port_config["min"], port_config["max"])
+            min_, max_ = _slot_port_range(port_config["min"], port_config["max"], worker_config.get("concurrency", 1))
+            if reserved_ports is None:
+                env_vars["PORT"] = get_available_port(min_, max_)
+            else:
+                with _PORT_LOCK:
+                    port = get_available_port(min_, max_, exclude=reserved_ports)
+                    if port is not None:
+                        reserved_ports.add(port)
+                env_vars["PORT"] = port
         postgresql_url = resources_config.get("postgresql_url")
-        if postgresql_url:
+        if postgresql_url and database_template is not None:
+            env_vars["DATABASE_URL"] = databases.create_test_database(postgresql_url, test_username, database_template)
+            env_vars["AUTOTESTENV"] = "true"
+        elif postgresql_url:
             with psycopg2.connect(postgresql_url) as conn:  # requires postgres 9.2+
                 with conn.cursor() as cursor:
                     cursor.execute("DROP OWNED BY CURRENT_USER;")
@@ -215,6 +514,198 @@ def _update_env_vars(base_env: Dict, test_env: Dict) -> Dict:
     return {**base_env, **test_env}
 
 
+def _group_timeout(test_data: Dict) -> Optional[int]:
+    """
+    Return the timeout for the test group described by test_data, capped by
+    the max_test_timeout config setting.
+    """
+    timeout = test_data.get("timeout")
+    max_timeout = config.get("max_test_timeout")
+    if max_timeout is not None:
+        if timeout is None:
+            timeout = max_timeout
+        else:
+            timeout = min(timeout, max_timeout)
+    return timeout
+
+
+def _max_parallel_groups(test_settings: Dict, test_username: str) -> int:
+    """
+    Return the maximum number of test groups that may run at the same time for
+    the given test settings.
+
+    Test groups are always run one at a time if the worker user has a postgresql
+    database since all test groups would share that database.
+    """
+    if _worker_config(test_username).get("resources", {}).get("postgresql_url"):
+        return 1
+    return max(int(test_settings.get("max_parallel_groups") or 1), 1)
+
+
+def _run_test_group(
+    cmd: str,
+    settings: Dict,
+    test_data: Dict,
+    tests_path: str,
+    test_username: str,
+    test_id: Union[int, str],
+    test_env_vars: Dict[str, str],
+    runner_pool: Optional[RunnerPool] = None,
+    reserved_ports: Optional[Set[str]] = None,
+    timer: Optional[PhaseTimer] = None,
+    database_template: Optional[str] = None,
+) -> ResultData:
+    """
+    Run a single test group described by test_data in the tests_path directory
+    using the command cmd. Return the result.
+
+    If reserved_ports is not None, this test group may be running at the same time
+    as other test groups. The test group is started in a new process group (so that
+    it can be killed on timeout without affecting other test groups) and the PORT
+    assigned to this test group is reserved until it completes. The test group is
+    also started in a new process group if test_username is shared by several
+    worker slots.
+
+    If the cgroups: root config setting is set and runner_pool is None, the test group
+    is run in its own cgroup instead (see cgroups.py) with the memory, cpu and process
+    limits in the cgroups config settings. All processes started by the test group are
+    killed through the cgroup on timeout and once the test group completes, and the memory
+    and cpu time used by the test group are reported in the "resource_usage" key of the
+    result's extra_info. If any process was killed because the test group ran out of
+    memory, this is reported in stderr and in the "oom_kills" key of "resource_usage".
+
+    If timer is not None, the time spent setting up environment variables, running
+    the tests and collecting feedback files is added to timer.
+
+    If database_template is not None, the test group uses a new copy of the database_template
+    database (see databases.py).
+
+    If the job times out while the test group is running, the test group is killed and the
+    JobTimeoutException is re-raised so that no later test groups are run.
+    """
+    timer = timer or PhaseTimer()
+    tester_type = settings["tester_type"]
+    args = cmd.format(_create_test_script_command(tester_type))
+    start = time.time()
+    out, err = "", ""
+    timeout_expired = None
+    timeout = _group_timeout(test_data)
+    test_group_name = test_data.get("extra_info", {}).get("name", "").strip()
+    group_env_vars = {}
+    isolated = reserved_ports is not None
+    new_session = isolated or _shared_user(test_username)
+    kill = _kill_process_group if new_session else _kill_test_processes
+    cgroup_root = _cgroup_root() if runner_pool is None else None
+    cgroup = None
+    stop = None
+    try:
+        env = settings.get("_env", {})
+        with timer.phase("env_setup"):
+            group_env_vars = _get_env_vars(test_username, reserved_ports, database_template)
+            env_vars = {**os.environ, **group_env_vars, **env}
+            env_vars = _update_env_vars(env_vars, test_env_vars)
+            if cgroup_root is not None:
+                limits = {k: v for k, v in config["cgroups"].items() if k != "root"}
+                cgroup = TestCgroup(cgroup_root, test_username, **limits, user=test_username)
+                args = cgroup.wrap_command(args)
+        returncode = None
+        tests_start = time.monotonic()
+        try:
+            if runner_pool is None:
+                proc = subprocess.Popen(
+                    args,
+                    cwd=tests_path,
+                    shell=True,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE,
+                    stdin=subprocess.PIPE,
+                    universal_newlines=True,
+                    env={**os.environ, **env_vars, **env},
+                    executable="/bin/bash",
+                    start_new_session=new_session,
+                )
+                if new_session and cgroup is None:
+                    _TEST_PROCESS_GROUPS.add(proc.pid)
+                stop = cgroup.kill if cgroup is not None else functools.partial(kill, proc, test_username)
+                _RUNNING_GROUPS.add(stop)
+                settings_json = json.dumps({**settings, "test_data": test_data})
+                out, err = proc.communicate(input=settings_json, timeout=timeout)
+            else:
+                out, err, returncode = runner_pool.run(
+                    tester_type,
+                    {**env_vars, **env},
+                    {**settings, "test_data": test_data},
+                    timeout,
+                    on_timeout=lambda p: kill(p, test_username),
+                )
+        except subprocess.TimeoutExpired:
+            if cgroup is not None:
+                cgroup.kill()
+                out, err = proc.communicate()
+                returncode = proc.returncode
+            elif runner_pool is None:
+                kill(proc, test_username)
+                out, err = proc.communicate()
+                returncode = proc.returncode
+            else:
+                returncode = -signal.SIGKILL
+            if err == "Killed\n" or (not err and returncode is not None and returncode != 0):
+                # err can be "Killed\n" (shell default) or empty (SIGKILL/OOM silent crash).
+                # Check the returncode to reliably detect both cases.
+                if test_group_name:
+                    err = f"Tests for {test_group_name} did not complete within time limit ({timeout}s)\n"
+                else:
+                    err = f"Tests did not complete within time limit ({timeout}s)\n"
+            timeout_expired = timeout
+        except JobTimeoutException:
+            # the job's own timeout expired (which can be shorter than the test group's timeout, see
+            # predict_timeout in the client) so stop this test group instead of going on to the next one
+            if stop is not None:
+                stop()
+            raise
+        finally:
+            _RUNNING_GROUPS.discard(stop)
+            timer.add("tests", time.monotonic() - tests_start)
+    except JobTimeoutException:
+        raise
+    except Exception as e:
+        err += "\n\n{}".format(e)
+    finally:
+        if isolated and "PORT" in group_env_vars:
+            with _PORT_LOCK:
+                reserved_ports.discard(group_env_vars["PORT"])
+        duration = int(round(time.time() - start, 3) * 1000)
+        extra_info = test_data.get("extra_info", {})
+        if cgroup is not None:
+            resource_usage = cgroup.stats()
+            cgroup.remove()
+            extra_info = {**extra_info, "resource_usage": resource_usage}
+            if resource_usage.get("oom_kills"):
+                msg = f"Tests for {test_group_name} ran out of memory" if test_group_name else "Tests ran out of memory"
+                memory_max = config["cgroups"].get("memory_max")
+                msg += f" (limit {memory_max} bytes)\n" if memory_max is not None else "\n"
+                err = msg if err in ("", "Killed\n") else msg + "\n" + err
+        with timer.phase("feedback"):
+            feedback, feedback_errors = _get_feedback(test_data, tests_path, test_id)
+        if feedback_errors:
+            msg = "Cannot find feedback file(s): " + ", ".join(feedback_errors)
+            err = err + "\n\n" + msg if err else msg
+    return _create_test_group_result(out, err, duration, extra_info, feedback, timeout_expired)
+
+
+def _test_groups(test_settings: Dict, categories: List[str]) -> List[Tuple[str, Dict, Dict]]:
+    """
+    Return the id, tester settings and test data of each test group in test_settings that should be run
+    for categories. The id of a test group is "<tester index>:<test data index>".
+    """
+    return [
+        (f"{i}:{j}", settings, test_data)
+        for i, settings in enumerate(test_settings["testers"])
+        for j, test_data in enumerate(settings["test_data"])
+        if set(test_data.get("category", [])) & set(categories)
+    ]
+
+
 def _run_test_specs(
     cmd: str,
     test_settings: dict,
@@ -223,145 +714,305 @@ def _run_test_specs(
     test_username: str,
     test_id: Union[int, str],
     test_env_vars: Dict[str, str],
+    runner_pool: Optional[RunnerPool] = None,
+    timer: Optional[PhaseTimer] = None,
+    database_template: Optional[str] = None,
 ) -> List[ResultData]:
     """
     Run each test script in test_scripts in the tests_path directory using the
     command cmd. Return the results.
+
+    If runner_pool is not None, test groups are run by the warm tester runners
+    in runner_pool instead of in a new process for each test group.
+
+    Up to test_settings["max_parallel_groups"] test groups are run at the same time.
+    The results are always returned in the same order as the test groups appear in
+    test_settings.
+
+    If timer is not None, the time spent in each phase of running the test groups is added to timer.
+
+    If database_template is not None, each test group uses a new copy of the database_template database.
+
+    If the job times out, every test group that is still running is killed before the JobTimeoutException
+    is re-raised.
     """
-    results = []
+    groups = [(settings, test_data) for _, settings, test_data in _test_groups(test_settings, categories)]
+    max_parallel = min(_max_parallel_groups(test_settings, test_username), len(groups))
+    if max_parallel <= 1:
+        return [
+            _run_test_group(
+                cmd,
+                settings,
+                test_data,
+                tests_path,
+                test_username,
+                test_id,
+                test_env_vars,
+                runner_pool,
+                timer=timer,
+                database_template=database_template,
+            )
+            for settings, test_data in groups
+        ]
 
-    for settings in test_settings["testers"]:
-        tester_type = settings["tester_type"]
-
-        cmd_str = _create_test_script_command(tester_type)
-        args = cmd.format(cmd_str)
-
-        for test_data in settings["test_data"]:
-            test_category = test_data.get("category", [])
-            if set(test_category) & set(categories):
-                start = time.time()
-                out, err = "", ""
-                timeout_expired = None
-                timeout = test_data.get("timeout")
-                max_timeout = config.get("max_test_timeout")
-                if max_timeout is not None:
-                    if timeout is None:
-                        timeout = max_timeout
-                    else:
-                        timeout = min(timeout, max_timeout)
-                try:
-                    env = settings.get("_env", {})
-                    env_vars = {**os.environ, **_get_env_vars(test_username), **env}
-                    env_vars = _update_env_vars(env_vars, test_env_vars)
-                    proc = subprocess.Popen(
-                        args,
-                        cwd=tests_path,
-                        shell=True,
-                        stdout=subprocess.PIPE,
-                        stderr=subprocess.PIPE,
-                        stdin=subprocess.PIPE,
-                        universal_newlines=True,
-                        env={**os.environ, **env_vars, **env},
-                        executable="/bin/bash",
-                    )
-                    try:
-                        settings_json = json.dumps({**settings, "test_data": test_data})
-                        out, err = proc.communicate(input=settings_json, timeout=timeout)
-                    except subprocess.TimeoutExpired:
-                        if test_username != getpass.getuser():
-                            _kill_user_processes(test_username)
-                        else:
-                            _kill_pgid_children(proc)
-                            proc.wait()
-                        out, err = proc.communicate()
-                        test_group_name = test_data.get("extra_info", {}).get("name", "").strip()
-                        if err == "Killed\n" or (not err and proc.returncode is not None and proc.returncode != 0):
-                            # err can be "Killed\n" (shell default) or empty (SIGKILL/OOM silent crash).
-                            # Check proc.returncode to reliably detect both cases.
-                            if test_group_name:
-                                err = f"Tests for {test_group_name} did not complete within time limit ({timeout}s)\n"
-                            else:
-                                err = f"Tests did not complete within time limit ({timeout}s)\n"
-                        timeout_expired = timeout
-                except Exception as e:
-                    err += "\n\n{}".format(e)
-                finally:
-                    duration = int(round(time.time() - start, 3) * 1000)
-                    extra_info = test_data.get("extra_info", {})
-                    feedback, feedback_errors = _get_feedback(test_data, tests_path, test_id)
-                    if feedback_errors:
-                        msg = "Cannot find feedback file(s): " + ", ".join(feedback_errors)
-                        err = err + "\n\n" + msg if err else msg
-                    results.append(_create_test_group_result(out, err, duration, extra_info, feedback, timeout_expired))
-    return results
+    reserved_ports = set()
+    with ThreadPoolExecutor(max_workers=max_parallel) as executor:
+        futures = [
+            executor.submit(
+                _run_test_group,
+                cmd,
+                settings,
+                test_data,
+                tests_path,
+                test_username,
+                test_id,
+                test_env_vars,
+                runner_pool,
+                reserved_ports,
+                timer,
+                database_template,
+            )
+            for settings, test_data in groups
+        ]
+        try:
+            return [future.result() for future in futures]
+        except JobTimeoutException:
+            # the job timeout is only raised in this thread, so stop the test groups that are still running
+            # in the other threads instead of waiting for them to complete
+            for future in futures:
+                future.cancel()
+            for stop in list(_RUNNING_GROUPS):
+                stop()
+            if runner_pool is not None:
+                runner_pool.interrupt()
+            raise
 
 
-def _clear_working_directory(tests_path: str, test_username: str) -> None:
+def _prepare_database_template(
+    settings_id: Union[int, str], test_settings: Dict, test_username: str, timer: Optional[PhaseTimer] = None
+) -> Optional[str]:
     """
-    Run commands that clear the tests_path working directory, as well
-    as clearing any files or directories owned by test_username in the /tmp directory
+    Return the name of the template database built from the database_seed_files in test_settings for
+    test_username, or None if test_settings do not have any seed files or test_username does not have a
+    postgresql_url.
+
+    If timer is not None, the time spent preparing the template is added to timer.
     """
-    if test_username != getpass.getuser():
-        sticky_cmd = f"sudo -u {test_username} -- bash -c 'chmod -Rf -t {tests_path}'"
-        chmod_cmd = f"sudo -u {test_username} -- bash -c 'chmod -Rf ugo+rwX {tests_path}'"
-        clean_tmp_cmd = (
-            f"sudo -u {test_username} -- bash -c 'find /tmp -maxdepth 1 -user {test_username} -exec rm " f"-rf {{}} +' "
+    seed_files = test_settings.get("database_seed_files")
+    postgresql_url = _worker_config(test_username).get("resources", {}).get("postgresql_url")
+    if not seed_files or not postgresql_url:
+        return None
+    with (timer or PhaseTimer()).phase("database_template"):
+        version = test_settings.get("_version", 0)
+        return databases.prepare_template(
+            postgresql_url, test_username, settings_id, version, seed_files, test_settings["_files"]
         )
-    else:
-        sticky_cmd = f"chmod -Rf -t {tests_path}"
-        chmod_cmd = f"chmod -Rf ugo+rwX {tests_path}"
-        clean_tmp_cmd = f"find /tmp -maxdepth 1 -user {test_username} -exec rm -rf {{}} +"
 
-    subprocess.run(sticky_cmd, shell=True)
-    subprocess.run(chmod_cmd, shell=True)
 
+@functools.lru_cache(maxsize=None)
+def _cleanup_helper() -> str:
+    """
+    Install a copy of the cleanup helper in the workspace and return its path.
+
+    The worker's own copy of the helper may be in a directory (such as a virtual environment) that the test users
+    cannot read, the workspace can be read by every test user since their working directories are in it.
+    """
+    with open(cleanup.__file__, "rb") as f:
+        content = f.read()
+    try:
+        with open(CLEANUP_HELPER, "rb") as f:
+            if f.read() == content:
+                return CLEANUP_HELPER
+    except FileNotFoundError:
+        pass
+    tmp_path = f"{CLEANUP_HELPER}.{os.getpid()}"
+    with open(tmp_path, "wb") as f:
+        f.write(content)
+    os.chmod(tmp_path, 0o644)
+    os.replace(tmp_path, CLEANUP_HELPER)
+    return CLEANUP_HELPER
+
+
+def _run_cleanup_helper(test_username: str, args: str) -> None:
+    """
+    Run the cleanup helper with args as test_username and print a warning if it fails.
+
+    The helper is run by the system python3 (found on sudo's secure_path) since the test user may not be able to
+    run the worker's python executable.
+    """
+    cleanup_cmd = f"sudo -u {test_username} -- python3 -I {_cleanup_helper()} {args}"
+    proc = subprocess.run(cleanup_cmd, shell=True, stdin=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    if proc.returncode != 0:
+        print(f"cleanup as {test_username} failed with exit code {proc.returncode}: {proc.stderr}", file=sys.stderr)
+
+
+def _clear_trash(test_username: str) -> Optional[subprocess.Popen]:
+    """
+    Start removing the contents of the trash directory in a background process and return that process. Return
+    None if a cleanup that was started earlier is still running.
+
+    The entries that were moved to the trash from test_username's working directories are first cleared by
+    running the cleanup helper as test_username (who owns most of what is left in them) and then everything
+    in the trash is removed by this user. Entries that still cannot be removed are retried by the next cleanup.
+    """
+    os.makedirs(TRASH_DIR, exist_ok=True)
+    lock = open(f"{TRASH_DIR}.lock", "w")
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock.close()
+        return None
+    cmds = []
+    user_entries = glob.glob(os.path.join(TRASH_DIR, f"{test_username}-*"))
+    if user_entries and test_username != getpass.getuser():
+        cmds.append(f"sudo -u {test_username} -- python3 -I {_cleanup_helper()} --keep-tmp {' '.join(user_entries)}")
+    cmds.append(f"{sys.executable} -I {cleanup.__file__} --keep-tmp {TRASH_DIR}")
+    # the lock is held until the background process (which inherits it) exits
+    with lock:
+        return subprocess.Popen(
+            "; ".join(cmds),
+            shell=True,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            start_new_session=True,
+            pass_fds=(lock.fileno(),),
+        )
+
+
+def _clear_working_directory(tests_path: str, test_username: str) -> None:
+    """
+    Clear the tests_path working directory, as well as clearing any files or directories
+    owned by test_username in the /tmp directory.
+
+    If test_username is shared by several worker slots, the temporary directory for the current slot is
+    cleared instead of /tmp.
+
+    Everything that the test user can remove is removed by running the cleanup helper as the test user,
+    everything else is removed by this process. Any entries that still cannot be removed are moved to the
+    trash directory which is then cleared in the background (see _clear_trash).
+    """
+    tmp_dir = _slot_tmp_dir(test_username)
+    dirs = [tests_path] if tmp_dir is None else [tests_path, tmp_dir]
+    if test_username != getpass.getuser():
+        _run_cleanup_helper(test_username, " ".join(dirs) if tmp_dir is None else "--keep-tmp " + " ".join(dirs))
+    elif tmp_dir is None:
+        clear_tmp()
+
+    os.makedirs(TRASH_DIR, exist_ok=True)
     # be careful not to remove the tests_path dir itself since we have to
     # set the group ownership with sudo (and that is only done in ../install.sh)
-    clean_cmd = f"rm -rf {tests_path}/.[!.]* {tests_path}/*"
-    subprocess.run(clean_cmd, shell=True)
-    subprocess.run(clean_tmp_cmd, shell=True)
+    for path in [path for dir_path in dirs for path in clear_directory(dir_path)]:
+        try:
+            os.rename(path, os.path.join(TRASH_DIR, f"{test_username}-{uuid.uuid4().hex}"))
+        except OSError:
+            traceback.print_exc()
+    _clear_trash(test_username)
 
 
-def _stop_tester_processes(test_username: str) -> None:
+def _stop_tester_processes(test_username: str, process_groups: Collection[int] = ()) -> None:
     """
     Run a command that kills all tester processes either by killing all
     user processes or killing with a reaper user (see https://lwn.net/Articles/754980/
     for reference).
+
+    If test_username is shared by several worker slots, only the processes in the
+    process groups in process_groups (and in _TEST_PROCESS_GROUPS) are killed since
+    the user's other processes may belong to a test run in another slot.
     """
-    if test_username != getpass.getuser():
+    groups = {*process_groups, *_TEST_PROCESS_GROUPS}
+    _TEST_PROCESS_GROUPS.clear()
+    if test_username == getpass.getuser():
+        return
+    if not _shared_user(test_username):
         _kill_user_processes(test_username)
+    elif groups:
+        pgids = " ".join(f"-{pgid}" for pgid in sorted(groups))
+        subprocess.run(f"sudo -u {test_username} -- bash -c 'kill -KILL -- {pgids}'", shell=True)
 
 
-def _setup_files(settings_id: int, user: str, files_url: str, tests_path: str, test_username: str) -> None:
+def _download_files(user: str, files_url: str, destination: str, timer: Optional[PhaseTimer] = None) -> None:
     """
-    Copy test script files and student files to the working directory tests_path,
-    then make it the current working directory.
+    Download the zip archive at files_url using the credentials for user and
+    extract it to destination.
+
+    If the archive_cache config setting is set, the archive is downloaded through
+    an ArchiveCache so that unchanged archives are not downloaded again.
+
+    If timer is not None, the time spent looking up credentials, downloading and
+    extracting the archive is added to timer.
+    """
+    timer = timer or PhaseTimer()
+    with timer.phase("credentials"):
+        creds = json.loads(redis_connection().hget("autotest:user_credentials", key=user))
+    headers = {"Authorization": f"{creds['auth_type']} {creds['credentials']}"}
+    archive_limits = config.get("archive_limits") or {}
+    limits = {"max_size": archive_limits.get("max_size"), "max_members": archive_limits.get("max_members")}
+    cache_config = config.get("archive_cache")
+    if cache_config:
+        cache = ArchiveCache(ARCHIVE_CACHE_DIR, cache_config["max_size"], redis_connection())
+        with timer.phase("download"):
+            f = cache.fetch(files_url, headers=headers)
+        with f, timer.phase("extract"):
+            extract_zip_stream(f, destination, **limits)
+    else:
+        with tempfile.SpooledTemporaryFile(max_size=ARCHIVE_SPOOL_SIZE) as f:
+            with timer.phase("download"), requests.get(files_url, headers=headers, stream=True) as r:
+                for chunk in r.iter_content(ARCHIVE_CHUNK_SIZE):
+                    f.write(chunk)
+            f.seek(0)
+            with timer.phase("extract"):
+                extract_zip_stream(f, destination, **limits)
+
+
+def _setup_files(
+    settings: Dict,
+    user: str,
+    files_url: str,
+    tests_path: str,
+    test_username: str,
+    timer: Optional[PhaseTimer] = None,
+) -> None:
+    """
+    Copy test script files for the test settings in settings and student files to
+    the working directory tests_path, then make it the current working directory.
     The following permissions are also set:
         - tests_path directory:     rwxrwx--T
         - test subdirectories:      rwxrwx--T
-        - test files:               rw-r-----
+        - test files:               rwxr-x---
+        - linked test files:        unchanged (readable and executable by all users)
         - student subdirectories:   rwxrwx---
         - student files:            rw-rw----
+
+    If the link_test_files config option is set and the tests are run by a different user than the worker,
+    test files that all users may already read and execute are hard linked from the test settings directory
+    instead of copied. Linked files share their permissions with the original so they are not chmodded or
+    chowned, and they cannot be modified or removed by the test user since they are owned by the worker and
+    tests_path has the sticky bit set.
+
+    If timer is not None, the time spent in each phase of setting up the files is added to timer.
     """
-    creds = json.loads(redis_connection().hget("autotest:user_credentials", key=user))
-    r = requests.get(files_url, headers={"Authorization": f"{creds['auth_type']} {creds['credentials']}"})
-    extract_zip_stream(r.content, tests_path)
+    timer = timer or PhaseTimer()
+    _download_files(user, files_url, tests_path, timer)
     for fd, file_or_dir in recursive_iglob(tests_path):
         if fd == "d":
             os.chmod(file_or_dir, 0o770)
         else:
             os.chmod(file_or_dir, 0o770)
         shutil.chown(file_or_dir, group=test_username)
-    settings = json.loads(redis_connection().hget("autotest:settings", settings_id))
     assert "_files" in settings, "Required key `_files` not found in settings"
     test_script_dir = settings["_files"]
-    script_files = copy_tree(test_script_dir, tests_path)
-    for fd, file_or_dir in script_files:
-        if fd == "d":
-            os.chmod(file_or_dir, 0o1770)
-        else:
-            os.chmod(file_or_dir, 0o750)
-        shutil.chown(file_or_dir, group=test_username)
+    link = bool(config.get("link_test_files")) and test_username != getpass.getuser()
+    with timer.phase("copy_files"):
+        script_files = copy_tree(test_script_dir, tests_path, link=link)
+        for fd, file_or_dir in script_files:
+            if fd == "l":
+                continue
+            if fd == "d":
+                os.chmod(file_or_dir, 0o1770)
+            else:
+                os.chmod(file_or_dir, 0o750)
+            shutil.chown(file_or_dir, group=test_username)
 
 
 def tester_user() -> Tuple[str, str]:
@@ -369,6 +1020,11 @@ def tester_user() -> Tuple[str, str]:
     Get the workspace for the tester user specified by the WORKERUSER
     environment variable, return the user_name and path to that user's workspace.
 
+    If the WORKERSLOT environment variable is set, the workspace is the directory for that
+    slot in the user's workspace so that each worker slot for the same user has its own
+    working directory. If the user is shared by several slots, a temporary directory for
+    the slot is created as well (see _slot_tmp_dir).
+
     Raises an AutotestError if a tester user is not specified or if a workspace
     has not been setup for that user.
     """
@@ -382,33 +1038,151 @@ def tester_user() -> Tuple[str, str]:
     os.chmod(workers_dir, 0o755)
     shutil.chown(user_workspace, group=user_name)
     os.chmod(user_workspace, 0o1770)
+    slot = os.environ.get("WORKERSLOT")
+    if slot is not None:
+        user_workspace = os.path.join(user_workspace, slot)
+        os.makedirs(user_workspace, exist_ok=True)
+        shutil.chown(user_workspace, group=user_name)
+        os.chmod(user_workspace, 0o1770)
+    tmp_dir = _slot_tmp_dir(user_name)
+    if tmp_dir is not None:
+        os.makedirs(tmp_dir, exist_ok=True)
+        for dir_path in (os.path.dirname(tmp_dir), tmp_dir):
+            shutil.chown(dir_path, group=user_name)
+            os.chmod(dir_path, 0o1770)
     if not os.path.isdir(user_workspace):
         raise Exception(f"No workspace directory for user: {user_name}")
 
     return user_name, user_workspace
 
 
+def _record_timings(settings_id: Union[int, str], timings: Dict[str, float]) -> None:
+    """
+    Add the time spent in each phase of a test run to the histograms for settings_id
+    and to the histograms for all test settings.
+
+    Each histogram is stored in the TIMINGS_KEY hash for settings_id (and the ALL_TIMINGS_KEY
+    hash) with the fields:
+        - <phase>:<bound>  the number of test runs where phase took at most <bound> seconds
+                           (and more than the previous bound in TIMING_BUCKETS)
+        - <phase>:+Inf     the number of test runs where phase took longer than the largest bound
+        - <phase>:sum      the total number of seconds spent in phase
+        - <phase>:count    the number of test runs
+    """
+    pipeline = redis_connection().pipeline(transaction=False)
+    for key in (TIMINGS_KEY.format(settings_id), ALL_TIMINGS_KEY):
+        for phase, seconds in timings.items():
+            bucket = next((str(bound) for bound in TIMING_BUCKETS if seconds <= bound), "+Inf")
+            pipeline.hincrby(key, f"{phase}:{bucket}", 1)
+            pipeline.hincrbyfloat(key, f"{phase}:sum", seconds)
+            pipeline.hincrby(key, f"{phase}:count", 1)
+    pipeline.execute()
+
+
+def _record_durations(
+    settings_id: Union[int, str], version: int, group_ids: List[str], results: List[ResultData], total: float
+) -> None:
+    """
+    Add the number of seconds taken by each test group in results (whose ids are group_ids) and by the
+    whole test run to the duration samples for version of the test settings for settings_id.
+
+    Samples are stored in a list for each test group at DURATIONS_KEY (with the group id as the last
+    part of the key) which holds the DURATION_SAMPLES most recent samples. The time spent outside of
+    test groups (downloading files, cleaning up, etc.) is stored under "overhead" and the total time
+    under "total". These samples are used by the API to predict job timeouts and completion times.
+    """
+    samples = {group_id: result["time"] / 1000 for group_id, result in zip(group_ids, results)}
+    samples["overhead"] = max(total - sum(samples.values()), 0)
+    samples["total"] = total
+    pipeline = redis_connection().pipeline(transaction=False)
+    for name, seconds in samples.items():
+        key = DURATIONS_KEY.format(settings_id, version, name)
+        pipeline.lpush(key, round(seconds, 3))
+        pipeline.ltrim(key, 0, DURATION_SAMPLES - 1)
+        pipeline.expire(key, DURATIONS_TTL)
+    pipeline.execute()
+
+
+def _record_job_status(status: str) -> None:
+    """
+    Count a test run that completed with status ("finished" or "failed") in the JOB_COUNTS_KEY hash
+    and in a counter for the current minute that expires after an hour.
+    """
+    minute_key = JOB_COUNTS_PER_MINUTE_KEY.format(status, int(time.time() // 60))
+    pipeline = redis_connection().pipeline(transaction=False)
+    pipeline.hincrby(JOB_COUNTS_KEY, status, 1)
+    pipeline.incr(minute_key)
+    pipeline.expire(minute_key, 3600)
+    pipeline.execute()
+
+
+def _record_killed_groups(results: List[ResultData]) -> None:
+    """
+    Count the test groups in results that were killed because they timed out ("timeout") or because
+    they ran out of memory ("oom") in the KILLED_GROUPS_KEY hash.
+    """
+    counts = {
+        "timeout": sum(1 for result in results if result["timeout"] is not None),
+        "oom": sum(1 for result in results if result["extra_info"].get("resource_usage", {}).get("oom_kills")),
+    }
+    if any(counts.values()):
+        pipeline = redis_connection().pipeline(transaction=False)
+        for reason, count in counts.items():
+            if count:
+                pipeline.hincrby(KILLED_GROUPS_KEY, reason, count)
+        pipeline.execute()
+
+
 def run_test(settings_id, test_id, files_url, categories, user, test_env_vars):
     results = []
+    timer = PhaseTimer()
+    start = time.monotonic()
     error = None
+    settings = {}
     try:
-        settings = json.loads(redis_connection().hget("autotest:settings", key=settings_id))
-        settings["_last_access"] = int(time.time())
-        redis_connection().hset("autotest:settings", key=settings_id, value=json.dumps(settings))
+        settings = load_settings(settings_id)
+        redis_connection().hset(SETTINGS_KEY.format(settings_id), "_last_access", int(time.time()))
 
         # If test settings contain errors, we do not want to run the tests.
         assert not settings.get("_error"), f"Error in test settings: {settings['_error']}"
         assert settings.get("_env_status") != "error", "Error in test settings"
 
         test_username, tests_path = tester_user()
+        runner_pool = None
         try:
-            _clear_working_directory(tests_path, test_username)
-            _setup_files(settings_id, user, files_url, tests_path, test_username)
+            with timer.phase("cleanup_before"):
+                _clear_working_directory(tests_path, test_username)
+            _setup_files(settings, user, files_url, tests_path, test_username, timer)
             cmd = run_test_command(test_username=test_username)
-            results = _run_test_specs(cmd, settings, categories, tests_path, test_username, test_id, test_env_vars)
+            if config.get("warm_runners"):
+                runner_pool = RunnerPool(
+                    lambda tester_type: cmd.format(_create_runner_command(tester_type)),
+                    tests_path,
+                    new_session=_max_parallel_groups(settings, test_username) > 1 or _shared_user(test_username),
+                )
+            database_template = _prepare_database_template(settings_id, settings, test_username, timer)
+            results = _run_test_specs(
+                cmd,
+                settings,
+                categories,
+                tests_path,
+                test_username,
+                test_id,
+                test_env_vars,
+                runner_pool,
+                timer,
+                database_template,
+            )
         finally:
-            _stop_tester_processes(test_username)
-            _clear_working_directory(tests_path, test_username)
+            runner_pids = []
+            if runner_pool is not None:
+                runner_pids = runner_pool.pids
+                runner_pool.close()
+            if runner_pool is not None or _cgroup_root() is None:
+                # otherwise every test process has already been killed through its test group's cgroup
+                _stop_tester_processes(test_username, runner_pids)
+            with timer.phase("cleanup_after"):
+                _clear_working_directory(tests_path, test_username)
     except AssertionError as e:
         traceback.print_exc()
         error = f"Failed to run tests: {e}"
@@ -416,9 +1190,19 @@ def run_test(settings_id, test_id, files_url, categories, user, test_env_vars):
         traceback.print_exc()
         error = traceback.format_exc()
     finally:
+        timer.add("total", time.monotonic() - start)
+        timings = timer.to_dict()
         key = f"autotest:test_result:{test_id}"
-        redis_connection().set(key, json.dumps({"test_groups": results, "error": error}))
+        redis_connection().set(key, json.dumps({"test_groups": results, "timings": timings, "error": error}))
         redis_connection().expire(key, 3600)  # TODO: make this configurable
+        _record_timings(settings_id, timings)
+        _record_job_status("failed" if error else "finished")
+        _record_killed_groups(results)
+        if error is None and results:
+            group_ids = [group_id for group_id, _, _ in _test_groups(settings, categories)]
+            _record_durations(settings_id, settings.get("_version", 0), group_ids, results, timings["total"])
+        # a worker is about to become available so move the next batch job to the rq batch queue
+        scheduler.dispatch(redis_connection(), scheduler.batch_queue_depth(config["workers"]))
 
 
 def ignore_missing_dir_error(
@@ -433,7 +1217,7 @@ def ignore_missing_dir_error(
     raise err_inst
 
 
-def update_test_settings(user, settings_id, test_settings, file_url):
+def update_test_settings(user, settings_id, test_settings, file_url, version=None):
     try:
         settings_dir = os.path.join(TEST_SCRIPT_DIR, str(settings_id))
 
@@ -444,9 +1228,7 @@ def update_test_settings(user, settings_id, test_settings, file_url):
         test_settings["_files"] = files_dir
         shutil.rmtree(files_dir, onerror=ignore_missing_dir_error)
         os.makedirs(files_dir, exist_ok=True)
-        creds = json.loads(redis_connection().hget("autotest:user_credentials", key=user))
-        r = requests.get(file_url, headers={"Authorization": f"{creds['auth_type']} {creds['credentials']}"})
-        extract_zip_stream(r.content, files_dir)
+        _download_files(user, file_url, files_dir)
 
         schema = json.loads(redis_connection().get("autotest:schema"))
         installed_testers = schema["definitions"]["installed_testers"]["enum"]
@@ -477,4 +1259,5 @@ def update_test_settings(user, settings_id, test_settings, file_url):
     finally:
         test_settings["_user"] = user
         test_settings["_last_access"] = int(time.time())
-        redis_connection().hset("autotest:settings", key=settings_id, value=json.dumps(test_settings))
+        _save_settings(settings_id, version, test_settings)
+        invalidate_settings(settings_id)
@@ -0,0 +1,137 @@
+from __future__ import annotations
+import os
+import json
+import hashlib
+import tempfile
+import requests
+import redis
+from typing import Dict, Optional, BinaryIO
+
+CACHE_STATS_KEY = "autotest:archive_cache"
+_CHUNK_SIZE = 1024 * 1024
+
+
+class ArchiveCache:
+    """
+    An on-disk cache of downloaded archives (student submissions and test script files).
+
+    Archives are stored once per unique content (keyed by the sha256 hash of their content) in root/blobs.
+    For each url that has been downloaded, the ETag returned by the server and the hash of the content are stored
+    in root/urls so that later downloads of the same url can use a conditional GET request and skip the download
+    if the content has not changed. Content downloaded without an ETag is not cached.
+
+    When the total size of all blobs exceeds max_size bytes, the least recently used blobs are removed.
+
+    The number of cache hits (downloads skipped) and misses (archives downloaded) are counted in redis under
+    the CACHE_STATS_KEY hash.
+    """
+
+    def __init__(self, root: str, max_size: int, connection: Optional[redis.Redis] = None) -> None:
+        self.root = root
+        self.max_size = max_size
+        self.connection = connection
+        self._blob_dir = os.path.join(root, "blobs")
+        self._url_dir = os.path.join(root, "urls")
+        self._tmp_dir = os.path.join(root, "tmp")
+        for dir_ in (self._blob_dir, self._url_dir, self._tmp_dir):
+            os.makedirs(dir_, exist_ok=True)
+
+    def _blob_path(self, digest: str) -> str:
+        return os.path.join(self._blob_dir, digest)
+
+    def _url_path(self, url: str) -> str:
+        return os.path.join(self._url_dir, hashlib.sha256(url.encode()).hexdigest() + ".json")
+
+    def _load_url_data(self, url: str) -> Optional[Dict]:
+        try:
+            with open(self._url_path(url)) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def _save_url_data(self, url: str, data: Dict) -> None:
+        with tempfile.NamedTemporaryFile("w", dir=self._tmp_dir, delete=False) as f:
+            json.dump(data, f)
+        os.replace(f.name, self._url_path(url))
+
+    def _count(self, stat: str) -> None:
+        if self.connection is not None:
+            self.connection.hincrby(CACHE_STATS_KEY, stat, 1)
+
+    def stats(self) -> Dict[str, int]:
+        """Return the number of cache hits and misses"""
+        stats = {"hits": 0, "misses": 0}
+        if self.connection is not None:
+            for key, val in (self.connection.hgetall(CACHE_STATS_KEY) or {}).items():
+                stats[key.decode() if isinstance(key, bytes) else key] = int(val)
+        return stats
+
+    def fetch(self, url: str, headers: Optional[Dict[str, str]] = None) -> BinaryIO:
+        """
+        Return an open (binary) file containing the content at url.
+
+        If the content at url has been downloaded before and the server reports (using the ETag) that
+        it has not changed since then, the cached content is returned without downloading it again.
+        """
+        headers = dict(headers or {})
+        url_data = self._load_url_data(url)
+        cached = None
+        if url_data and url_data.get("etag") and os.path.isfile(self._blob_path(url_data["digest"])):
+            cached = self._blob_path(url_data["digest"])
+            headers["If-None-Match"] = url_data["etag"]
+        with requests.get(url, headers=headers, stream=True) as r:
+            if r.status_code == 304 and cached is not None:
+                try:
+                    f = open(cached, "rb")
+                except FileNotFoundError:
+                    # the blob was evicted by another process since it was checked above
+                    self._save_url_data(url, {})
+                    return self.fetch(url, headers={k: v for k, v in headers.items() if k != "If-None-Match"})
+                os.utime(cached)
+                self._count("hits")
+                return f
+            r.raise_for_status()
+            digest = hashlib.sha256()
+            tmp = tempfile.NamedTemporaryFile(dir=self._tmp_dir, delete=False)
+            try:
+                with tmp:
+                    for chunk in r.iter_content(_CHUNK_SIZE):
+                        digest.update(chunk)
+                        tmp.write(chunk)
+            except BaseException:
+                os.unlink(tmp.name)
+                raise
+            etag = r.headers.get("ETag")
+        self._count("misses")
+        if not etag:
+            # without an ETag the content can never be looked up again so it is not kept in the cache
+            if url_data is not None:
+                self._save_url_data(url, {})
+            f = open(tmp.name, "rb")
+            os.unlink(tmp.name)
+            return f
+        blob = self._blob_path(digest.hexdigest())
+        os.replace(tmp.name, blob)
+        f = open(blob, "rb")
+        self._save_url_data(url, {"etag": etag, "digest": digest.hexdigest()})
+        self.evict()
+        return f
+
+    def evict(self) -> None:
+        """Remove the least recently used blobs until the total size of all blobs is at most self.max_size"""
+        blobs = []
+        for entry in os.scandir(self._blob_dir):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            blobs.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in blobs)
+        for _, size, path in sorted(blobs):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
@@ -0,0 +1,138 @@
+"""
+Start and stop rq worker slots as the number of jobs in each queue changes.
+
+This module is run as a supervisor program by start_stop.py when the autoscale config option is set. Every
+interval seconds it starts enough worker slots to run all jobs waiting in (or being run from) each queue, within
+the minimum and maximum number of slots configured for that queue, and stops idle worker slots that are no longer
+needed.
+"""
+
+import time
+import traceback
+import xmlrpc.client
+from typing import Dict, List, Optional, Set, Tuple
+
+import redis
+import rq
+
+from .config import config
+from . import scheduler
+
+QUEUE_NAMES = ("high", "low", "batch", "settings")
+RUNNING_STATES = ("STARTING", "RUNNING", "BACKOFF")
+DEFAULT_INTERVAL = 10
+DEFAULT_SCALE_DOWN_DELAY = 300
+
+
+def worker_slots(workers: List[Dict]) -> List[Tuple[str, Set[str]]]:
+    """
+    Return the supervisor process name ("<group>:<name>") and the queues of each worker slot
+    started by start_stop.py for the workers config.
+    """
+    return [
+        (f'rq_worker_{w["user"]}:rq_worker_{w["user"]}_{i}', {"settings", *w["queues"]})
+        for w in workers
+        for i in range(w.get("concurrency", 1))
+    ]
+
+
+class Autoscaler:
+    """
+    Keeps the number of running worker slots for each queue between the configured minimum and maximum, scaling
+    up as soon as jobs are waiting and scaling down once a queue has needed fewer slots for scale_down_delay seconds.
+
+    Worker slots are started and stopped through supervisor (the supervisor namespace of an XML-RPC ServerProxy).
+    Slots that are running a job are never stopped.
+    """
+
+    def __init__(self, supervisor, connection: redis.Redis, workers: List[Dict], settings: Dict) -> None:
+        self._supervisor = supervisor
+        self._connection = connection
+        self._slots = worker_slots(workers)
+        limits = settings.get("queues") or {}
+        self._min = {q: limits.get(q, {}).get("min", 0) for q in QUEUE_NAMES}
+        self._max = {q: limits.get(q, {}).get("max", len(self._slots)) for q in QUEUE_NAMES}
+        self._max_wait = settings.get("max_wait")
+        self._scale_down_delay = settings.get("scale_down_delay", DEFAULT_SCALE_DOWN_DELAY)
+        self._targets = {q: self._min[q] for q in QUEUE_NAMES}
+        self._last_needed = {q: 0.0 for q in QUEUE_NAMES}
+
+    def _oldest_job_age(self, queue: rq.Queue, now: float) -> float:
+        oldest = queue.get_job_ids(0, 1)
+        job = queue.fetch_job(oldest[0]) if oldest else None
+        if job is not None and job.enqueued_at is not None:
+            return max(now - job.enqueued_at.timestamp(), 0.0)
+        return 0.0
+
+    def targets(self, now: float) -> Dict[str, int]:
+        """
+        Return the number of worker slots that should be running for each queue.
+
+        Each queue needs a slot for every job waiting in it or being run from it (including batch jobs that are
+        waiting to be dispatched by the scheduler). If the oldest job has been
+        waiting for longer than max_wait seconds, the queue needs its maximum number of slots. The target for
+        a queue is only lowered once it has needed fewer slots than its target for scale_down_delay seconds.
+        """
+        for name in QUEUE_NAMES:
+            queue = rq.Queue(name, connection=self._connection)
+            waiting = queue.count
+            if name == "batch":
+                waiting += sum(n for _, n, _ in scheduler.backlog(self._connection))
+            needed = waiting + queue.started_job_registry.count
+            if waiting and self._max_wait is not None and self._oldest_job_age(queue, now) > self._max_wait:
+                needed = self._max[name]
+            needed = min(max(needed, self._min[name]), self._max[name])
+            if needed >= self._targets[name]:
+                self._targets[name] = needed
+                self._last_needed[name] = now
+            elif now - self._last_needed[name] >= self._scale_down_delay:
+                self._targets[name] = needed
+        return dict(self._targets)
+
+    def _busy_pids(self) -> Set[int]:
+        return {w.pid for w in rq.Worker.all(connection=self._connection) if w.get_state() == "busy"}
+
+    def step(self, now: Optional[float] = None) -> None:
+        """
+        Dispatch any batch jobs that there are workers for and start or stop worker slots so that the number of
+        running slots for each queue matches its target.
+
+        Slots that are already running are preferred over starting new ones and slots that are running a job
+        are always kept running.
+        """
+        now = time.time() if now is None else now
+        # jobs are usually dispatched when a test run finishes or a batch is scheduled, this makes sure that the
+        # batch queue is refilled even if neither has happened for a while
+        scheduler.dispatch(self._connection)
+        targets = self.targets(now)
+        processes = {f'{p["group"]}:{p["name"]}': p for p in self._supervisor.getAllProcessInfo()}
+        running = {name for name, p in processes.items() if p["statename"] in RUNNING_STATES}
+        busy_pids = self._busy_pids()
+        selected = {name for name in running if processes[name]["pid"] in busy_pids}
+        counts = {q: sum(q in queues for name, queues in self._slots if name in selected) for q in QUEUE_NAMES}
+        for name, queues in sorted(self._slots, key=lambda slot: slot[0] not in running):
+            if name not in selected and any(counts[q] < targets[q] for q in queues):
+                selected.add(name)
+                for q in queues:
+                    counts[q] += 1
+        for name, _ in self._slots:
+            if name in selected and name not in running:
+                self._supervisor.startProcess(name, False)
+            elif name not in selected and name in running:
+                self._supervisor.stopProcess(name, False)
+
+
+def main() -> None:
+    settings = config["autoscale"]
+    supervisor = xmlrpc.client.ServerProxy(f'http://{config["supervisor_url"]}/RPC2').supervisor
+    autoscaler = Autoscaler(supervisor, redis.Redis.from_url(config["redis_url"]), config["workers"], settings)
+    while True:
+        try:
+            autoscaler.step()
+        except Exception:
+            traceback.print_exc()
+        time.sleep(settings.get("interval", DEFAULT_INTERVAL))
+
+
+if __name__ == "__main__":
+    main()
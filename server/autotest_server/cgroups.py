@@ -0,0 +1,169 @@
+"""
+Run test groups in their own cgroup (version 2).
+
+The cgroups are created in a directory of the cgroup v2 hierarchy that has been delegated to the worker user (the
+cgroups: root config setting). Every process started by a test group (including processes that start a new session or
+process group) stays in the test group's cgroup so that all of them can be killed at once by writing to cgroup.kill
+and their resource usage can be read from the cgroup's accounting files.
+
+Limits on the memory, cpu and number of processes of a test group are applied to the cgroup as a whole (unlike rlimits
+which are applied to each process separately) so they also limit the total resources used by the processes that a test
+group starts.
+"""
+
+import os
+import time
+import uuid
+import functools
+import subprocess
+from typing import Dict, Optional
+
+CONTROLLERS = ("cpu", "memory", "pids")
+CPU_PERIOD = 100000
+
+
+@functools.lru_cache(maxsize=None)
+def _enable_controllers(root: str) -> None:
+    """
+    Enable the CONTROLLERS that are available in root for the cgroups created in root.
+    """
+    try:
+        with open(os.path.join(root, "cgroup.controllers")) as f:
+            available = f.read().split()
+        with open(os.path.join(root, "cgroup.subtree_control"), "w") as f:
+            f.write(" ".join(f"+{c}" for c in CONTROLLERS if c in available))
+    except OSError:
+        pass
+
+
+def limit_values(
+    memory_max: Optional[int] = None, cpu_max: Optional[float] = None, pids_max: Optional[int] = None
+) -> Dict[str, str]:
+    """
+    Return the contents of the cgroup interface files that set the limits: memory_max (in bytes), cpu_max
+    (in cpus) and pids_max (the number of processes and threads). Limits that are None are not set.
+    """
+    values = {}
+    if memory_max is not None:
+        values["memory.max"] = str(memory_max)
+        values["memory.swap.max"] = "0"
+    if cpu_max is not None:
+        values["cpu.max"] = f"{max(int(cpu_max * CPU_PERIOD), 1000)} {CPU_PERIOD}"
+    if pids_max is not None:
+        values["pids.max"] = str(pids_max)
+    return values
+
+
+class TestCgroup:
+    """
+    A transient cgroup for a single test group.
+    """
+
+    def __init__(
+        self,
+        root: str,
+        name: str,
+        memory_max: Optional[int] = None,
+        cpu_max: Optional[float] = None,
+        pids_max: Optional[int] = None,
+        user: Optional[str] = None,
+    ) -> None:
+        """
+        Create a cgroup in root whose name starts with name and apply the limits to it.
+
+        If user is not None, it is the user that runs the processes in this cgroup (see kill).
+        """
+        _enable_controllers(root)
+        self.user = user
+        self.path = os.path.join(root, f"{name}-{uuid.uuid4().hex}")
+        os.mkdir(self.path)
+        for filename, value in limit_values(memory_max, cpu_max, pids_max).items():
+            try:
+                with open(os.path.join(self.path, filename), "w") as f:
+                    f.write(value)
+            except OSError:
+                if filename != "memory.swap.max":  # swap accounting may be disabled
+                    self.remove()
+                    raise
+
+    def _read(self, filename: str) -> Optional[str]:
+        try:
+            with open(os.path.join(self.path, filename)) as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def wrap_command(self, command: str) -> str:
+        """
+        Return a bash command that moves itself to this cgroup before running command so that
+        command and every process it starts are in this cgroup.
+        """
+        return f"echo $$ > {os.path.join(self.path, 'cgroup.procs')} && {command}"
+
+    def populated(self) -> bool:
+        """
+        Return True if there are any processes in this cgroup.
+        """
+        events = self._read("cgroup.events") or ""
+        return "populated 1" in events.splitlines()
+
+    def kill(self) -> None:
+        """
+        Kill all processes in this cgroup.
+
+        Falls back to killing each process listed in cgroup.procs if cgroup.kill is not
+        supported (before Linux 5.14). Processes that the current user is not allowed to
+        signal are killed by running kill as self.user.
+        """
+        kill_file = os.path.join(self.path, "cgroup.kill")
+        if os.path.exists(kill_file):
+            with open(kill_file, "w") as f:
+                f.write("1")
+            return
+        denied = []
+        for pid in (self._read("cgroup.procs") or "").split():
+            try:
+                os.kill(int(pid), 9)
+            except ProcessLookupError:
+                pass
+            except PermissionError:
+                denied.append(pid)
+        if denied and self.user is not None:
+            subprocess.run(
+                ["sudo", "-u", self.user, "--", "kill", "-KILL", *denied],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Return the peak memory usage (in bytes), the number of processes killed because the cgroup ran
+        out of memory and the user and system cpu time (in seconds) used by the processes in this cgroup.
+        Values that are not available are omitted.
+        """
+        stats = {}
+        memory_peak = self._read("memory.peak")
+        if memory_peak is not None:
+            stats["memory_peak_bytes"] = int(memory_peak)
+        for line in (self._read("memory.events") or "").splitlines():
+            key, _, value = line.partition(" ")
+            if key == "oom_kill":
+                stats["oom_kills"] = int(value)
+        for line in (self._read("cpu.stat") or "").splitlines():
+            key, _, value = line.partition(" ")
+            if key in ("user_usec", "system_usec"):
+                stats[f"cpu_{key[:-5]}_seconds"] = round(int(value) / 1_000_000, 3)
+        return stats
+
+    def remove(self, timeout: float = 5) -> None:
+        """
+        Kill all processes in this cgroup, wait up to timeout seconds for them to exit and remove the cgroup.
+        """
+        self.kill()
+        deadline = time.monotonic() + timeout
+        while self.populated() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        try:
+            os.rmdir(self.path)
+        except OSError:
+            pass
@@ -0,0 +1,72 @@
+"""
+Remove the contents of test working directories.
+
+This module is run as a script by the test user to remove everything that the test user owns in the directories
+given as arguments and in /tmp (/tmp is not cleared if the --keep-tmp flag is given). It is also imported by the worker
+to remove whatever is left over. Since the test user may not be able to import the autotest_server package, this module
+must only depend on the standard library.
+"""
+
+import os
+import sys
+from typing import List
+
+
+def _remove_entry(entry: os.DirEntry, uid: int) -> bool:
+    """
+    Remove entry (recursively if it is a directory) and return True if it was removed.
+
+    Directories owned by uid are made readable, writable and searchable by all users (and lose their sticky bit)
+    before they are walked so that anything left in them can be removed by another user.
+    """
+    try:
+        if not entry.is_dir(follow_symlinks=False):
+            os.unlink(entry.path)
+            return True
+        if entry.stat(follow_symlinks=False).st_uid == uid:
+            os.chmod(entry.path, 0o777)
+        with os.scandir(entry.path) as it:
+            removed = [_remove_entry(child, uid) for child in it]
+        if all(removed):
+            os.rmdir(entry.path)
+            return True
+    except OSError:
+        pass
+    return False
+
+
+def clear_directory(path: str) -> List[str]:
+    """
+    Remove the contents of the directory at path (but not the directory itself) in a single walk and return
+    the paths of the entries directly in path that could not be removed completely.
+    """
+    uid = os.getuid()
+    try:
+        with os.scandir(path) as it:
+            return [entry.path for entry in it if not _remove_entry(entry, uid)]
+    except (FileNotFoundError, NotADirectoryError):
+        return []
+
+
+def clear_tmp(tmp_dir: str = "/tmp") -> None:
+    """
+    Remove all files and directories in tmp_dir that are owned by the current user.
+    """
+    uid = os.getuid()
+    with os.scandir(tmp_dir) as it:
+        for entry in it:
+            try:
+                owner = entry.stat(follow_symlinks=False).st_uid
+            except OSError:
+                continue
+            if owner == uid:
+                _remove_entry(entry, uid)
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    for dir_path in args:
+        if dir_path != "--keep-tmp":
+            clear_directory(dir_path)
+    if "--keep-tmp" not in args:
+        clear_tmp()
@@ -0,0 +1,140 @@
+"""
+Template databases for test settings that seed a postgres database.
+
+When test settings set the database_seed_files option, the seed files are run once (for each version of the test
+settings and each worker user) to build a template database. Before each test group, the test group's database is
+then created as a copy of the template with CREATE DATABASE ... TEMPLATE, which is much faster than running the seed
+files again.
+
+The template and test group databases are created with the credentials in the worker's postgresql_url, so the
+postgres role in that url must have the CREATEDB privilege. All databases created for a worker user have names
+starting with the same prefix so that templates for old versions of the test settings can be found and removed.
+
+The seed files are run with psycopg2 rather than with psql because they are run by the worker user: psql
+meta-commands (such as \\! or \\o |command) would let the seed files run shell commands as the worker user.
+"""
+
+import os
+import hashlib
+import urllib.parse
+from contextlib import contextmanager
+from typing import Iterator, List, Union
+
+import psycopg2
+from psycopg2 import sql
+
+DATABASE_PREFIX = "autotest_{}"
+
+
+def _prefix(test_username: str) -> str:
+    return DATABASE_PREFIX.format(hashlib.md5(test_username.encode()).hexdigest()[:8])
+
+
+def template_name(test_username: str, settings_id: Union[int, str], version: Union[int, str]) -> str:
+    """
+    Return the name of the template database for version of the test settings with id settings_id for test_username.
+    """
+    return f"{_prefix(test_username)}_t_{settings_id}_{version}"
+
+
+def test_database_name(test_username: str) -> str:
+    """
+    Return the name of the database that test groups run by test_username use when the test settings have a template.
+    """
+    return f"{_prefix(test_username)}_test"
+
+
+def database_url(postgresql_url: str, database: str) -> str:
+    """
+    Return postgresql_url with the database name replaced by database.
+    """
+    return urllib.parse.urlsplit(postgresql_url)._replace(path=f"/{database}").geturl()
+
+
+@contextmanager
+def _cursor(postgresql_url: str) -> Iterator[psycopg2.extensions.cursor]:
+    conn = psycopg2.connect(postgresql_url)
+    conn.autocommit = True  # CREATE DATABASE and DROP DATABASE cannot be run in a transaction
+    try:
+        with conn.cursor() as cursor:
+            yield cursor
+    finally:
+        conn.close()
+
+
+def _drop_database(cursor: psycopg2.extensions.cursor, database: str) -> None:
+    cursor.execute(sql.SQL("DROP DATABASE IF EXISTS {};").format(sql.Identifier(database)))
+
+
+def _run_seed_files(postgresql_url: str, seed_files: List[str], files_dir: str) -> None:
+    """
+    Run the SQL in each file in seed_files (relative to files_dir) in a single transaction in the database
+    at postgresql_url.
+    """
+    files_dir = os.path.realpath(files_dir)
+    conn = psycopg2.connect(postgresql_url)
+    try:
+        with conn, conn.cursor() as cursor:
+            for seed_file in seed_files:
+                path = os.path.realpath(os.path.join(files_dir, seed_file))
+                if os.path.commonpath([files_dir, path]) != files_dir:
+                    raise Exception(f"Database seed file {seed_file} is not in the test files")
+                with open(path) as f:
+                    contents = f.read()
+                try:
+                    cursor.execute(contents)
+                except psycopg2.Error as e:
+                    raise Exception(f"Failed to run database seed file {seed_file}:\n{e}") from e
+    finally:
+        conn.close()
+
+
+def prepare_template(
+    postgresql_url: str,
+    test_username: str,
+    settings_id: Union[int, str],
+    version: Union[int, str],
+    seed_files: List[str],
+    files_dir: str,
+) -> str:
+    """
+    Return the name of the template database for this version of the test settings, creating it by running the
+    SQL in each file in seed_files (relative to files_dir) if it does not exist yet. Templates for other versions of
+    these test settings (and templates that were never completed) are removed.
+    """
+    template = template_name(test_username, settings_id, version)
+    prefix = template_name(test_username, settings_id, "")
+    build = f"{template}_build"
+    with _cursor(postgresql_url) as cursor:
+        cursor.execute("SELECT datname FROM pg_database WHERE datname LIKE %s;", (prefix.replace("_", r"\_") + "%",))
+        existing = {row[0] for row in cursor.fetchall()}
+        for database in existing - {template}:
+            _drop_database(cursor, database)
+        if template in existing:
+            return template
+        cursor.execute(sql.SQL("CREATE DATABASE {};").format(sql.Identifier(build)))
+    try:
+        _run_seed_files(database_url(postgresql_url, build), seed_files, files_dir)
+    except Exception:
+        with _cursor(postgresql_url) as cursor:
+            _drop_database(cursor, build)
+        raise
+    # the template is only renamed once it is complete so that a partially built template is never used
+    with _cursor(postgresql_url) as cursor:
+        cursor.execute(
+            sql.SQL("ALTER DATABASE {} RENAME TO {};").format(sql.Identifier(build), sql.Identifier(template))
+        )
+    return template
+
+
+def create_test_database(postgresql_url: str, test_username: str, template: str) -> str:
+    """
+    Replace the test database for test_username with a new copy of the template database and return its url.
+    """
+    database = test_database_name(test_username)
+    with _cursor(postgresql_url) as cursor:
+        _drop_database(cursor, database)
+        cursor.execute(
+            sql.SQL("CREATE DATABASE {} TEMPLATE {};").format(sql.Identifier(database), sql.Identifier(template))
+        )
+    return database_url(postgresql_url, database)
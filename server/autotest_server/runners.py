@@ -0,0 +1,177 @@
+from __future__ import annotations
+import json
+import select
+import tempfile
+import threading
+import subprocess
+from typing import Dict, List, Tuple, Optional, Callable
+
+
+class WarmRunnerError(Exception):
+    """Error raised when a warm tester runner exits unexpectedly"""
+
+
+class WarmRunner:
+    """
+    A long running tester process that has already imported a tester module.
+
+    Test groups are sent to the runner over its stdin and the results are read back from its stdout
+    (see testers/runner.py for the protocol).
+    """
+
+    def __init__(self, command: str, env: Dict[str, str], cwd: str, new_session: bool = False) -> None:
+        self.env = env
+        self._stderr = tempfile.TemporaryFile()
+        self.proc = subprocess.Popen(
+            command,
+            cwd=cwd,
+            shell=True,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=self._stderr,
+            env=env,
+            executable="/bin/bash",
+            start_new_session=new_session,
+        )
+
+    @property
+    def alive(self) -> bool:
+        """Return True if the runner process has not exited"""
+        return self.proc.poll() is None
+
+    def _error(self) -> WarmRunnerError:
+        self._stderr.seek(0)
+        stderr = self._stderr.read().decode(errors="replace")
+        return WarmRunnerError(f"tester runner exited unexpectedly:\n{stderr}")
+
+    def run(self, specs: Dict, env: Dict[str, str], cwd: str, timeout: Optional[int]) -> Tuple[str, str, int]:
+        """
+        Run a single test group using specs and return the stdout, stderr and returncode of the process that ran it.
+
+        env is the full environment for the test group. Only the variables that differ from the environment
+        that the runner was started with are sent to the runner, along with the names of the variables that
+        the runner was started with but that are not in env (so that they are unset for this test group).
+
+        Raises subprocess.TimeoutExpired if no result is returned within timeout seconds.
+        """
+        request = {
+            "specs": specs,
+            "env": {k: v for k, v in env.items() if self.env.get(k) != v},
+            "unset": [k for k in self.env if k not in env],
+            "cwd": cwd,
+        }
+        request = json.dumps(request) + "\n"
+        try:
+            self.proc.stdin.write(request.encode())
+            self.proc.stdin.flush()
+        except BrokenPipeError as e:
+            raise self._error() from e
+        ready, _, _ = select.select([self.proc.stdout], [], [], timeout)
+        if not ready:
+            raise subprocess.TimeoutExpired(self.proc.args, timeout)
+        line = self.proc.stdout.readline()
+        if not line:
+            raise self._error()
+        reply = json.loads(line)
+        return reply["stdout"], reply["stderr"], reply["returncode"]
+
+    def close(self) -> None:
+        """Stop the runner process by closing its stdin"""
+        try:
+            self.proc.stdin.close()
+            self.proc.wait(timeout=5)
+        except (OSError, subprocess.TimeoutExpired):
+            pass
+        finally:
+            self._stderr.close()
+
+
+class RunnerPool:
+    """
+    A pool of warm tester runners, one or more for each tester virtual environment.
+
+    Runners are started lazily the first time a test group is run for a given tester type and python
+    executable and are reused by later test groups until the pool is closed. If new_session is True, each
+    runner is started in a new process group so that it can be killed without affecting other runners.
+    """
+
+    def __init__(self, command_factory: Callable[[str], str], cwd: str, new_session: bool = False) -> None:
+        self._command_factory = command_factory
+        self._cwd = cwd
+        self._new_session = new_session
+        self._idle: Dict[Tuple[str, str], List[WarmRunner]] = {}
+        self._runners: List[WarmRunner] = []
+        self._pids: List[int] = []
+        self._busy: Dict[WarmRunner, Callable[[subprocess.Popen], None]] = {}
+        self._lock = threading.Lock()
+
+    def _acquire(self, tester_type: str, env: Dict[str, str]) -> Tuple[Tuple[str, str], WarmRunner]:
+        key = (tester_type, env.get("PYTHON", ""))
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            while idle:
+                runner = idle.pop()
+                if runner.alive:
+                    return key, runner
+        runner = WarmRunner(self._command_factory(tester_type), env, self._cwd, self._new_session)
+        with self._lock:
+            self._runners.append(runner)
+            self._pids.append(runner.proc.pid)
+        return key, runner
+
+    @property
+    def pids(self) -> List[int]:
+        """The process ids of all runners started by this pool, including runners that have been stopped"""
+        with self._lock:
+            return list(self._pids)
+
+    def run(
+        self,
+        tester_type: str,
+        env: Dict[str, str],
+        specs: Dict,
+        timeout: Optional[int],
+        on_timeout: Callable[[subprocess.Popen], None],
+    ) -> Tuple[str, str, int]:
+        """
+        Run a single test group with a runner for tester_type and return the stdout, stderr and returncode.
+
+        env is the full environment for the test group (see WarmRunner.run). If the test group times out, or
+        waiting for it raises any other exception (such as the job timeout) while the runner is still running,
+        on_timeout is called with the runner process before the exception is re-raised; the runner is not reused
+        afterwards.
+        """
+        key, runner = self._acquire(tester_type, env)
+        with self._lock:
+            self._busy[runner] = on_timeout
+        try:
+            result = runner.run(specs, env, self._cwd, timeout)
+        except Exception:
+            with self._lock:
+                busy = self._busy.pop(runner, None) is not None
+            # the runner may still be running the test group unless it has already been stopped by interrupt
+            if busy and runner.alive:
+                on_timeout(runner.proc)
+            runner.close()
+            raise
+        finally:
+            with self._lock:
+                self._busy.pop(runner, None)
+        with self._lock:
+            self._idle.setdefault(key, []).append(runner)
+        return result
+
+    def interrupt(self) -> None:
+        """Call on_timeout (see run) with the process of every runner that is running a test group"""
+        with self._lock:
+            busy, self._busy = list(self._busy.items()), {}
+        for runner, on_timeout in busy:
+            if runner.alive:
+                on_timeout(runner.proc)
+
+    def close(self) -> None:
+        """Stop all runners in this pool"""
+        with self._lock:
+            runners, self._runners, self._idle = self._runners, [], {}
+        for runner in runners:
+            runner.close()
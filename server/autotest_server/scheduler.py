@@ -0,0 +1,166 @@
+"""
+Fair share scheduling of batch test runs.
+
+Batch test runs are not enqueued in the rq batch queue directly by the API. Instead, the jobs for each test settings
+id are kept in a separate scheduler queue and are moved to the rq batch queue a few at a time (so that the rq batch
+queue never holds more jobs than there are workers to run them) by the dispatch script below. The script is run by the
+API whenever a batch is scheduled, by the workers whenever a test run finishes (even if its work horse was killed) and
+by the autoscaler (if it is running) every interval. The script is stored in redis when the workers are started and
+the API runs the stored script, so that this module is the only copy of it.
+
+Each time a job is dispatched, the next one is taken from:
+
+    - the test settings with the earliest deadline, if that deadline is less than deadline_window seconds away
+    - otherwise, the test settings that have received the least service so far relative to their weight
+      (weighted fair queuing: each dispatched job advances the virtual time of its settings by 1 / weight)
+
+Individual test runs are still enqueued in the rq high and low queues directly, so they are always run before any
+batch test run that has not started yet.
+"""
+
+import redis
+from typing import Dict, List, Optional, Tuple
+
+TENANTS_KEY = "autotest:scheduler:tenants"
+DEADLINES_KEY = "autotest:scheduler:deadlines"
+VIRTUAL_TIME_KEY = "autotest:scheduler:vtime"
+WEIGHTS_KEY = "autotest:scheduler:weights"
+CONFIG_KEY = "autotest:scheduler:config"
+SCRIPT_KEY = "autotest:scheduler:script"
+JOBS_KEY = "autotest:scheduler:jobs:{}"
+BATCH_QUEUE_KEY = "rq:queue:batch"
+RQ_QUEUES_KEY = "rq:queues"
+RQ_JOB_KEY = "rq:job:{}"
+DEFAULT_DEADLINE_WINDOW = 3600
+
+# Move jobs from the scheduler queues to the rq batch queue until it holds <depth> jobs.
+#
+# KEYS: tenants, deadlines, virtual time, weights, scheduler config, rq batch queue, rq queues set, followed by
+#       any scheduler jobs lists and rq job hashes requested by a previous call (see below)
+# ARGV: batch queue depth, deadline window, scheduler jobs key prefix, rq job key prefix
+#       (if the depth and window are empty they are read from the scheduler config, otherwise they are stored in it)
+# Returns: the number of jobs moved to the rq batch queue, followed by the keys that the script needs in order to move
+#          the next job (the scheduler jobs list of the next settings id and the rq job hash of its first job). The
+#          caller runs the script again with those keys until it does not ask for any more keys (see _run_dispatch).
+DISPATCH_SCRIPT = """
+local declared = {}
+for i = 8, #KEYS do
+    declared[KEYS[i]] = true
+end
+local depth = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+if depth and window then
+    redis.call('HSET', KEYS[5], 'depth', depth, 'deadline_window', window)
+else
+    local config = redis.call('HMGET', KEYS[5], 'depth', 'deadline_window')
+    depth = tonumber(config[1]) or 1
+    window = tonumber(config[2]) or 3600
+end
+local now = tonumber(redis.call('TIME')[1])
+local moved = 0
+local needed = {}
+while redis.call('LLEN', KEYS[6]) < depth do
+    local tenant = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', now + window, 'LIMIT', 0, 1)[1]
+    if not tenant then
+        tenant = redis.call('ZRANGE', KEYS[1], 0, 0)[1]
+    end
+    if not tenant then
+        break
+    end
+    local jobs = ARGV[3] .. tenant
+    if not declared[jobs] then
+        needed = {jobs}
+        break
+    end
+    local job_id = redis.call('LINDEX', jobs, 0)
+    local job = job_id and ARGV[4] .. job_id
+    if job and not declared[job] then
+        needed = {jobs, job}
+        break
+    end
+    local vtime = tonumber(redis.call('ZSCORE', KEYS[1], tenant)) or 0
+    redis.call('LPOP', jobs)
+    if job and redis.call('HGET', job, 'status') == 'queued' then
+        redis.call('RPUSH', KEYS[6], job_id)
+        moved = moved + 1
+        local weight = tonumber(redis.call('HGET', KEYS[4], tenant)) or 1
+        if weight <= 0 then
+            weight = 1
+        end
+        vtime = vtime + 1 / weight
+    end
+    if redis.call('LLEN', jobs) == 0 then
+        redis.call('ZREM', KEYS[1], tenant)
+        redis.call('ZREM', KEYS[2], tenant)
+    else
+        redis.call('ZADD', KEYS[1], vtime, tenant)
+    end
+end
+local oldest = redis.call('ZRANGE', KEYS[1], 0, 0, 'WITHSCORES')
+if oldest[2] then
+    redis.call('SET', KEYS[3], oldest[2])
+end
+if moved > 0 then
+    redis.call('SADD', KEYS[7], KEYS[6])
+end
+local result = {moved}
+for _, key in ipairs(needed) do
+    table.insert(result, key)
+end
+return result
+"""
+
+
+def _run_dispatch(script: redis.commands.core.Script, keys: List[str], args: List) -> int:
+    """
+    Run the dispatch script with keys and args (and the keys it asks for) until it has moved every job that it
+    can and return the number of jobs moved.
+    """
+    moved, needed = 0, []
+    while True:
+        result = script(keys=[*keys, *needed], args=args)
+        moved += int(result[0])
+        needed = [key.decode() if isinstance(key, bytes) else key for key in result[1:]]
+        if not needed:
+            return moved
+
+
+def batch_queue_depth(workers: List[Dict]) -> int:
+    """
+    Return the number of worker slots that monitor the batch queue in the workers config.
+    """
+    return max(sum(w.get("concurrency", 1) for w in workers if "batch" in w["queues"]), 1)
+
+
+def store_script(connection: redis.Redis) -> None:
+    """
+    Store the dispatch script under SCRIPT_KEY so that the API runs the same script as the workers.
+    """
+    connection.set(SCRIPT_KEY, DISPATCH_SCRIPT)
+
+
+def dispatch(
+    connection: redis.Redis, depth: Optional[int] = None, deadline_window: Optional[int] = DEFAULT_DEADLINE_WINDOW
+) -> int:
+    """
+    Move jobs from the scheduler queues to the rq batch queue until it holds depth jobs and return the number of
+    jobs moved. If depth is None, the depth last used by the workers is used instead.
+    """
+    keys = [TENANTS_KEY, DEADLINES_KEY, VIRTUAL_TIME_KEY, WEIGHTS_KEY, CONFIG_KEY, BATCH_QUEUE_KEY, RQ_QUEUES_KEY]
+    args = ["" if depth is None else depth, "" if depth is None else deadline_window]
+    script = connection.register_script(DISPATCH_SCRIPT)
+    return _run_dispatch(script, keys, [*args, JOBS_KEY.format(""), RQ_JOB_KEY.format("")])
+
+
+def backlog(connection: redis.Redis) -> List[Tuple[str, int, Optional[float]]]:
+    """
+    Return the settings id, the number of jobs waiting in the scheduler queue and the deadline (or None) of each
+    test settings with batch jobs waiting to be dispatched.
+    """
+    tenants = [t.decode() if isinstance(t, bytes) else t for t in connection.zrange(TENANTS_KEY, 0, -1)]
+    with connection.pipeline(transaction=False) as pipe:
+        for tenant in tenants:
+            pipe.llen(JOBS_KEY.format(tenant))
+            pipe.zscore(DEADLINES_KEY, tenant)
+        data = pipe.execute()
+    return list(zip(tenants, data[::2], data[1::2]))
@@ -1,10 +1,13 @@
 from collections import defaultdict, OrderedDict
 from contextlib import contextmanager
+import functools
 import glob
+import hashlib
 import locale
 import os
 import re
 import signal
+import stat
 import subprocess
 from typing import Optional, List
 import unittest
@@ -12,6 +15,13 @@ import unittest
 DEFAULT_LTRACE_LOG_FILE = "ltrace_log.txt"
 DEFAULT_GCC_FLAGS = ["-std=gnu99", "-Wall", "-g"]
 DEFAULT_LTRACE_FLAGS = ["-f", "-n", "2", "-o", DEFAULT_LTRACE_LOG_FILE]
+MAKE_SOURCE_PATTERNS = ["*.c", "*.h", "*.mk", "Makefile", "makefile", "GNUmakefile"]
+
+# Results of builds (and of running executables in TestGenerator) in this process, see _cache_key. The cache is
+# kept in memory so that it only lasts for a single test group: code run by the tests runs as the same user as
+# the tests, so it could change a cache stored in a file before a later test group reads it. Builds and reference
+# outputs are therefore not shared between test groups or test runs.
+_BUILD_CACHE = {}
 
 # Note that the keys of the dictionary correspond to the "type" of call it was
 regex_dict = OrderedDict(
@@ -23,6 +33,22 @@ regex_dict = OrderedDict(
 )
 
 
+@functools.lru_cache(maxsize=None)
+def _compile_regex(regex):
+    return re.compile(regex)
+
+
+# Substrings that a line must contain to match each regex in regex_dict. Lines that do not contain
+# them are not matched against the regex at all, which avoids the (slow) backtracking of the regexes.
+_REGEX_LITERALS = {
+    regex_dict["resumed"]: ("<... ", " resumed>", "="),
+    regex_dict["unfinished"]: ("(", "<unfinished"),
+    regex_dict["no_return"]: ("(", "<no return"),
+    regex_dict["special"]: ("(", ")"),
+    regex_dict["function_call"]: ("(", ")", "="),
+}
+
+
 class TestExecutable(unittest.TestCase):
     """A test that compiles and runs a single executable.
 
@@ -36,6 +62,7 @@ class TestExecutable(unittest.TestCase):
     make = False
     make_targets = []
     make_args = ["--silent"]
+    build_cache = True
 
     @classmethod
     def setUpClass(cls) -> None:
@@ -44,6 +71,10 @@ class TestExecutable(unittest.TestCase):
         First remove any .o files and the executable file
 
         Use make if cls.make is True, and gcc otherwise.
+
+        If cls.build_cache is True, the result of compiling the same sources (and headers) with
+        the same flags (or running make with the same targets and arguments on the same sources)
+        is reused if another test class in the same test group has already done so.
         """
         if not cls.make and not cls.source_files:
             raise ValueError("ERROR: TestExecutable subclasses must specify source_files or set make=True.")
@@ -62,9 +93,11 @@ class TestExecutable(unittest.TestCase):
         try:
             if cls.make:
                 # Tuple (stdoutdata, stderrdata) is returned
-                cls.compile_out, cls.compile_err, _ = _make(cls.make_targets, cls.make_args)
+                make = _cached_make if cls.build_cache else _make
+                cls.compile_out, cls.compile_err, _ = make(cls.make_targets, cls.make_args)
             else:
-                cls.compile_out, cls.compile_err, _ = _compile(cls.source_files, cls.executable_name)
+                compile_ = _cached_compile if cls.build_cache else _compile
+                cls.compile_out, cls.compile_err, _ = compile_(cls.source_files, cls.executable_name)
         except subprocess.CalledProcessError:
             cls.compiled = False
         else:
@@ -110,7 +143,7 @@ def simple_test(
     check=True,
     rstrip=False,
     doc="",
-    stderr_relax=False
+    stderr_relax=False,
 ):
     """Create a unittest test for fixed command-line arguments, expected stdout and stderr, and exit status.
 
@@ -128,27 +161,26 @@ def simple_test(
     def _t(self: "TestExecutable") -> None:
         stdout, stderr, returncode = self._run_exec(args=args, input_=input_, timeout=timeout, check=check)
 
+        expected_out, expected_err = expected_stdout, expected_stderr
         if rstrip:
             stdout = stdout.rstrip()
             stderr = stderr.rstrip()
-            if expected_stderr is not None:
-                nonlocal expected_stderr
-                expected_stderr = expected_stderr.rstrip()
-            if expected_stdout is not None:
-                nonlocal expected_stdout
-                expected_stdout = expected_stdout.rstrip()
+            if expected_err is not None:
+                expected_err = expected_err.rstrip()
+            if expected_out is not None:
+                expected_out = expected_out.rstrip()
 
-        if expected_stderr is not None:
+        if expected_err is not None:
             if stderr_relax:
                 try:
-                    self.assertIn(expected_stderr, stdout)
+                    self.assertIn(expected_err, stdout)
                 except AssertionError:
-                    self.assertEqual(stderr, expected_stderr)
+                    self.assertEqual(stderr, expected_err)
             else:
-                self.assertEqual(stderr, expected_stderr)
+                self.assertEqual(stderr, expected_err)
 
-        if expected_stdout is not None:
-            self.assertEqual(stdout, expected_stdout)
+        if expected_out is not None:
+            self.assertEqual(stdout, expected_out)
 
         if expected_status is not None:
             self.assertEqual(returncode, expected_status)
@@ -166,7 +198,7 @@ def substr_test(
     input_=None,
     timeout=2,
     check=True,
-    doc=""
+    doc="",
 ):
     """Create a unittest test for fixed command-line arguments, expected stdout and stderr, and exit status.
 
@@ -259,38 +291,64 @@ class Trace:
         except subprocess.TimeoutExpired:  # allow for partial results to be reported
             pass
 
-        with open(DEFAULT_LTRACE_LOG_FILE, "rb") as f:
-            f_bytes = f.read()
-            self.raw = f_bytes.decode(errors="ignore")
-
         self.parent_first_process = None
         self.lines = []
         self.process_log = defaultdict(list)
         self.first_process = None
-        self.split_lines = self.raw.splitlines()
-        if len(self.split_lines) > 1:
-            parsed_line = parse_arbitrary(self.split_lines[0], r"([0-9]+)\s*.")
+        # per pid index of the calls in process_log by function name and the first call recording an exit status
+        self._calls_by_name = defaultdict(lambda: defaultdict(list))
+        self._exit_calls = {}
+
+        # The log is parsed one line at a time as it is read since traces of programs that fork can be very long.
+        # The decoded lines are kept so that raw and split_lines still describe this trace after another trace
+        # has overwritten the log file.
+        parsers = _line_parsers(tuple(regex_dict.items()))
+        self._log_chunks = []
+        first_line = None
+        num_lines = 0
+        with open(DEFAULT_LTRACE_LOG_FILE, "rb") as f:
+            for line_bytes in f:
+                chunk = line_bytes.decode(errors="ignore")
+                self._log_chunks.append(chunk)
+                for line in chunk.splitlines():
+                    if first_line is None:
+                        first_line = line
+                    num_lines += 1
+                    self._add_line(_parse_line(parsers, line))
+
+        if num_lines > 1:
+            parsed_line = parse_arbitrary(first_line, r"([0-9]+)\s*.")
             if parsed_line:
                 self.first_process = parsed_line[0]
             else:
                 raise Exception("First call of ltrace is not pid!")
 
-        for line in self.split_lines:
-            parsed_line = run_through_regexes(regex_dict, line)
-            if len(parsed_line) < 4 or not parsed_line[0]:
-                continue
-            pid = parsed_line[0]
-            self.lines.append(parsed_line)
-            self.process_log[pid].append(list(parsed_line[1:]))
+    def _add_line(self, parsed_line):
+        if len(parsed_line) < 4 or not parsed_line[0]:
+            return
+        pid = parsed_line[0]
+        call = list(parsed_line[1:])
+        self.lines.append(parsed_line)
+        self.process_log[pid].append(call)
+        self._calls_by_name[pid][call[0]].append(call)
+        if pid not in self._exit_calls and "exited" in call[0]:
+            self._exit_calls[pid] = call
+
+    @functools.cached_property
+    def raw(self):
+        """The contents of the ltrace log file for this trace."""
+        return "".join(self._log_chunks)
+
+    @functools.cached_property
+    def split_lines(self):
+        """The lines of the ltrace log file (see raw)."""
+        return self.raw.splitlines()
 
     def get_status(self, pid):
         """Return the exit status recorded in this trace for the given pid."""
-        if pid not in self.process_log:
+        if pid not in self._exit_calls:
             return None
-
-        for calls in self.process_log[pid]:
-            if "exited" in calls[0]:
-                return int(calls[1].split()[-1])
+        return int(self._exit_calls[pid][1].split()[-1])
 
     def lines_for_pid(self, pid, match=""):
         """Return the lines in this trace for the given pid.
@@ -306,49 +364,62 @@ class Trace:
         if not match:
             return self.process_log[pid]
 
-        return [call for call in self.process_log[pid] if call[0] == match]
+        calls = self._calls_by_name[pid]
+        return list(calls[match]) if match in calls else []
 
 
-def run_through_regexes(regexes, trace_line):
-    """Parse trace_line against the collection of regexes."""
-    for key, regex in regexes.items():
-        parser = re.compile(regex)
-        result = parser.match(trace_line)
-        if not result:
-            continue
-
-        final_result = list(result.groups())
-
-        # Note that this check is unnecessary, because an optional capturing group will return None if it
-        # is not detected
-        if len(final_result) >= 3:
-            # print("this is the len of final result " + str(len(final_result)))
-            # print(final_result)
-            # clean the line before putting it in
-            sep = "->"
-            rest = final_result[1].split(sep, 1)
-            if len(rest) > 1:  # in case there were multiple
-                final_result[1] = rest[1]
-            # print(final_result)
-        else:
-            raise ValueError("groups mismatch arity")
+def _trace_tuple(key, groups):
+    """Return the function call tuple for a trace line of type key whose regex matched with groups."""
+    final_result = list(groups)
+
+    # Note that this check is unnecessary, because an optional capturing group will return None if it
+    # is not detected
+    if len(final_result) >= 3:
+        # clean the line before putting it in
+        sep = "->"
+        rest = final_result[1].split(sep, 1)
+        if len(rest) > 1:  # in case there were multiple
+            final_result[1] = rest[1]
+    else:
+        raise ValueError("groups mismatch arity")
 
-        while len(final_result) < 4:
-            final_result += (None,)
+    while len(final_result) < 4:
+        final_result += (None,)
 
-        final_result += (key,)  # append the type of the entry to the end
-        return final_result  # stops as soon as a matching regex is encountered
-    # print("line did not have any mathces " + trace_line)
+    final_result += (key,)  # append the type of the entry to the end
+    return final_result
+
+
+@functools.lru_cache(maxsize=None)
+def _line_parsers(regexes):
+    """Return the type, compiled match method and required substrings of each (key, regex) pair in regexes."""
+    return tuple((key, _compile_regex(regex).match, _REGEX_LITERALS.get(regex, ())) for key, regex in regexes)
+
+
+def _parse_line(parsers, trace_line):
+    """Parse trace_line with parsers (see _line_parsers), trying each one after another until one matches."""
+    for key, match, literals in parsers:
+        for literal in literals:
+            if literal not in trace_line:
+                break
+        else:
+            result = match(trace_line)
+            if result:
+                return _trace_tuple(key, result.groups())  # stops as soon as a matching regex is encountered
     return "", "", "", ""  # did not match with any of the regexes
 
 
+def run_through_regexes(regexes, trace_line):
+    """Parse trace_line against the collection of regexes."""
+    return _parse_line(_line_parsers(tuple(regexes.items())), trace_line)
+
+
 def parse_arbitrary(trace_line, regex):
     """Apply the regex to the string, returning the matching groups (if any).
 
     trace_line and regex are both strings.
     """
-    parser = re.compile(regex)
-    result = parser.match(trace_line)
+    result = _compile_regex(regex).match(trace_line)
     if result:
         return result.groups()
 
@@ -378,6 +449,7 @@ class TestGenerator:
         input_extension="txt",
         output_extension="stdout",
         error_extension="stderr",
+        build_cache=True,
     ):
         """
         `input_dir` specifies where the input files are found
@@ -386,6 +458,9 @@ class TestGenerator:
         (currently, standard output and standard error files must go to the
         same directory)
         `executable_path` specifies where the executable may be found
+        If `build_cache` is True, the outputs of running the executable on an input file are
+        reused if they have already been generated for the same executable, input and arguments
+        in the same test group.
         """
         self.executable_path = executable_path
         self.input_dir = input_dir
@@ -393,6 +468,7 @@ class TestGenerator:
         self.input_extension = input_extension
         self.output_extension = output_extension
         self.error_extension = error_extension
+        self.build_cache = build_cache
 
     def build_outputs(self, args=""):
         """Generate all output files.
@@ -406,11 +482,20 @@ class TestGenerator:
             stdout_file = os.path.join(self.out_dir, name + "." + self.output_extension)
             stderr_file = os.path.join(self.out_dir, name + "." + self.error_extension)
             cmd = "{} {} < {} > {} 2> {}".format(self.executable_path, args, file, stdout_file, stderr_file)
+            key = None
+            if self.build_cache:
+                key = _cache_key(["run", args], [self.executable_path, file])
+                if _restore_cached(key, {"stdout": stdout_file, "stderr": stderr_file}):
+                    print("Using cached outputs for:", cmd)
+                    continue
             print("Running:", cmd)
             try:
                 _exec_shell([cmd])
             except subprocess.TimeoutExpired:  # TODO add handling for TimeoutExpired (error log file for example?)
                 print("failed on {}".format(file))
+            else:
+                if key is not None:
+                    _store_cached(key, {"stdout": stdout_file, "stderr": stderr_file})
 
     def clean(self):
         """Remove generated test files."""
@@ -467,6 +552,105 @@ def _make(targets=None, make_args=None, **kwargs):
     return _exec(["make"] + make_args + (targets or []), timeout=60, **kwargs)
 
 
+def _cache_key(args, files):
+    """Return a key for the build cache from the strings in args and the names and contents of files."""
+    hasher = hashlib.sha256()
+    for arg in args:
+        hasher.update(repr(arg).encode() + b"\0")
+    for file in files:
+        hasher.update(file.encode() + b"\0")
+        with open(file, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 16), b""):
+                hasher.update(chunk)
+        hasher.update(b"\0")
+    return hasher.hexdigest()
+
+
+def _restore_cached(key, files):
+    """Write the files stored in the build cache entry for key to their destinations.
+
+    files maps the name of each file in the cache entry to its destination. Return False
+    (without writing anything) if there is no cache entry for key.
+    """
+    entry = _BUILD_CACHE.get(key)
+    if entry is None:
+        return False
+    for name, destination in files.items():
+        if name in entry["files"]:
+            contents, mode = entry["files"][name]
+            with open(destination, "wb") as f:
+                f.write(contents)
+            os.chmod(destination, mode)
+    return True
+
+
+def _store_cached(key, files, result=None):
+    """Store the (stdout, stderr, exit status) triple result and copies of files in the build cache entry for key.
+
+    files maps the name of each file in the cache entry to its source. Sources that do not
+    exist are not stored.
+    """
+    stored = {}
+    for name, source in files.items():
+        if os.path.isfile(source):
+            with open(source, "rb") as f:
+                stored[name] = (f.read(), stat.S_IMODE(os.stat(source).st_mode))
+    _BUILD_CACHE[key] = {"result": result, "files": stored}
+
+
+def _read_cached(key):
+    """Return the (stdout, stderr, exit status) triple stored in the build cache entry for key, or None."""
+    return _BUILD_CACHE.get(key, {}).get("result")
+
+
+def _working_files(patterns):
+    """Return the files in the working directory (and its subdirectories) that match any of patterns."""
+    return sorted(
+        {f for pattern in patterns for f in glob.glob(os.path.join("**", pattern), recursive=True) if os.path.isfile(f)}
+    )
+
+
+def _cached_compile(files, exec_name=None, gcc_flags=None, **kwargs):
+    """Run gcc like _compile, reusing the executable and output of an identical earlier compilation.
+
+    The cache key covers the source files and every header in the working directory (and its subdirectories),
+    so that changing a header that the sources may include causes them to be compiled again. Headers outside
+    the working directory are not part of the key.
+    """
+    if isinstance(files, str):
+        files = [files]
+    exec_name = exec_name or "a.out"
+    gcc_flags = DEFAULT_GCC_FLAGS if gcc_flags is None else gcc_flags
+    headers = [f for f in _working_files(["*.h"]) if f not in files]
+    try:
+        key = _cache_key(["gcc", gcc_flags, exec_name, files], files + headers)
+    except OSError:  # let gcc report missing source files
+        return _compile(files, exec_name, gcc_flags, **kwargs)
+    cached = _read_cached(key)
+    if cached is not None:
+        _restore_cached(key, {"executable": exec_name})
+        return cached
+    result = _compile(files, exec_name, gcc_flags, **kwargs)
+    _store_cached(key, {"executable": exec_name}, result)
+    return result
+
+
+def _cached_make(targets=None, make_args=None, **kwargs):
+    """Run make like _make, reusing the output of an identical earlier run of make.
+
+    Since the files built by make are not known, the cached output is only used if make reports that
+    the targets are up to date (with the --question flag); otherwise make is run again.
+    """
+    make_args = ["--silent"] if make_args is None else make_args
+    key = _cache_key(["make", make_args, targets or []], _working_files(MAKE_SOURCE_PATTERNS))
+    cached = _read_cached(key)
+    if cached is not None and _exec(["make", "--question"] + make_args + (targets or []), timeout=60)[2] == 0:
+        return cached
+    result = _make(targets, make_args, **kwargs)
+    _store_cached(key, {}, result)
+    return result
+
+
 def _exec(args, *, input_=None, timeout=10, shell=False):
     """Wrapper function that calls exec on the given args in a new subprocess.
 
@@ -3,7 +3,7 @@ import inspect
 import subprocess
 from unittest.mock import patch
 from contextlib import contextmanager
-from typing import ContextManager, Callable, Optional, List, ClassVar, Type
+from typing import ContextManager, Callable, Optional, List, ClassVar, Type, Set, Tuple
 from psycopg2.extensions import AsIs
 from psycopg2.extensions import cursor as _psycopg2_cursor
 from psycopg2.extensions import connection as _psycopg2_connection
@@ -145,6 +145,8 @@ def execute_psql_file(
 
 class PSQLTest:
     connection: ClassVar[Optional[ConnectionType]] = None
+    _isolation_depth: ClassVar[int] = 0
+    _copied_schemas: ClassVar[List[Set[Tuple[str, str, Optional[Tuple[str, ...]]]]]] = []
 
     SCHEMA_COPY_STR = """
     CREATE TABLE %(new)s.%(table)s (
@@ -195,10 +197,79 @@ class PSQLTest:
         The arguments passed to this method are passed on to the cursor's
         constructor. The create_connection method must be called first or
         there will be no connection to create a cursor object on.
+
+        Changes made with the cursor are committed when the context manager
+        exits (or rolled back if an error is raised). Inside an isolated block
+        (see the isolated method) the changes are made in a savepoint instead,
+        which is released when the context manager exits (or rolled back if an
+        error is raised) so that they can still be rolled back when the isolated
+        block exits.
         """
-        with cls.connection as conn:
-            with conn.cursor(*args, **kwargs) as curr:
+        if cls._isolation_depth == 0:
+            with cls.connection as conn:
+                with conn.cursor(*args, **kwargs) as curr:
+                    yield curr
+            return
+        with cls.connection.cursor(*args, **kwargs) as curr:
+            curr.execute("SAVEPOINT psqltest_cursor;")
+            try:
                 yield curr
+            except BaseException:
+                curr.execute("ROLLBACK TO SAVEPOINT psqltest_cursor;")
+                raise
+            finally:
+                curr.execute("RELEASE SAVEPOINT psqltest_cursor;")
+
+    @classmethod
+    @contextmanager
+    def isolated(cls) -> ContextManager:
+        """
+        Context manager that rolls back every change made to the database
+        through this class's connection when it exits.
+
+        The outermost isolated block runs in a transaction that is rolled back
+        when it exits and nested isolated blocks run in a savepoint that is
+        rolled back when they exit. This makes it possible to load fixtures once
+        for all tests in a class and to undo the changes made by each test
+        without recreating the fixtures:
+
+        >>> class TestQueries(PSQLTest):
+        >>>     @pytest.fixture(scope="class", autouse=True)
+        >>>     def fixtures(self):
+        >>>         self.create_connection()
+        >>>         with self.isolated():
+        >>>             self.execute_files(["schema.sql", "data.sql"])
+        >>>             self.copy_schema("solution_schema", cached=True)
+        >>>             yield
+        >>>         self.close_connection()
+        >>>
+        >>>     @pytest.fixture(autouse=True)
+        >>>     def rollback(self, fixtures):
+        >>>         with self.isolated():
+        >>>             yield
+
+        Statements that cannot be run inside a transaction (such as VACUUM or
+        CREATE DATABASE) cannot be run inside an isolated block.
+        """
+        if cls._isolation_depth == 0:
+            cls.connection.commit()
+        cls._isolation_depth += 1
+        cls._copied_schemas = [*cls._copied_schemas, set()]
+        savepoint = f"psqltest_isolated_{cls._isolation_depth}"
+        try:
+            if cls._isolation_depth > 1:
+                with cls.connection.cursor() as curr:
+                    curr.execute(f"SAVEPOINT {savepoint};")
+            yield
+        finally:
+            cls._copied_schemas = cls._copied_schemas[:-1]
+            cls._isolation_depth -= 1
+            if cls._isolation_depth == 0:
+                cls.connection.rollback()
+            else:
+                with cls.connection.cursor() as curr:
+                    curr.execute(f"ROLLBACK TO SAVEPOINT {savepoint};")
+                    curr.execute(f"RELEASE SAVEPOINT {savepoint};")
 
     @classmethod
     @contextmanager
@@ -233,6 +304,7 @@ class PSQLTest:
         tables: Optional[List[str]] = None,
         from_schema: str = "public",
         overwrite: bool = True,
+        cached: bool = False,
     ) -> None:
         """
         Copies tables from <from_schema> to <to_schema>. <from_schema> is
@@ -241,7 +313,18 @@ class PSQLTest:
         If <tables> is None all tables will be copied, otherwise only the table
         names in <tables> will be copied. If <overwrite> is True, tables of the
         same name in <to_schema> will be overwritten.
+
+        If <cached> is True and this method is called inside an isolated block
+        (see the isolated method), the tables are not copied again if they were
+        already copied with the same arguments in this block or in an enclosing
+        one, since any changes made to the copy since then in a nested isolated
+        block have already been rolled back. Note that changes made to the copy
+        (or to <from_schema>) directly in the block that made the copy are not
+        undone.
         """
+        key = (to_schema, from_schema, None if tables is None else tuple(tables))
+        if cached and any(key in copied for copied in cls._copied_schemas):
+            return
         strings = {"new": AsIs(to_schema), "old": AsIs(from_schema)}
         if tables is None:
             with cls.cursor() as curr:
@@ -254,6 +337,8 @@ class PSQLTest:
                     curr.execute("DROP TABLE IF EXISTS %s.%s;", [AsIs(to_schema), AsIs(table)])
                 strs = {**strings, "table": AsIs(table)}
                 curr.execute(cls.SCHEMA_COPY_STR, strs)
+        if cls._copied_schemas:
+            cls._copied_schemas[-1].add(key)
 
     @classmethod
     def execute_files(cls, files: List[str], *args, cursor: Optional[CursorType] = None, **kwargs) -> None:
@@ -1,4 +1,7 @@
 import os
+import json
+import resource
+import traceback
 import unittest
 from typing import TextIO, Tuple, Optional, Type, Dict, List
 from types import TracebackType
@@ -105,9 +108,11 @@ class PytestPlugin:
         self.annotations = []
         self.extra_marks = []
         self.overall_comments = []
+        self.rootpath = None
 
     def pytest_configure(self, config):
         """Register custom markers for use with MarkUs."""
+        self.rootpath = str(config.rootpath)
         config.addinivalue_line("markers", "markus_tag(name): indicate that the submission should be given a tag")
         config.addinivalue_line(
             "markers", "markus_annotation(**ann_data): indicate that the submission should be given an annotation"
@@ -213,6 +218,20 @@ class PytestPlugin:
         parts = report.nodeid.split("::")
         return f"[{parts[0]}] {'.'.join(parts[1:])}" if len(parts) > 1 else f"[{parts[0]}]"
 
+    def results_by_file(self, test_files: List[str]) -> Dict[str, List[Dict]]:
+        """
+        Return a dict mapping each file in test_files to the results of the tests in that file.
+
+        Results that do not belong to any of the test files (for example, errors collecting a conftest.py
+        file) are reported with the results of the first test file.
+        """
+        results = {test_file: [] for test_file in test_files}
+        paths = {os.path.realpath(test_file): test_file for test_file in test_files}
+        for nodeid, result in self.results.items():
+            path = os.path.realpath(os.path.join(self.rootpath or os.getcwd(), nodeid.split("::")[0]))
+            results[paths.get(path, test_files[0])].append(result)
+        return results
+
 
 class PyTest(Test):
     def __init__(
@@ -305,39 +324,175 @@ class PyTester(Tester):
             test_result = test_runner.run(test_suite)
         return test_result.results
 
-    def _run_pytest_tests(self, test_file: str) -> List[Dict]:
+    def _run_pytest_session(self, test_files: List[str]) -> Dict:
         """
-        Run unittest tests in test_file and return the results
-        of these tests
+        Run the pytest tests in test_files in a single pytest session and return the results
+        of these tests for each file along with the MarkUs metadata from the tests
         """
-        results = []
         with open(os.devnull, "w") as null_out:
             try:
                 sys.stdout = null_out
                 verbosity = self.specs["test_data", "output_verbosity"] or "short"
                 plugin = PytestPlugin()
-                pytest.main([test_file, f"--tb={verbosity}", "-p", "no:cacheprovider"], plugins=[plugin])
-                results.extend(plugin.results.values())
-                self.annotations = plugin.annotations
-                self.overall_comments = plugin.overall_comments
-                self.extra_marks = plugin.extra_marks
-                self.tags = plugin.tags
+                pytest.main(
+                    [*test_files, f"--tb={verbosity}", "-p", "no:cacheprovider", "--continue-on-collection-errors"],
+                    plugins=[plugin],
+                )
             finally:
                 sys.stdout = sys.__stdout__
-        return results
+        return {
+            "results": plugin.results_by_file(test_files),
+            "annotations": plugin.annotations,
+            "overall_comments": plugin.overall_comments,
+            "extra_marks": plugin.extra_marks,
+            "tags": sorted(plugin.tags),
+        }
+
+    def _pytest_workers(self, num_files: int) -> int:
+        """
+        Return the number of processes to run num_files pytest files in.
+
+        This is the number of parallel_workers requested in the test settings, reduced so that there are
+        no more processes than files or available cpus and so that the processes fit in the process limit
+        set for this test group.
+        """
+        workers = min(self.specs.get("test_data", "parallel_workers", default=1) or 1, num_files)
+        workers = min(workers, len(os.sched_getaffinity(0)))
+        nproc, _ = resource.getrlimit(resource.RLIMIT_NPROC)
+        if nproc != resource.RLIM_INFINITY:
+            workers = min(workers, nproc - 1)
+        return max(workers, 1)
+
+    def _fork_pytest_session(self, test_files: List[str]) -> Tuple[int, int]:
+        """
+        Run the pytest tests in test_files in a child process and return the process id of the
+        child and the file descriptor that the results (as a json string) can be read from.
+
+        If running the tests raises an exception in the child, the formatted exception is written
+        instead (as the "error" key of a json object).
+        """
+        read_fd, write_fd = os.pipe()
+        sys.stdout.flush()
+        try:
+            pid = os.fork()
+        except OSError:
+            os.close(read_fd)
+            os.close(write_fd)
+            raise
+        if pid == 0:
+            os.close(read_fd)
+            status = 1
+            try:
+                try:
+                    output = json.dumps(self._run_pytest_session(test_files), default=str)
+                    status = 0
+                except BaseException:
+                    output = json.dumps({"error": traceback.format_exc()})
+                with os.fdopen(write_fd, "w") as f:
+                    f.write(output)
+            finally:
+                os._exit(status)
+        os.close(write_fd)
+        return pid, read_fd
+
+    @staticmethod
+    def _wait_pytest_session(pid: int, read_fd: int, test_files: List[str]) -> Dict:
+        """
+        Return the results written by the child process with process id pid to read_fd. If the
+        child process did not report any results, report an error for each file in test_files.
+
+        If the child process reported an exception, it is also written to stderr.
+        """
+        with os.fdopen(read_fd) as f:
+            output = f.read()
+        _, status = os.waitpid(pid, 0)
+        try:
+            data = json.loads(output)
+        except json.JSONDecodeError:
+            reason = (
+                f"signal {os.WTERMSIG(status)}"
+                if os.WIFSIGNALED(status)
+                else f"status {os.waitstatus_to_exitcode(status)}"
+            )
+            message = f"Test process exited unexpectedly with {reason}"
+        else:
+            if "error" not in data:
+                return data
+            print(data["error"], file=sys.stderr, flush=True)
+            message = f"Test process failed with an exception:\n{data['error']}"
+        error = {"status": "error", "errors": message, "description": None}
+        return {"results": {test_file: [{**error, "name": f"[{test_file}]"}] for test_file in test_files}}
+
+    def _run_pytest_tests(self, test_files: List[str]) -> Dict[str, List[Dict]]:
+        """
+        Run pytest tests in test_files and return a dict mapping each file to the results
+        of the tests in that file
+
+        Files that do not exist are not passed to pytest and an error is reported for each of them instead.
+        """
+        missing = {
+            test_file: [self._missing_file_result(test_file)]
+            for test_file in test_files
+            if not os.path.exists(test_file)
+        }
+        existing_files = [test_file for test_file in test_files if test_file not in missing]
+        if not existing_files:
+            return missing
+        results = {**missing, **self._run_pytest_files(existing_files)}
+        return {test_file: results[test_file] for test_file in test_files}
+
+    @staticmethod
+    def _missing_file_result(test_file: str) -> Dict:
+        """
+        Return an error result for a test file that does not exist (pytest would otherwise stop
+        the whole session without running the tests in any file).
+        """
+        return {
+            "status": "error",
+            "name": f"[{test_file}]",
+            "errors": f"file not found: {test_file}",
+            "description": None,
+        }
+
+    def _run_pytest_files(self, test_files: List[str]) -> Dict[str, List[Dict]]:
+        """
+        Run pytest tests in test_files (which must all exist) and return a dict mapping each file
+        to the results of the tests in that file
+
+        All files are run in a single pytest session unless the test settings request more than one
+        parallel worker, in which case the files are split between that many pytest sessions, each run
+        in its own process.
+        """
+        workers = self._pytest_workers(len(test_files))
+        if workers == 1:
+            sessions = [self._run_pytest_session(test_files)]
+        else:
+            children = []
+            sessions = []
+            for i in range(workers):
+                chunk = test_files[i::workers]
+                try:
+                    children.append((*self._fork_pytest_session(chunk), chunk))
+                except OSError:
+                    sessions.append(self._run_pytest_session(chunk))
+            sessions.extend(self._wait_pytest_session(*child) for child in children)
+        results = {}
+        for session in sessions:
+            results.update(session["results"])
+            self.annotations.extend(session.get("annotations", []))
+            self.overall_comments.extend(session.get("overall_comments", []))
+            self.extra_marks.extend(session.get("extra_marks", []))
+            self.tags.update(session.get("tags", []))
+        return {test_file: results[test_file] for test_file in test_files}
 
     def run_python_tests(self) -> Dict[str, List[Dict]]:
         """
         Return a dict mapping each filename to its results
         """
-        results = {}
-        for test_file in self.specs["test_data", "script_files"]:
-            if self.specs["test_data", "tester"] == "unittest":
-                result = self._run_unittest_tests(test_file)
-            else:
-                result = self._run_pytest_tests(test_file)
-            results[test_file] = result
-        return results
+        test_files = self.specs["test_data", "script_files"]
+        if self.specs["test_data", "tester"] == "unittest":
+            return {test_file: self._run_unittest_tests(test_file) for test_file in test_files}
+        return self._run_pytest_tests(test_files)
 
     @Tester.run_decorator
     def run(self) -> None:
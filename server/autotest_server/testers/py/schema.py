@@ -33,3 +33,4 @@ class PyTestData(BaseTestData, kw_only=True):
         Literal["", "short", "auto", "long", "no", "line", "native"] | Literal[0, 1, 2],
         Meta(title="Output verbosity"),
     ] = ""
+    parallel_workers: Annotated[int, Meta(title="Number of processes to run test files in", ge=1)] = 1
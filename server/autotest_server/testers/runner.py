@@ -0,0 +1,80 @@
+import importlib
+import json
+import os
+import sys
+import tempfile
+import traceback
+from typing import Dict, Type
+from .specs import TestSpecs
+from .tester import Tester
+
+
+def _run_child(
+    tester_class: Type[Tester],
+    resource_settings: list[tuple[int, tuple[int, int]]],
+    request: Dict,
+    base_env: Dict[str, str],
+    stdout_fd: int,
+    stderr_fd: int,
+) -> None:
+    """
+    Run a single test group in a forked child process and exit.
+
+    The child writes its results to stdout_fd and stderr_fd in the same way that the
+    tester would if it were run as a standalone process.
+    """
+    exit_code = 0
+    try:
+        devnull = os.open(os.devnull, os.O_RDONLY)
+        os.dup2(devnull, 0)
+        os.dup2(stdout_fd, 1)
+        os.dup2(stderr_fd, 2)
+        os.chdir(request["cwd"])
+        os.environ.clear()
+        os.environ.update({**base_env, **request["env"]})
+        for var in request.get("unset", []):
+            os.environ.pop(var, None)
+        importlib.invalidate_caches()
+        tester_class(resource_settings=resource_settings, specs=TestSpecs(request["specs"])).run()
+    except BaseException:
+        traceback.print_exc()
+        exit_code = 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(exit_code)
+
+
+def serve(tester_class: Type[Tester], resource_settings: list[tuple[int, tuple[int, int]]]) -> None:
+    """
+    Run test groups read from stdin until stdin is closed.
+
+    Each line read from stdin is a json object with the following keys:
+        - specs: the test specs used to create a tester_class instance
+        - env: environment variables to set (in addition to those of this process) while running the tester
+        - unset: names of environment variables of this process to unset while running the tester
+        - cwd: the directory to run the tester in
+
+    Each test group is run in a forked child process so that the modules already imported by this process do not
+    need to be imported again. For each line read, a single line json object is written to stdout containing the
+    stdout, stderr, and returncode of the child process.
+    """
+    base_env = dict(os.environ)
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        request = json.loads(line)
+        with tempfile.TemporaryFile() as out, tempfile.TemporaryFile() as err:
+            pid = os.fork()
+            if pid == 0:
+                _run_child(tester_class, resource_settings, request, base_env, out.fileno(), err.fileno())
+            _, status = os.waitpid(pid, 0)
+            out.seek(0)
+            err.seek(0)
+            reply = {
+                "stdout": out.read().decode(errors="replace"),
+                "stderr": err.read().decode(errors="replace"),
+                "returncode": os.waitstatus_to_exitcode(status),
+            }
+        sys.stdout.write(json.dumps(reply) + "\n")
+        sys.stdout.flush()
@@ -0,0 +1,91 @@
+import hashlib
+import os
+from unittest.mock import patch, MagicMock
+
+import fakeredis
+import pytest
+
+from autotest_server.archive_cache import ArchiveCache
+
+
+def _response(status_code=200, content=b"", etag=None):
+    r = MagicMock()
+    r.__enter__.return_value = r
+    r.status_code = status_code
+    r.headers = {"ETag": etag} if etag else {}
+    r.iter_content.return_value = [content]
+    return r
+
+
+@pytest.fixture
+def cache(tmp_path):
+    yield ArchiveCache(str(tmp_path), max_size=1024, connection=fakeredis.FakeStrictRedis())
+
+
+class TestArchiveCache:
+    def test_fetch_returns_content(self, cache):
+        with patch("autotest_server.archive_cache.requests.get", return_value=_response(content=b"abc")):
+            with cache.fetch("http://example.com/a") as f:
+                assert f.read() == b"abc"
+
+    def test_first_fetch_is_miss(self, cache):
+        with patch("autotest_server.archive_cache.requests.get", return_value=_response(content=b"abc", etag="1")):
+            cache.fetch("http://example.com/a").close()
+        assert cache.stats() == {"hits": 0, "misses": 1}
+
+    def test_conditional_get_sent_when_cached(self, cache):
+        with patch("autotest_server.archive_cache.requests.get", return_value=_response(content=b"abc", etag="1")):
+            cache.fetch("http://example.com/a").close()
+        with patch("autotest_server.archive_cache.requests.get", return_value=_response(304)) as mock_get:
+            with cache.fetch("http://example.com/a", headers={"Authorization": "x"}) as f:
+                assert f.read() == b"abc"
+        assert mock_get.call_args.kwargs["headers"] == {"Authorization": "x", "If-None-Match": "1"}
+        assert cache.stats() == {"hits": 1, "misses": 1}
+
+    def test_no_conditional_get_without_etag(self, cache):
+        with patch("autotest_server.archive_cache.requests.get", return_value=_response(content=b"abc")):
+            cache.fetch("http://example.com/a").close()
+        with patch("autotest_server.archive_cache.requests.get", return_value=_response(content=b"abc")) as mock_get:
+            cache.fetch("http://example.com/a").close()
+        assert "If-None-Match" not in mock_get.call_args.kwargs["headers"]
+
+    def test_content_without_etag_not_stored(self, cache):
+        with patch("autotest_server.archive_cache.requests.get", return_value=_response(content=b"abc")):
+            with cache.fetch("http://example.com/a") as f:
+                assert f.read() == b"abc"
+        assert os.listdir(os.path.join(cache.root, "blobs")) == []
+        assert os.listdir(os.path.join(cache.root, "tmp")) == []
+
+    def test_failed_download_removes_tmp_file(self, cache):
+        r = _response()
+        r.iter_content.side_effect = ConnectionError
+        with patch("autotest_server.archive_cache.requests.get", return_value=r):
+            with pytest.raises(ConnectionError):
+                cache.fetch("http://example.com/a")
+        assert os.listdir(os.path.join(cache.root, "tmp")) == []
+        assert cache.stats() == {"hits": 0, "misses": 0}
+
+    def test_changed_content_is_downloaded(self, cache):
+        with patch("autotest_server.archive_cache.requests.get", return_value=_response(content=b"abc", etag="1")):
+            cache.fetch("http://example.com/a").close()
+        with patch("autotest_server.archive_cache.requests.get", return_value=_response(content=b"def", etag="2")):
+            with cache.fetch("http://example.com/a") as f:
+                assert f.read() == b"def"
+
+    def test_same_content_stored_once(self, cache):
+        with patch("autotest_server.archive_cache.requests.get", return_value=_response(content=b"abc", etag="1")):
+            cache.fetch("http://example.com/a").close()
+            cache.fetch("http://example.com/b").close()
+        assert len(os.listdir(os.path.join(cache.root, "blobs"))) == 1
+
+    def test_least_recently_used_evicted(self, cache):
+        digests = []
+        for i in range(3):
+            content = bytes([i]) * 500
+            digests.append(hashlib.sha256(content).hexdigest())
+            with patch(
+                "autotest_server.archive_cache.requests.get", return_value=_response(content=content, etag=str(i))
+            ):
+                cache.fetch(f"http://example.com/{i}").close()
+            os.utime(cache._blob_path(digests[-1]), (i, i))
+        assert sorted(os.listdir(os.path.join(cache.root, "blobs"))) == sorted(digests[1:])
@@ -0,0 +1,116 @@
+import unittest
+from unittest.mock import patch
+
+import fakeredis
+import rq
+
+from autotest_server.autoscaler import Autoscaler, worker_slots
+
+WORKERS = [{"user": "a", "queues": ["high", "batch"], "concurrency": 2}, {"user": "b", "queues": ["batch"]}]
+
+
+class FakeSupervisor:
+    def __init__(self, running=()):
+        self.running = set(running)
+        self.pids = {}
+
+    def getAllProcessInfo(self):
+        processes = []
+        for name, _ in worker_slots(WORKERS):
+            group, process_name = name.split(":")
+            state = "RUNNING" if name in self.running else "STOPPED"
+            processes.append({"group": group, "name": process_name, "statename": state, "pid": self.pids.get(name, 0)})
+        return processes
+
+    def startProcess(self, name, wait):
+        self.running.add(name)
+
+    def stopProcess(self, name, wait):
+        self.running.discard(name)
+
+
+def _enqueue(conn, queue_name, n):
+    queue = rq.Queue(queue_name, connection=conn)
+    for _ in range(n):
+        queue.enqueue_call("autotest_server.run_test")
+
+
+class TestAutoscaler(unittest.TestCase):
+    """Tests for starting and stopping worker slots with the Autoscaler."""
+
+    def setUp(self):
+        self.conn = fakeredis.FakeStrictRedis()
+
+    def _autoscaler(self, supervisor, **settings):
+        return Autoscaler(supervisor, self.conn, WORKERS, settings)
+
+    def test_worker_slots(self):
+        self.assertEqual(
+            worker_slots(WORKERS),
+            [
+                ("rq_worker_a:rq_worker_a_0", {"settings", "high", "batch"}),
+                ("rq_worker_a:rq_worker_a_1", {"settings", "high", "batch"}),
+                ("rq_worker_b:rq_worker_b_0", {"settings", "batch"}),
+            ],
+        )
+
+    def test_step_dispatches_batch_jobs(self):
+        with patch("autotest_server.autoscaler.scheduler.dispatch") as dispatch:
+            self._autoscaler(FakeSupervisor()).step(0)
+        dispatch.assert_called_once_with(self.conn)
+
+    def test_starts_minimum(self):
+        supervisor = FakeSupervisor()
+        self._autoscaler(supervisor, queues={"high": {"min": 1}}).step(0)
+        self.assertEqual(supervisor.running, {"rq_worker_a:rq_worker_a_0"})
+
+    def test_scales_up_to_queue_length(self):
+        supervisor = FakeSupervisor()
+        _enqueue(self.conn, "batch", 2)
+        self._autoscaler(supervisor).step(0)
+        self.assertEqual(len(supervisor.running), 2)
+
+    def test_scales_up_to_maximum(self):
+        supervisor = FakeSupervisor()
+        _enqueue(self.conn, "batch", 10)
+        self._autoscaler(supervisor, queues={"batch": {"max": 2}}).step(0)
+        self.assertEqual(len(supervisor.running), 2)
+
+    def test_max_wait(self):
+        supervisor = FakeSupervisor()
+        _enqueue(self.conn, "batch", 1)
+        autoscaler = self._autoscaler(supervisor, max_wait=60)
+        autoscaler.step(rq.Queue("batch", connection=self.conn).jobs[0].enqueued_at.timestamp() + 120)
+        self.assertEqual(len(supervisor.running), 3)
+
+    def test_oldest_job_age_reads_head_of_queue(self):
+        _enqueue(self.conn, "batch", 3)
+        queue = rq.Queue("batch", connection=self.conn)
+        enqueued_at = queue.jobs[0].enqueued_at.timestamp()
+        with patch.object(self.conn, "lrange", wraps=self.conn.lrange) as lrange:
+            self.assertAlmostEqual(self._autoscaler(FakeSupervisor())._oldest_job_age(queue, enqueued_at + 30), 30)
+        lrange.assert_called_once_with(queue.key, 0, 0)
+
+    def test_scale_down_delay(self):
+        supervisor = FakeSupervisor()
+        _enqueue(self.conn, "batch", 2)
+        autoscaler = self._autoscaler(supervisor, scale_down_delay=100)
+        autoscaler.step(0)
+        rq.Queue("batch", connection=self.conn).empty()
+        autoscaler.step(50)
+        self.assertEqual(len(supervisor.running), 2)
+        autoscaler.step(150)
+        self.assertEqual(supervisor.running, set())
+
+    def test_busy_slots_are_not_stopped(self):
+        supervisor = FakeSupervisor(running={"rq_worker_b:rq_worker_b_0"})
+        supervisor.pids["rq_worker_b:rq_worker_b_0"] = 123
+        with patch.object(Autoscaler, "_busy_pids", return_value={123}):
+            self._autoscaler(supervisor, scale_down_delay=0).step(0)
+        self.assertEqual(supervisor.running, {"rq_worker_b:rq_worker_b_0"})
+
+    def test_prefers_running_slots(self):
+        supervisor = FakeSupervisor(running={"rq_worker_b:rq_worker_b_0"})
+        _enqueue(self.conn, "batch", 1)
+        self._autoscaler(supervisor).step(0)
+        self.assertEqual(supervisor.running, {"rq_worker_b:rq_worker_b_0"})
@@ -118,8 +118,9 @@ class TestRunTest(unittest.TestCase):
         mock_redis.return_value = mock_redis_instance
 
         error_message = "Invalid configuration"
-        mock_settings = {"_error": error_message}
-        mock_redis_instance.hget.return_value = json.dumps(mock_settings)
+        mock_settings = {"_version": "1", "_error": error_message}
+        mock_redis_instance.hgetall.return_value = mock_settings
+        mock_redis_instance.get.return_value = json.dumps({})
 
         autotest_server.run_test(
             settings_id="test_settings_id",
@@ -134,7 +135,9 @@ class TestRunTest(unittest.TestCase):
         mock_redis_instance.set.assert_called_once()
         call_args = mock_redis_instance.set.call_args[0]
         self.assertEqual(call_args[0], "autotest:test_result:test_id_123")
-        self.assertEqual(json.loads(call_args[1]), expected_result)
+        result = json.loads(call_args[1])
+        self.assertIn("total", result.pop("timings"))
+        self.assertEqual(result, expected_result)
 
     @patch("autotest_server.redis_connection")
     def test_env_status_error(self, mock_redis):
@@ -144,8 +147,9 @@ class TestRunTest(unittest.TestCase):
         mock_redis_instance = MagicMock()
         mock_redis.return_value = mock_redis_instance
 
-        mock_settings = {"_env_status": "error"}
-        mock_redis_instance.hget.return_value = json.dumps(mock_settings)
+        mock_settings = {"_version": "1", "_env_status": "error"}
+        mock_redis_instance.hgetall.return_value = mock_settings
+        mock_redis_instance.get.return_value = json.dumps({})
 
         autotest_server.run_test(
             settings_id="test_settings_id",
@@ -160,7 +164,9 @@ class TestRunTest(unittest.TestCase):
         mock_redis_instance.set.assert_called_once()
         call_args = mock_redis_instance.set.call_args[0]
         self.assertEqual(call_args[0], "autotest:test_result:test_id_456")
-        self.assertEqual(json.loads(call_args[1]), expected_result)
+        result = json.loads(call_args[1])
+        self.assertIn("total", result.pop("timings"))
+        self.assertEqual(result, expected_result)
 
     @patch("autotest_server.redis_connection")
     @patch("autotest_server.tester_user")
@@ -172,7 +178,8 @@ class TestRunTest(unittest.TestCase):
         mock_redis.return_value = mock_redis_instance
 
         mock_settings = {"key": "value"}
-        mock_redis_instance.hget.return_value = json.dumps(mock_settings)
+        mock_redis_instance.hgetall.return_value = {"_version": "1"}
+        mock_redis_instance.get.return_value = json.dumps(mock_settings)
 
         # `tester_user` is a function that gets called after we assert that settings don't have an error.
         # We add an exception to this call to check the correct error value in the result.
@@ -196,3 +203,162 @@ class TestRunTest(unittest.TestCase):
         self.assertIsNotNone(result_dict["error"])
         self.assertIn("Traceback", result_dict["error"])
         self.assertIn("Unexpected error", result_dict["error"])
+
+
+@pytest.mark.parametrize("key", ["autotest:timings:1", "autotest:timings"])
+def test_record_timings(fake_redis_conn, key):
+    autotest_server._record_timings(1, {"tests": 0.3, "total": 4000})
+    autotest_server._record_timings(1, {"tests": 0.4})
+    histogram = {k.decode(): float(v) for k, v in fake_redis_conn.hgetall(key).items()}
+    assert histogram == {
+        "tests:0.5": 2,
+        "tests:sum": 0.7,
+        "tests:count": 2,
+        "total:+Inf": 1,
+        "total:sum": 4000,
+        "total:count": 1,
+    }
+
+
+def test_record_durations(fake_redis_conn):
+    results = [{"time": 1500}, {"time": 500}]
+    autotest_server._record_durations(1, 2, ["0:0", "1:0"], results, 3.25)
+    autotest_server._record_durations(1, 2, ["0:0", "1:0"], results, 1)
+    assert fake_redis_conn.lrange("autotest:durations:1:2:0:0", 0, -1) == [b"1.5", b"1.5"]
+    assert fake_redis_conn.lrange("autotest:durations:1:2:overhead", 0, -1) == [b"0", b"1.25"]
+    assert fake_redis_conn.lrange("autotest:durations:1:2:total", 0, -1) == [b"1", b"3.25"]
+    assert fake_redis_conn.ttl("autotest:durations:1:2:total") > 0
+
+
+def test_test_groups():
+    settings = {
+        "testers": [{"test_data": [{"category": ["a"]}, {"category": ["b"]}]}, {"test_data": [{"category": ["a"]}]}]
+    }
+    assert [group_id for group_id, _, _ in autotest_server._test_groups(settings, ["a"])] == ["0:0", "1:0"]
+
+
+def test_record_job_status(fake_redis_conn):
+    autotest_server._record_job_status("finished")
+    autotest_server._record_job_status("finished")
+    autotest_server._record_job_status("failed")
+    assert fake_redis_conn.hgetall("autotest:metrics:jobs") == {b"finished": b"2", b"failed": b"1"}
+    per_minute_keys = fake_redis_conn.keys("autotest:metrics:jobs:finished:*")
+    assert sum(int(fake_redis_conn.get(key)) for key in per_minute_keys) == 2
+
+
+class TestSettingsStorage:
+    @pytest.fixture(autouse=True)
+    def clear_cache(self):
+        autotest_server._SETTINGS_CACHE.clear()
+
+    @staticmethod
+    def _set_settings(conn, spec, version=1, **fields):
+        conn.hset("autotest:settings:1", mapping={"_version": version, **fields})
+        conn.set(f"autotest:settings_spec:1:{version}", json.dumps(spec))
+
+    def test_load_settings(self, fake_redis_conn):
+        self._set_settings(fake_redis_conn, {"testers": []}, _user="a", _last_access=10)
+        assert autotest_server.load_settings(1) == {"testers": [], "_user": "a", "_last_access": 10, "_version": 1}
+
+    def test_load_legacy_settings(self, fake_redis_conn):
+        legacy = {"testers": [], "_user": "a", "_env_status": "ready", "_error": None}
+        fake_redis_conn.hset("autotest:settings", "1", json.dumps(legacy))
+        assert autotest_server.load_settings(1) == {"testers": [], "_user": "a", "_env_status": "ready", "_version": 1}
+        assert json.loads(fake_redis_conn.get("autotest:settings_spec:1:1")) == {"testers": []}
+        assert not fake_redis_conn.exists("autotest:settings")
+
+    def test_legacy_settings_not_migrated_over_newer_settings(self, fake_redis_conn):
+        self._set_settings(fake_redis_conn, {"testers": [1]}, version=2, _user="a")
+        fake_redis_conn.hset("autotest:settings", "1", json.dumps({"testers": [], "_user": "a"}))
+        assert autotest_server.migrate_legacy_settings(1, fake_redis_conn)
+        assert autotest_server.load_settings(1)["testers"] == [1]
+        assert not fake_redis_conn.exists("autotest:settings", "autotest:settings_spec:1:1")
+
+    def test_load_missing_settings(self, fake_redis_conn):
+        with pytest.raises(Exception):
+            autotest_server.load_settings(1)
+
+    def test_ready_settings_cached(self, fake_redis_conn):
+        self._set_settings(fake_redis_conn, {"testers": []}, _env_status="ready")
+        autotest_server.load_settings(1)
+        fake_redis_conn.set("autotest:settings_spec:1:1", json.dumps({"testers": [1]}))
+        assert autotest_server.load_settings(1)["testers"] == []
+
+    def test_settings_not_cached_during_setup(self, fake_redis_conn):
+        self._set_settings(fake_redis_conn, {"testers": []}, _env_status="setup")
+        autotest_server.load_settings(1)
+        fake_redis_conn.set("autotest:settings_spec:1:1", json.dumps({"testers": [1]}))
+        assert autotest_server.load_settings(1)["testers"] == [1]
+
+    def test_missing_spec_not_cached(self, fake_redis_conn):
+        fake_redis_conn.hset("autotest:settings:1", mapping={"_version": 1, "_env_status": "ready"})
+        assert autotest_server.load_settings(1) == {"_version": 1, "_env_status": "ready"}
+        assert "1" not in autotest_server._SETTINGS_CACHE
+
+    def test_new_version_loaded(self, fake_redis_conn):
+        self._set_settings(fake_redis_conn, {"testers": []}, _env_status="ready")
+        autotest_server.load_settings(1)
+        self._set_settings(fake_redis_conn, {"testers": [1]}, version=2, _env_status="ready")
+        assert autotest_server.load_settings(1)["testers"] == [1]
+
+    def test_save_settings(self, fake_redis_conn):
+        self._set_settings(fake_redis_conn, {}, _error="old")
+        autotest_server._save_settings(1, 1, {"testers": [], "_files": "x", "_user": "a", "_env_status": "ready"})
+        assert json.loads(fake_redis_conn.get("autotest:settings_spec:1:1")) == {"testers": [], "_files": "x"}
+        assert fake_redis_conn.hgetall("autotest:settings:1") == {
+            b"_user": b"a",
+            b"_env_status": b"ready",
+            b"_version": b"1",
+        }
+
+    def test_save_outdated_settings(self, fake_redis_conn):
+        self._set_settings(fake_redis_conn, {"testers": [2]}, version=2, _env_status="setup")
+        autotest_server._save_settings(1, 1, {"testers": [1], "_env_status": "ready"})
+        assert fake_redis_conn.hget("autotest:settings:1", "_env_status") == b"setup"
+        assert not fake_redis_conn.exists("autotest:settings_spec:1:1")
+
+    def test_invalidate_settings(self, fake_redis_conn):
+        self._set_settings(fake_redis_conn, {"testers": []}, _env_status="ready")
+        autotest_server.load_settings(1)
+        fake_redis_conn.set("autotest:settings_spec:1:1", json.dumps({"testers": [1]}))
+        autotest_server.invalidate_settings(1)
+        assert autotest_server.load_settings(1)["testers"] == [1]
+
+    def test_prepare_settings(self, fake_redis_conn):
+        self._set_settings(fake_redis_conn, {"testers": [{"tester_type": "py"}], "_files": "x"}, _env_status="ready")
+        autotest_server._create_test_script_command.cache_clear()
+        autotest_server.prepare_settings(1, fake_redis_conn)
+        assert "1" in autotest_server._SETTINGS_CACHE
+        assert autotest_server._create_test_script_command.cache_info().currsize == 1
+
+    def test_prepare_settings_evicts_incomplete_settings(self, fake_redis_conn):
+        self._set_settings(fake_redis_conn, {"testers": []}, _env_status="ready")
+        with pytest.raises(Exception):
+            autotest_server.prepare_settings(1, fake_redis_conn)
+        assert "1" not in autotest_server._SETTINGS_CACHE
+
+    def test_prepare_settings_interleaved_with_version_bump(self, fake_redis_conn):
+        self._set_settings(fake_redis_conn, {"testers": [], "_files": "x"}, _env_status="ready")
+        autotest_server.prepare_settings(1, fake_redis_conn)
+        # a worker loads the settings after the version is bumped but before the new spec is written
+        fake_redis_conn.hincrby("autotest:settings:1", "_version", 1)
+        with pytest.raises(Exception):
+            autotest_server.prepare_settings(1, fake_redis_conn)
+        assert "1" not in autotest_server._SETTINGS_CACHE
+        self._set_settings(fake_redis_conn, {"testers": [], "_files": "y"}, version=2, _env_status="ready")
+        autotest_server.prepare_settings(1, fake_redis_conn)
+        assert autotest_server.load_settings(1)["_files"] == "y"
+        assert autotest_server._SETTINGS_CACHE["1"][0] == 2
+
+
+def test_test_script_command_cached():
+    autotest_server._create_test_script_command.cache_clear()
+    autotest_server._resource_settings.cache_clear()
+    with patch("autotest_server.get_resource_settings", return_value=[(6, (300, 300))]) as get_resource_settings:
+        cmd = autotest_server._create_test_script_command("py")
+        assert autotest_server._create_test_script_command("py") == cmd
+        autotest_server._create_test_script_command("pyta")
+    get_resource_settings.assert_called_once()
+    assert "resource_settings=[(6, (300, 300))]" in cmd
+    autotest_server._create_test_script_command.cache_clear()
+    autotest_server._resource_settings.cache_clear()
@@ -0,0 +1,179 @@
+import json
+import os
+import re
+import subprocess
+from unittest.mock import patch, MagicMock
+
+import fakeredis
+import jsonschema
+import pytest
+
+import autotest_server
+from autotest_server.cgroups import TestCgroup, limit_values
+
+
+@pytest.fixture
+def cgroup(tmp_path):
+    yield TestCgroup(str(tmp_path), "testuser")
+
+
+def test_creates_cgroup(tmp_path, cgroup):
+    assert os.path.dirname(cgroup.path) == str(tmp_path)
+    assert os.path.basename(cgroup.path).startswith("testuser-")
+    assert os.path.isdir(cgroup.path)
+
+
+def test_wrap_command_moves_shell_to_cgroup(cgroup):
+    out = subprocess.run(cgroup.wrap_command("echo $$"), shell=True, executable="/bin/bash", capture_output=True)
+    with open(os.path.join(cgroup.path, "cgroup.procs")) as f:
+        assert f.read().strip() == out.stdout.decode().strip()
+
+
+def test_kill_writes_cgroup_kill(cgroup):
+    with open(os.path.join(cgroup.path, "cgroup.kill"), "w"):
+        pass
+    cgroup.kill()
+    with open(os.path.join(cgroup.path, "cgroup.kill")) as f:
+        assert f.read() == "1"
+
+
+def test_kill_without_cgroup_kill(cgroup):
+    proc = subprocess.Popen(["sleep", "60"])
+    with open(os.path.join(cgroup.path, "cgroup.procs"), "w") as f:
+        f.write(f"{proc.pid}\n")
+    cgroup.kill()
+    assert proc.wait(timeout=5) == -9
+
+
+def test_kill_without_cgroup_kill_as_test_user(tmp_path):
+    cgroup = TestCgroup(str(tmp_path), "testuser", user="testuser")
+    with open(os.path.join(cgroup.path, "cgroup.procs"), "w") as f:
+        f.write("123\n456\n")
+    with patch("os.kill", side_effect=[PermissionError, ProcessLookupError]), patch(
+        "autotest_server.cgroups.subprocess.run"
+    ) as run:
+        cgroup.kill()
+    assert run.call_args.args[0] == ["sudo", "-u", "testuser", "--", "kill", "-KILL", "123"]
+
+
+def test_kill_without_cgroup_kill_permission_denied(cgroup):
+    with open(os.path.join(cgroup.path, "cgroup.procs"), "w") as f:
+        f.write("123\n")
+    with patch("os.kill", side_effect=PermissionError), patch("autotest_server.cgroups.subprocess.run") as run:
+        cgroup.kill()
+    run.assert_not_called()
+
+
+def test_stats(cgroup):
+    with open(os.path.join(cgroup.path, "memory.peak"), "w") as f:
+        f.write("1048576\n")
+    with open(os.path.join(cgroup.path, "cpu.stat"), "w") as f:
+        f.write("usage_usec 3500000\nuser_usec 2500000\nsystem_usec 1000000\nnr_periods 0\n")
+    assert cgroup.stats() == {"memory_peak_bytes": 1048576, "cpu_user_seconds": 2.5, "cpu_system_seconds": 1.0}
+
+
+def test_stats_missing_files(cgroup):
+    assert cgroup.stats() == {}
+
+
+def test_remove(cgroup):
+    cgroup.remove()
+    assert not os.path.exists(cgroup.path)
+
+
+def _run_test_group(tmp_path, proc, settings=None, stats=None):
+    test_data = {"category": ["unit"], "timeout": 30, "extra_info": {"name": "test group"}}
+    with patch("autotest_server._create_test_script_command", return_value="echo test"), patch(
+        "autotest_server._get_env_vars", return_value={}
+    ), patch("autotest_server._update_env_vars", side_effect=lambda b, t: {**b, **t}), patch(
+        "autotest_server.subprocess.Popen", return_value=proc
+    ) as popen, patch(
+        "autotest_server._get_feedback", return_value=([], [])
+    ), patch(
+        "autotest_server._kill_test_processes"
+    ) as kill, patch.object(
+        autotest_server, "config", {"cgroups": settings or {"root": str(tmp_path)}}
+    ), patch.object(
+        TestCgroup, "stats", return_value=stats or {"cpu_user_seconds": 1.0}
+    ), patch.object(
+        TestCgroup, "kill"
+    ) as cgroup_kill:
+        result = autotest_server._run_test_group(
+            "echo {}", {"tester_type": "py"}, test_data, "/tmp/test", "testuser", 1, {}
+        )
+    return result, popen, kill, cgroup_kill
+
+
+def test_run_test_group_in_cgroup(tmp_path):
+    proc = MagicMock(returncode=0)
+    proc.communicate.return_value = ('{"tests": []}', "")
+    result, popen, _, cgroup_kill = _run_test_group(tmp_path, proc)
+    assert re.fullmatch(rf"echo \$\$ > {tmp_path}/testuser-\w+/cgroup.procs && echo echo test", popen.call_args.args[0])
+    cgroup_kill.assert_called_once()
+    assert os.listdir(tmp_path) == []
+    assert result["extra_info"] == {"name": "test group", "resource_usage": {"cpu_user_seconds": 1.0}}
+
+
+def test_run_test_group_timeout_kills_cgroup(tmp_path):
+    proc = MagicMock(returncode=-9)
+    proc.communicate.side_effect = [subprocess.TimeoutExpired("cmd", 30), ("", "Killed\n")]
+    result, _, kill, cgroup_kill = _run_test_group(tmp_path, proc)
+    kill.assert_not_called()
+    assert cgroup_kill.call_count == 2
+    assert result["timeout"] == 30
+    assert "did not complete within time limit" in result["stderr"]
+
+
+def test_limit_values():
+    assert limit_values() == {}
+    assert limit_values(memory_max=1024, cpu_max=1.5, pids_max=50) == {
+        "memory.max": "1024",
+        "memory.swap.max": "0",
+        "cpu.max": "150000 100000",
+        "pids.max": "50",
+    }
+
+
+def test_creates_cgroup_with_limits(tmp_path):
+    cgroup = TestCgroup(str(tmp_path), "testuser", memory_max=1024, pids_max=50)
+    with open(os.path.join(cgroup.path, "memory.max")) as f:
+        assert f.read() == "1024"
+    with open(os.path.join(cgroup.path, "pids.max")) as f:
+        assert f.read() == "50"
+    assert not os.path.exists(os.path.join(cgroup.path, "cpu.max"))
+
+
+def test_stats_oom_kills(cgroup):
+    with open(os.path.join(cgroup.path, "memory.events"), "w") as f:
+        f.write("low 0\nhigh 0\nmax 4\noom 1\noom_kill 2\n")
+    assert cgroup.stats() == {"oom_kills": 2}
+
+
+def test_run_test_group_out_of_memory(tmp_path):
+    proc = MagicMock(returncode=-9)
+    proc.communicate.return_value = ("", "Killed\n")
+    settings = {"root": str(tmp_path), "memory_max": 1024}
+    result, *_ = _run_test_group(tmp_path, proc, settings, {"oom_kills": 1})
+    assert result["stderr"] == "Tests for test group ran out of memory (limit 1024 bytes)\n"
+    assert result["extra_info"]["resource_usage"] == {"oom_kills": 1}
+
+
+def test_record_killed_groups():
+    results = [
+        {"timeout": 30, "extra_info": {}},
+        {"timeout": None, "extra_info": {"resource_usage": {"oom_kills": 1}}},
+        {"timeout": None, "extra_info": {"resource_usage": {"oom_kills": 0}}},
+    ]
+    conn = fakeredis.FakeStrictRedis()
+    with patch("autotest_server.redis_connection", return_value=conn):
+        autotest_server._record_killed_groups(results)
+        autotest_server._record_killed_groups(results[2:])
+    assert conn.hgetall(autotest_server.KILLED_GROUPS_KEY) == {b"timeout": b"1", b"oom": b"1"}
+
+
+@pytest.mark.parametrize("warm_runners, valid", [(True, False), (False, True)])
+def test_cgroups_rejected_with_warm_runners(warm_runners, valid):
+    with open(os.path.join(os.path.dirname(autotest_server.__file__), "settings_schema.json")) as f:
+        validator = jsonschema.Draft7Validator(json.load(f))
+    settings = {"warm_runners": warm_runners, "cgroups": {"root": "/sys/fs/cgroup/autotest"}}
+    assert validator.is_valid(settings) is valid
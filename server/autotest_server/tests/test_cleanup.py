@@ -0,0 +1,98 @@
+import getpass
+import os
+from unittest.mock import patch
+
+import autotest_server
+from autotest_server.cleanup import clear_directory, clear_tmp
+
+
+def _make_tree(path):
+    (path / "a" / "b").mkdir(parents=True)
+    (path / "a" / "b" / "c.txt").write_text("c")
+    (path / ".hidden").write_text("hidden")
+    (path / "link").symlink_to(path / "a")
+    (path / "locked").mkdir()
+    (path / "locked" / "d.txt").write_text("d")
+    os.chmod(path / "locked", 0o000)
+    os.chmod(path / "a", 0o1770)
+
+
+class TestClearDirectory:
+    def test_removes_contents(self, tmp_path):
+        _make_tree(tmp_path)
+        assert clear_directory(str(tmp_path)) == []
+        assert os.listdir(tmp_path) == []
+
+    def test_does_not_follow_symlinks(self, tmp_path):
+        (tmp_path / "target").mkdir()
+        (tmp_path / "target" / "keep.txt").write_text("keep")
+        (tmp_path / "dir").mkdir()
+        (tmp_path / "dir" / "link").symlink_to(tmp_path / "target")
+        clear_directory(str(tmp_path / "dir"))
+        assert (tmp_path / "target" / "keep.txt").exists()
+
+    def test_missing_directory(self, tmp_path):
+        assert clear_directory(str(tmp_path / "missing")) == []
+
+    def test_reports_entries_not_removed(self, tmp_path):
+        _make_tree(tmp_path)
+        with patch("autotest_server.cleanup.os.unlink", side_effect=PermissionError):
+            not_removed = clear_directory(str(tmp_path))
+        assert sorted(not_removed) == sorted(str(tmp_path / p) for p in (".hidden", "a", "link", "locked"))
+
+    def test_clear_tmp(self, tmp_path):
+        _make_tree(tmp_path)
+        clear_tmp(str(tmp_path))
+        assert os.listdir(tmp_path) == []
+
+
+class TestClearWorkingDirectory:
+    def test_moves_entries_not_removed_to_trash(self, tmp_path):
+        tests_path = tmp_path / "tests"
+        trash = tmp_path / "trash"
+        tests_path.mkdir()
+        (tests_path / "a.txt").write_text("a")
+        with patch.object(autotest_server, "TRASH_DIR", str(trash)), patch("autotest_server.clear_tmp"), patch(
+            "autotest_server.clear_directory",
+            side_effect=lambda p: [str(tests_path / "a.txt")] if p == str(tests_path) else [],
+        ), patch("autotest_server._clear_trash") as clear_trash:
+            autotest_server._clear_working_directory(str(tests_path), getpass.getuser())
+        assert os.listdir(tests_path) == []
+        assert len(os.listdir(trash)) == 1
+        clear_trash.assert_called_once_with(getpass.getuser())
+
+    def test_helper_is_run_as_test_user(self, tmp_path):
+        with patch.object(autotest_server, "CLEANUP_HELPER", str(tmp_path / "cleanup.py")), patch(
+            "autotest_server.subprocess.run"
+        ) as run, patch("autotest_server._clear_trash"):
+            autotest_server._cleanup_helper.cache_clear()
+            run.return_value.returncode = 0
+            autotest_server._clear_working_directory(str(tmp_path / "tests"), "someone-else")
+        autotest_server._cleanup_helper.cache_clear()
+        assert (
+            run.call_args[0][0] == f"sudo -u someone-else -- python3 -I {tmp_path / 'cleanup.py'} {tmp_path / 'tests'}"
+        )
+        with open(autotest_server.cleanup.__file__) as f1, open(tmp_path / "cleanup.py") as f2:
+            assert f1.read() == f2.read()
+        assert os.stat(tmp_path / "cleanup.py").st_mode & 0o777 == 0o644
+
+
+class TestClearTrash:
+    def test_trash_is_cleared_in_background(self, tmp_path):
+        trash = tmp_path / "trash"
+        (trash / "old").mkdir(parents=True)
+        (trash / "old" / "a.txt").write_text("a")
+        with patch.object(autotest_server, "TRASH_DIR", str(trash)):
+            proc = autotest_server._clear_trash(getpass.getuser())
+        assert proc.wait(timeout=30) == 0
+        assert os.listdir(trash) == []
+
+    def test_only_one_cleanup_runs_at_a_time(self, tmp_path):
+        trash = tmp_path / "trash"
+        with patch.object(autotest_server, "TRASH_DIR", str(trash)), patch.object(
+            autotest_server.sys, "executable", "sleep 2;"
+        ):
+            proc = autotest_server._clear_trash(getpass.getuser())
+            assert autotest_server._clear_trash(getpass.getuser()) is None
+            proc.wait(timeout=30)
+            autotest_server._clear_trash(getpass.getuser()).wait(timeout=30)
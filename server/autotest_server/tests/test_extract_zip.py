@@ -0,0 +1,41 @@
+import io
+import zipfile
+
+import pytest
+
+from autotest_server.utils import extract_zip_stream, ArchiveLimitError
+
+
+def _zip(files):
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        for name, content in files.items():
+            zf.writestr(name, content)
+    buf.seek(0)
+    return buf
+
+
+class TestExtractZipStream:
+    def test_extract_from_bytes(self, tmp_path):
+        extract_zip_stream(_zip({"a.txt": "abc"}).read(), str(tmp_path))
+        assert (tmp_path / "a.txt").read_text() == "abc"
+
+    def test_extract_from_file(self, tmp_path):
+        extract_zip_stream(_zip({"a.txt": "abc", "d/b.txt": "def", "e/": ""}), str(tmp_path))
+        assert (tmp_path / "a.txt").read_text() == "abc"
+        assert (tmp_path / "d" / "b.txt").read_text() == "def"
+        assert (tmp_path / "e").is_dir()
+
+    def test_within_limits(self, tmp_path):
+        extract_zip_stream(_zip({"a.txt": "abc", "b.txt": "def"}), str(tmp_path), max_size=6, max_members=2)
+        assert sorted(p.name for p in tmp_path.iterdir()) == ["a.txt", "b.txt"]
+
+    def test_too_many_members(self, tmp_path):
+        with pytest.raises(ArchiveLimitError):
+            extract_zip_stream(_zip({"a.txt": "abc", "b.txt": "def"}), str(tmp_path), max_members=1)
+        assert not list(tmp_path.iterdir())
+
+    def test_too_large(self, tmp_path):
+        with pytest.raises(ArchiveLimitError):
+            extract_zip_stream(_zip({"a.txt": "a" * 100}), str(tmp_path), max_size=99)
+        assert not list(tmp_path.iterdir())
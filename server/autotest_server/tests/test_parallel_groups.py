@@ -0,0 +1,87 @@
+import threading
+import time
+import unittest
+from unittest.mock import patch
+
+import autotest_server
+
+
+class TestParallelGroups(unittest.TestCase):
+    """Tests for running test groups in parallel in _run_test_specs."""
+
+    @staticmethod
+    def _make_settings(n_groups, max_parallel_groups=None):
+        test_data = [{"category": ["unit"], "extra_info": {"name": f"group {i}"}} for i in range(n_groups)]
+        settings = {"testers": [{"tester_type": "py", "test_data": test_data}]}
+        if max_parallel_groups is not None:
+            settings["max_parallel_groups"] = max_parallel_groups
+        return settings
+
+    def _run(self, test_settings, worker_config=None):
+        lock = threading.Lock()
+        running = []
+        max_running = []
+
+        def fake_run_test_group(cmd, settings, test_data, *args, **kwargs):
+            name = test_data["extra_info"]["name"]
+            with lock:
+                running.append(name)
+                max_running.append(len(running))
+            # later groups finish first
+            time.sleep(0.05 * (len(settings["test_data"]) - int(name.split()[-1])))
+            with lock:
+                running.remove(name)
+            return {"extra_info": test_data["extra_info"], "args": args}
+
+        workers = worker_config or [{"user": "testuser", "queues": ["high"]}]
+        with patch("autotest_server._run_test_group", side_effect=fake_run_test_group), patch.object(
+            autotest_server, "config", {"workers": workers}
+        ):
+            results = autotest_server._run_test_specs(
+                cmd="echo {}",
+                test_settings=test_settings,
+                categories=["unit"],
+                tests_path="/tmp/test",
+                test_username="testuser",
+                test_id=1,
+                test_env_vars={},
+            )
+        return results, max(max_running)
+
+    def test_sequential_by_default(self):
+        results, max_running = self._run(self._make_settings(4))
+        self.assertEqual(max_running, 1)
+        self.assertEqual(len(results), 4)
+
+    def test_runs_groups_in_parallel(self):
+        _, max_running = self._run(self._make_settings(4, max_parallel_groups=4))
+        self.assertGreater(max_running, 1)
+
+    def test_parallel_is_bounded(self):
+        _, max_running = self._run(self._make_settings(6, max_parallel_groups=2))
+        self.assertLessEqual(max_running, 2)
+
+    def test_result_order_is_stable(self):
+        results, _ = self._run(self._make_settings(4, max_parallel_groups=4))
+        self.assertEqual([r["extra_info"]["name"] for r in results], [f"group {i}" for i in range(4)])
+
+    def test_sequential_with_postgresql(self):
+        workers = [{"user": "testuser", "queues": ["high"], "resources": {"postgresql_url": "postgresql://"}}]
+        _, max_running = self._run(self._make_settings(4, max_parallel_groups=4), worker_config=workers)
+        self.assertEqual(max_running, 1)
+
+
+class TestReservedPorts(unittest.TestCase):
+    """Tests for assigning a distinct PORT to concurrent test groups."""
+
+    def test_ports_are_distinct(self):
+        workers = [{"user": "testuser", "queues": ["high"], "resources": {"port": {"min": 50000, "max": 50100}}}]
+        reserved = set()
+        with patch.object(autotest_server, "config", {"workers": workers}):
+            ports = [autotest_server._get_env_vars("testuser", reserved)["PORT"] for _ in range(3)]
+        self.assertEqual(len(set(ports)), 3)
+        self.assertEqual(reserved, set(ports))
+
+    def test_excluded_port_is_skipped(self):
+        port = autotest_server.get_available_port(50000, 50100)
+        self.assertNotEqual(autotest_server.get_available_port(50000, 50100, exclude={port}), port)
@@ -0,0 +1,112 @@
+import os
+import stat
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+import autotest_server
+from autotest_server.runners import RunnerPool, WarmRunnerError
+
+
+@pytest.fixture
+def tests_path(tmp_path):
+    script = tmp_path / "test.sh"
+    script.write_text('#!/bin/bash\necho "{\\"name\\": \\"$TEST_NAME\\", \\"pid\\": $PPID}"\n')
+    script.chmod(script.stat().st_mode | stat.S_IEXEC)
+    sleep_script = tmp_path / "sleep.sh"
+    sleep_script.write_text("#!/bin/bash\nsleep 10\n")
+    sleep_script.chmod(sleep_script.stat().st_mode | stat.S_IEXEC)
+    yield str(tmp_path)
+
+
+@pytest.fixture
+def pool(tests_path):
+    pool = RunnerPool(autotest_server._create_runner_command, tests_path)
+    yield pool
+    pool.close()
+
+
+def _env(**kwargs):
+    return {**os.environ, "PYTHON": sys.executable, **kwargs}
+
+
+def _specs(script):
+    return {"tester_type": "custom", "test_data": {"script_files": [script]}}
+
+
+def _not_timed_out(proc):
+    pytest.fail(f"test group run by runner {proc.pid} timed out")
+
+
+class TestRunnerPool:
+    def test_runs_test_group(self, pool):
+        out, err, returncode = pool.run("custom", _env(TEST_NAME="a"), _specs("test.sh"), 10, on_timeout=_not_timed_out)
+        assert '"name": "a"' in out
+        assert returncode == 0
+
+    def test_reuses_runner(self, pool):
+        pool.run("custom", _env(TEST_NAME="a"), _specs("test.sh"), 10, on_timeout=_not_timed_out)
+        pool.run("custom", _env(TEST_NAME="b"), _specs("test.sh"), 10, on_timeout=_not_timed_out)
+        assert len(pool._runners) == 1
+
+    def test_group_env_is_not_shared(self, pool):
+        pool.run("custom", _env(TEST_NAME="a"), _specs("test.sh"), 10, on_timeout=_not_timed_out)
+        out, _, _ = pool.run("custom", _env(TEST_NAME="b"), _specs("test.sh"), 10, on_timeout=_not_timed_out)
+        assert '"name": "b"' in out
+
+    def test_group_env_not_set_is_unset(self, pool):
+        pool.run("custom", _env(TEST_NAME="a"), _specs("test.sh"), 10, on_timeout=_not_timed_out)
+        out, _, _ = pool.run("custom", _env(), _specs("test.sh"), 10, on_timeout=_not_timed_out)
+        assert '"name": ""' in out
+        assert len(pool._runners) == 1
+
+    def test_timeout(self, pool):
+        killed = []
+
+        def on_timeout(proc):
+            killed.append(proc)
+            proc.kill()
+
+        with pytest.raises(subprocess.TimeoutExpired):
+            pool.run("custom", _env(), _specs("sleep.sh"), 1, on_timeout=on_timeout)
+        assert len(killed) == 1
+
+    def test_runner_not_reused_after_timeout(self, pool):
+        with pytest.raises(subprocess.TimeoutExpired):
+            pool.run("custom", _env(), _specs("sleep.sh"), 1, on_timeout=lambda p: p.kill())
+        pool.run("custom", _env(TEST_NAME="a"), _specs("test.sh"), 10, on_timeout=_not_timed_out)
+        assert len(pool._runners) == 2
+
+    def test_runner_import_error(self, pool):
+        with pytest.raises(WarmRunnerError):
+            # the runner may not have exited yet when its error is read
+            pool.run("not_a_tester", _env(), _specs("test.sh"), 10, on_timeout=lambda p: p.kill())
+
+    def test_interrupt(self, pool):
+        killed = []
+        errors = []
+
+        def on_timeout(proc):
+            killed.append(proc)
+            proc.kill()
+
+        def run():
+            try:
+                pool.run("custom", _env(), _specs("sleep.sh"), 30, on_timeout=on_timeout)
+            except WarmRunnerError as e:
+                errors.append(e)
+
+        thread = threading.Thread(target=run)
+        start = time.monotonic()
+        thread.start()
+        while not pool._busy:
+            time.sleep(0.01)
+        pool.interrupt()
+        thread.join()
+        assert time.monotonic() - start < 10
+        assert len(killed) == 1
+        assert len(errors) == 1
+        assert not pool._busy
@@ -0,0 +1,107 @@
+from unittest.mock import patch
+
+import fakeredis
+import pytest
+import redis
+import rq
+
+from autotest_server import scheduler
+from autotest_server.worker import AutotestWorker
+
+
+@pytest.fixture
+def conn():
+    yield fakeredis.FakeStrictRedis()
+
+
+def _schedule(conn, settings_id, job_ids, vtime=0, deadline=None):
+    queue = rq.Queue("batch", connection=conn)
+    for job_id in job_ids:
+        queue.create_job("autotest_server.run_test", job_id=job_id).save()
+    conn.rpush(scheduler.JOBS_KEY.format(settings_id), *job_ids)
+    conn.zadd(scheduler.TENANTS_KEY, {settings_id: vtime}, nx=True)
+    if deadline is not None:
+        conn.zadd(scheduler.DEADLINES_KEY, {settings_id: deadline})
+
+
+def test_batch_queue_depth():
+    workers = [
+        {"user": "a", "queues": ["high", "batch"], "concurrency": 3},
+        {"user": "b", "queues": ["batch"]},
+        {"user": "c", "queues": ["high"], "concurrency": 5},
+    ]
+    assert scheduler.batch_queue_depth(workers) == 4
+    assert scheduler.batch_queue_depth(workers[2:]) == 1
+
+
+def test_dispatch_fills_batch_queue(conn):
+    _schedule(conn, "1", ["1", "2", "3"])
+    assert scheduler.dispatch(conn, 2) == 2
+    assert conn.lrange(scheduler.BATCH_QUEUE_KEY, 0, -1) == [b"1", b"2"]
+    assert conn.sismember(scheduler.RQ_QUEUES_KEY, scheduler.BATCH_QUEUE_KEY)
+
+
+def test_dispatch_stores_depth(conn):
+    _schedule(conn, "1", ["1", "2", "3"])
+    scheduler.dispatch(conn, 2)
+    conn.delete(scheduler.BATCH_QUEUE_KEY)
+    assert scheduler.dispatch(conn) == 1
+    assert conn.hget(scheduler.CONFIG_KEY, "depth") == b"2"
+
+
+def test_dispatch_alternates_settings(conn):
+    _schedule(conn, "1", ["1", "2", "3"])
+    _schedule(conn, "2", ["4", "5"])
+    scheduler.dispatch(conn, 10)
+    assert conn.lrange(scheduler.BATCH_QUEUE_KEY, 0, -1) == [b"1", b"4", b"2", b"5", b"3"]
+    assert not conn.exists(scheduler.TENANTS_KEY)
+
+
+def test_dispatch_deadline_outside_window(conn):
+    _schedule(conn, "1", ["1", "2"])
+    _schedule(conn, "2", ["3", "4"], deadline=4102444800)
+    scheduler.dispatch(conn, 10)
+    assert conn.lrange(scheduler.BATCH_QUEUE_KEY, 0, -1) == [b"1", b"3", b"2", b"4"]
+
+
+def test_backlog(conn):
+    _schedule(conn, "1", ["1", "2", "3"])
+    _schedule(conn, "2", ["4"], deadline=100)
+    assert scheduler.backlog(conn) == [("1", 3, None), ("2", 1, 100.0)]
+
+
+def test_dispatch_declares_keys(conn):
+    _schedule(conn, "1", ["1", "2"])
+    _schedule(conn, "2", ["3"])
+    calls = []
+    script_call = redis.commands.core.Script.__call__
+
+    def call(self, keys=(), args=(), client=None):
+        calls.append(list(keys))
+        return script_call(self, keys=keys, args=args, client=client)
+
+    with patch.object(redis.commands.core.Script, "__call__", call):
+        assert scheduler.dispatch(conn, 10) == 3
+    declared = {key for keys in calls for key in keys}
+    for settings_id, job_id in (("1", "1"), ("1", "2"), ("2", "3")):
+        assert scheduler.JOBS_KEY.format(settings_id) in declared
+        assert scheduler.RQ_JOB_KEY.format(job_id) in declared
+
+
+def test_store_script(conn):
+    scheduler.store_script(conn)
+    assert conn.get(scheduler.SCRIPT_KEY).decode() == scheduler.DISPATCH_SCRIPT
+
+
+def test_worker_dispatches_after_killed_test_job(conn):
+    _schedule(conn, "1", ["1", "2"])
+    scheduler.dispatch(conn, 1)
+    conn.delete(scheduler.BATCH_QUEUE_KEY)
+    worker = AutotestWorker(["batch"], connection=conn)
+    job = rq.job.Job.create("autotest_server.run_test", kwargs={"settings_id": 1}, connection=conn)
+    with patch("autotest_server.worker.prepare_settings"), patch.object(
+        rq.Worker, "execute_job", side_effect=Exception("work horse killed")
+    ):
+        with pytest.raises(Exception):
+            worker.execute_job(job, rq.Queue("batch", connection=conn))
+    assert conn.lrange(scheduler.BATCH_QUEUE_KEY, 0, -1) == [b"2"]
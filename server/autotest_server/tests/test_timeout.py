@@ -1,8 +1,13 @@
+import getpass
 import signal
 import subprocess
+import tempfile
+import time
 import unittest
 from unittest.mock import patch, MagicMock, ANY
 
+from rq.timeouts import JobTimeoutException, UnixSignalDeathPenalty
+
 import autotest_server
 
 _UNSET = object()
@@ -269,3 +274,67 @@ class TestTimeoutKillHandler(unittest.TestCase):
                 test_env_vars={},
             )
         self.assertIn("did not complete within time limit", results[0]["stderr"])
+
+
+class TestJobTimeout(unittest.TestCase):
+    """Tests for stopping test groups when the job times out while they are running."""
+
+    @staticmethod
+    def _make_settings(n_groups, max_parallel_groups=None):
+        test_data = [{"category": ["unit"], "extra_info": {"name": f"group {i}"}} for i in range(n_groups)]
+        settings = {"testers": [{"tester_type": "py", "test_data": test_data}]}
+        if max_parallel_groups is not None:
+            settings["max_parallel_groups"] = max_parallel_groups
+        return settings
+
+    def test_sequential_group_killed_and_exception_raised(self):
+        mock_proc = MagicMock()
+        mock_proc.communicate.side_effect = JobTimeoutException("job timed out")
+
+        with patch("autotest_server._create_test_script_command", return_value="echo test"), patch(
+            "autotest_server._get_env_vars", return_value={}
+        ), patch("autotest_server._update_env_vars", side_effect=lambda b, t: {**b, **t}), patch(
+            "autotest_server.subprocess.Popen", return_value=mock_proc
+        ) as mock_popen, patch(
+            "autotest_server._get_feedback", return_value=([], [])
+        ), patch(
+            "autotest_server.getpass.getuser", return_value="autotest"
+        ), patch(
+            "autotest_server._kill_user_processes"
+        ) as mock_kill_user, patch.object(
+            autotest_server, "config", {"workers": [{"user": "autotst0", "queues": ["high"]}]}
+        ):
+            with self.assertRaises(JobTimeoutException):
+                autotest_server._run_test_specs(
+                    cmd="echo {}",
+                    test_settings=self._make_settings(2),
+                    categories=["unit"],
+                    tests_path="/tmp/test",
+                    test_username="autotst0",
+                    test_id=1,
+                    test_env_vars={},
+                )
+        mock_kill_user.assert_called_once_with("autotst0")
+        mock_popen.assert_called_once()
+        self.assertEqual(autotest_server._RUNNING_GROUPS, set())
+
+    def test_parallel_groups_killed_and_exception_raised(self):
+        user = getpass.getuser()
+        start = time.monotonic()
+        with patch("autotest_server._create_test_script_command", return_value="sleep 30"), patch(
+            "autotest_server._get_env_vars", return_value={}
+        ), patch("autotest_server._get_feedback", return_value=([], [])), patch.object(
+            autotest_server, "config", {"workers": [{"user": user, "queues": ["high"]}]}
+        ):
+            with self.assertRaises(JobTimeoutException), UnixSignalDeathPenalty(1, JobTimeoutException):
+                autotest_server._run_test_specs(
+                    cmd="{}",
+                    test_settings=self._make_settings(2, max_parallel_groups=2),
+                    categories=["unit"],
+                    tests_path=tempfile.gettempdir(),
+                    test_username=user,
+                    test_id=1,
+                    test_env_vars={},
+                )
+        self.assertLess(time.monotonic() - start, 10)
+        self.assertEqual(autotest_server._RUNNING_GROUPS, set())
@@ -0,0 +1,74 @@
+import os
+import time
+
+import pytest
+
+from autotest_server.utils import copy_tree, clone_file, PhaseTimer
+
+
+@pytest.fixture
+def src_tree(tmp_path):
+    src = tmp_path / "src"
+    (src / "sub").mkdir(parents=True)
+    (src / "a.txt").write_text("abc")
+    (src / "sub" / "b.txt").write_text("def")
+    os.chmod(src / "a.txt", 0o755)
+    os.chmod(src / "sub" / "b.txt", 0o755)
+    yield src
+
+
+class TestCopyTree:
+    def test_clone_file(self, tmp_path):
+        (tmp_path / "a").write_text("abc")
+        os.chmod(tmp_path / "a", 0o640)
+        clone_file(str(tmp_path / "a"), str(tmp_path / "b"))
+        assert (tmp_path / "b").read_text() == "abc"
+        assert os.stat(tmp_path / "b").st_mode == os.stat(tmp_path / "a").st_mode
+
+    def test_copy(self, src_tree, tmp_path):
+        copied = copy_tree(str(src_tree), str(tmp_path / "dst"))
+        assert (tmp_path / "dst" / "sub" / "b.txt").read_text() == "def"
+        assert os.stat(tmp_path / "dst" / "a.txt").st_ino != os.stat(src_tree / "a.txt").st_ino
+        assert sorted(fd for fd, _ in copied) == ["d", "f", "f"]
+
+    def test_link(self, src_tree, tmp_path):
+        copied = copy_tree(str(src_tree), str(tmp_path / "dst"), link=True)
+        assert (tmp_path / "dst" / "sub" / "b.txt").read_text() == "def"
+        assert os.stat(tmp_path / "dst" / "a.txt").st_ino == os.stat(src_tree / "a.txt").st_ino
+        assert sorted(fd for fd, _ in copied) == ["d", "l", "l"]
+
+    @pytest.mark.parametrize("mode", [0o644, 0o750, 0o775, 0o757])
+    def test_link_copies_files_that_cannot_be_shared(self, src_tree, tmp_path, mode):
+        os.chmod(src_tree / "a.txt", mode)
+        copied = copy_tree(str(src_tree), str(tmp_path / "dst"), link=True)
+        assert os.stat(tmp_path / "dst" / "a.txt").st_ino != os.stat(src_tree / "a.txt").st_ino
+        assert sorted(fd for fd, _ in copied) == ["d", "f", "l"]
+        assert os.stat(src_tree / "a.txt").st_mode & 0o777 == mode
+
+    def test_link_replaces_existing(self, src_tree, tmp_path):
+        (tmp_path / "dst").mkdir()
+        (tmp_path / "dst" / "a.txt").write_text("student")
+        copy_tree(str(src_tree), str(tmp_path / "dst"), link=True)
+        assert (tmp_path / "dst" / "a.txt").read_text() == "abc"
+
+
+class TestPhaseTimer:
+    def test_phase(self):
+        timer = PhaseTimer()
+        with timer.phase("a"):
+            time.sleep(0.01)
+        assert timer.to_dict()["a"] >= 0.01
+
+    def test_phases_are_added(self):
+        timer = PhaseTimer()
+        timer.add("a", 1)
+        timer.add("a", 2)
+        timer.add("b", 0.5)
+        assert timer.to_dict() == {"a": 3, "b": 0.5}
+
+    def test_phase_timed_on_error(self):
+        timer = PhaseTimer()
+        with pytest.raises(ValueError):
+            with timer.phase("a"):
+                raise ValueError
+        assert "a" in timer.to_dict()
@@ -0,0 +1,74 @@
+import os
+import unittest
+from unittest.mock import patch
+
+import autotest_server
+
+WORKERS = [
+    {
+        "user": "shared",
+        "queues": ["high"],
+        "concurrency": 4,
+        "resources": {"port": {"min": 50000, "max": 50399}},
+    },
+    {"user": "single", "queues": ["high"]},
+]
+CONFIG = {"workspace": "/workspace", "workers": WORKERS}
+
+
+class TestWorkerSlots(unittest.TestCase):
+    """Tests for running several worker slots for the same worker user."""
+
+    def setUp(self):
+        patcher = patch.object(autotest_server, "config", CONFIG)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        env_patcher = patch.dict(os.environ, {"WORKERSLOT": "2"})
+        env_patcher.start()
+        self.addCleanup(env_patcher.stop)
+
+    def test_shared_user(self):
+        self.assertTrue(autotest_server._shared_user("shared"))
+        self.assertFalse(autotest_server._shared_user("single"))
+
+    def test_slot_port_range(self):
+        self.assertEqual(autotest_server._slot_port_range(50000, 50399, 4), (50200, 50299))
+        self.assertEqual(autotest_server._slot_port_range(50000, 50399, 1), (50000, 50399))
+
+    def test_slot_port_range_without_slot(self):
+        with patch.dict(os.environ):
+            os.environ.pop("WORKERSLOT")
+            self.assertEqual(autotest_server._slot_port_range(50000, 50399, 4), (50000, 50399))
+
+    def test_slot_tmp_dir(self):
+        self.assertEqual(autotest_server._slot_tmp_dir("shared"), "/workspace/workers/shared/tmp/2")
+        self.assertIsNone(autotest_server._slot_tmp_dir("single"))
+
+    def test_env_vars(self):
+        env_vars = autotest_server._get_env_vars("shared")
+        self.assertIn(int(env_vars["PORT"]), range(50200, 50300))
+        self.assertEqual(env_vars["TMPDIR"], "/workspace/workers/shared/tmp/2")
+
+    def test_stop_kills_only_process_groups(self):
+        autotest_server._TEST_PROCESS_GROUPS.add(123)
+        with patch("autotest_server.subprocess.run") as run, patch("autotest_server._kill_user_processes") as kill_user:
+            autotest_server._stop_tester_processes("shared", [456])
+        kill_user.assert_not_called()
+        run.assert_called_once_with("sudo -u shared -- bash -c 'kill -KILL -- -123 -456'", shell=True)
+        self.assertEqual(autotest_server._TEST_PROCESS_GROUPS, set())
+
+    def test_stop_kills_all_processes(self):
+        with patch("autotest_server._kill_user_processes") as kill_user:
+            autotest_server._stop_tester_processes("single")
+        kill_user.assert_called_once_with("single")
+
+    def test_cleanup_keeps_tmp(self):
+        with patch("autotest_server.subprocess.run") as run, patch(
+            "autotest_server.clear_directory", return_value=[]
+        ), patch("autotest_server._clear_trash"), patch(
+            "autotest_server._cleanup_helper", return_value="/workspace/cleanup.py"
+        ):
+            run.return_value.returncode = 0
+            autotest_server._clear_working_directory("/workspace/workers/shared/2", "shared")
+        cmd = run.call_args[0][0]
+        self.assertTrue(cmd.endswith("--keep-tmp /workspace/workers/shared/2 /workspace/workers/shared/tmp/2"))
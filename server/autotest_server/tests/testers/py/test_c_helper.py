@@ -0,0 +1,175 @@
+import os
+import re
+import shutil
+import subprocess
+from collections import defaultdict
+from unittest.mock import patch
+
+import pytest
+
+from ....testers.py.lib import c_helper
+
+LTRACE_LOG = os.path.join(os.path.dirname(__file__), "fixtures", "ltrace_log.txt")
+MAIN = '#include <stdio.h>\n#include "value.h"\nint main(void) { printf("%d", VALUE); return 0; }\n'
+
+
+@pytest.fixture(autouse=True)
+def build_dir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(c_helper, "_BUILD_CACHE", {})
+    with open("main.c", "w") as f:
+        f.write(MAIN)
+    _write_header(1)
+    return tmp_path
+
+
+def _write_header(value):
+    with open("value.h", "w") as f:
+        f.write(f"#define VALUE {value}\n")
+
+
+def _run_main():
+    return subprocess.run(["./main"], capture_output=True, text=True).stdout
+
+
+def test_cached_compile_reuses_executable():
+    result = c_helper._cached_compile(["main.c"], "main")
+    os.remove("main")
+    with patch.object(c_helper, "_compile") as compile_:
+        assert c_helper._cached_compile(["main.c"], "main") == result
+    compile_.assert_not_called()
+    assert _run_main() == "1"
+
+
+def test_cached_compile_rebuilds_when_header_changes():
+    c_helper._cached_compile(["main.c"], "main")
+    _write_header(2)
+    c_helper._cached_compile(["main.c"], "main")
+    assert _run_main() == "2"
+
+
+def test_cached_compile_rebuilds_when_missing_header_is_added():
+    os.remove("value.h")
+    _, err, returncode = c_helper._cached_compile(["main.c"], "main")
+    assert returncode != 0
+    assert "value.h" in err
+    _write_header(3)
+    assert c_helper._cached_compile(["main.c"], "main")[2] == 0
+    assert _run_main() == "3"
+
+
+def test_cached_compile_runs_gcc_once_on_miss():
+    with patch.object(c_helper, "_exec", wraps=c_helper._exec) as exec_:
+        c_helper._cached_compile(["main.c"], "main")
+    assert exec_.call_count == 1
+
+
+def test_cached_compile_missing_source_not_cached():
+    _, _, returncode = c_helper._cached_compile(["missing.c"], "main")
+    assert returncode != 0
+    assert c_helper._BUILD_CACHE == {}
+
+
+def test_cached_make_reuses_output():
+    with open("Makefile", "w") as f:
+        f.write("main: main.c value.h\n\tgcc -o main main.c\n")
+    result = c_helper._cached_make(["main"])
+    with patch.object(c_helper, "_make") as make:
+        assert c_helper._cached_make(["main"]) == result
+    make.assert_not_called()
+
+
+def test_cached_make_reruns_out_of_date_targets():
+    os.mkdir("include")
+    with open("include/value.h", "w") as f:
+        f.write("#define VALUE 1\n")
+    with open("Makefile", "w") as f:
+        f.write("main: main.c include/value.h\n\tgcc -Iinclude -o main main.c\n")
+    os.remove("value.h")
+    c_helper._cached_make(["main"])
+    with open("include/value.h", "w") as f:
+        f.write("#define VALUE 2\n")
+    c_helper._cached_make(["main"])
+    assert _run_main() == "2"
+
+
+def test_generator_reuses_outputs(build_dir):
+    c_helper._compile(["main.c"], "main")
+    os.mkdir("in")
+    os.mkdir("out")
+    with open("in/a.txt", "w") as f:
+        f.write("")
+    generator = c_helper.TestGenerator(input_dir="in", executable_path="./main", out_dir="out")
+    generator.build_outputs()
+    generator.clean()
+    with patch.object(c_helper, "_exec_shell") as exec_shell:
+        generator.build_outputs()
+    exec_shell.assert_not_called()
+    with open("out/a.stdout") as f:
+        assert f.read() == "1"
+
+
+def _reference_parse(raw):
+    """Parse an ltrace log the way Trace did before it parsed the log in a single pass."""
+    lines, process_log = [], defaultdict(list)
+    for line in raw.splitlines():
+        parsed_line = "", "", "", ""
+        for key, regex in c_helper.regex_dict.items():
+            result = re.compile(regex).match(line)
+            if result:
+                parsed_line = list(result.groups())
+                rest = parsed_line[1].split("->", 1)
+                if len(rest) > 1:
+                    parsed_line[1] = rest[1]
+                parsed_line += [None] * (4 - len(parsed_line)) + [key]
+                break
+        if len(parsed_line) < 4 or not parsed_line[0]:
+            continue
+        lines.append(parsed_line)
+        process_log[parsed_line[0]].append(list(parsed_line[1:]))
+    return lines, process_log
+
+
+def _trace():
+    shutil.copy(LTRACE_LOG, c_helper.DEFAULT_LTRACE_LOG_FILE)
+    with patch.object(c_helper, "_exec"):
+        return c_helper.Trace(["./main"])
+
+
+def test_trace_matches_reference_parser():
+    trace = _trace()
+    with open(LTRACE_LOG, "rb") as f:
+        lines, process_log = _reference_parse(f.read().decode(errors="ignore"))
+    assert trace.lines == lines
+    assert trace.process_log == process_log
+    assert trace.first_process == "12345"
+    assert {call[-1] for call in trace.lines} == {"resumed", "unfinished", "no_return", "special", "function_call"}
+
+
+def test_trace_calls():
+    trace = _trace()
+    assert trace.get_status("12345") == 1
+    assert trace.get_status("12346") == 0
+    assert trace.get_status("1") is None
+    assert trace.lines_for_pid("12346", "strlen") == [["strlen", '"abc"', "3", "function_call"]]
+    assert trace.lines_for_pid("12345", "malloc")[0][2] == "0x1c2d2a0"
+    assert trace.lines_for_pid("12345", "calloc") == []
+    assert trace.lines_for_pid("12345") == trace.process_log["12345"]
+
+
+def test_trace_keeps_its_log():
+    trace = _trace()
+    with open(c_helper.DEFAULT_LTRACE_LOG_FILE, "w") as f:
+        f.write("1 +++ exited (status 3) +++\n")
+    assert "café" in trace.raw
+    assert trace.split_lines == trace.raw.splitlines()
+    assert len(trace.split_lines) == 16
+
+
+def test_trace_reads_log_once():
+    shutil.copy(LTRACE_LOG, c_helper.DEFAULT_LTRACE_LOG_FILE)
+    with patch.object(c_helper, "_exec"), patch("builtins.open", wraps=open) as open_:
+        trace = c_helper.Trace(["./main"])
+        assert trace.split_lines is trace.split_lines
+        assert trace.raw is trace.raw
+    assert open_.call_count == 1
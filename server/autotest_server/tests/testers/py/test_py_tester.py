@@ -101,3 +101,108 @@ def test_marks_earned_respected_when_equal_to_total(request, monkeypatch) -> Non
     # marks_earned=2: should get 2 marks, not 0 (TICKET-602)
     assert outputs[2]["marks_earned"] == 2
     assert outputs[2]["marks_total"] == 2
+
+
+def test_multiple_files_single_session(request, monkeypatch) -> None:
+    """Test that the results of files run in a single pytest session are reported with the file they came from."""
+    monkeypatch.chdir(request.fspath.dirname)
+    tester = PyTester(specs=TestSpecs.from_json("""
+        {
+          "test_data": {
+            "script_files": [
+              "fixtures/sample_tests_collection_error.py",
+              "fixtures/sample_tests_skip.py",
+              "fixtures/sample_tests_success.py"
+            ],
+            "category": ["instructor"],
+            "timeout": 30,
+            "tester": "pytest",
+            "output_verbosity": "short",
+            "extra_info": {
+              "criterion": "",
+              "name": "Python Test Group 1"
+            }
+          }
+        }
+    """))
+    results = tester.run_python_tests()
+    assert list(results) == [
+        "fixtures/sample_tests_collection_error.py",
+        "fixtures/sample_tests_skip.py",
+        "fixtures/sample_tests_success.py",
+    ]
+    assert [r["status"] for r in results["fixtures/sample_tests_collection_error.py"]] == ["error"]
+    assert results["fixtures/sample_tests_skip.py"] == []
+    assert [r["status"] for r in results["fixtures/sample_tests_success.py"]] == ["success"]
+
+
+def test_missing_file(request, monkeypatch) -> None:
+    """Test that a missing file is reported as an error without stopping the tests in the other files."""
+    monkeypatch.chdir(request.fspath.dirname)
+    tester = PyTester(specs=TestSpecs.from_json("""
+        {
+          "test_data": {
+            "script_files": ["fixtures/sample_tests_missing.py", "fixtures/sample_tests_success.py"],
+            "category": ["instructor"],
+            "timeout": 30,
+            "tester": "pytest",
+            "output_verbosity": "short"
+          }
+        }
+    """))
+    results = tester.run_python_tests()
+    assert list(results) == ["fixtures/sample_tests_missing.py", "fixtures/sample_tests_success.py"]
+    assert results["fixtures/sample_tests_missing.py"] == [
+        {
+            "status": "error",
+            "name": "[fixtures/sample_tests_missing.py]",
+            "errors": "file not found: fixtures/sample_tests_missing.py",
+            "description": None,
+        }
+    ]
+    assert [r["status"] for r in results["fixtures/sample_tests_success.py"]] == ["success"]
+
+
+def test_parallel_workers(request, monkeypatch) -> None:
+    """Test that files run by parallel workers give the same results as files run in a single session."""
+    monkeypatch.chdir(request.fspath.dirname)
+    script_files = ["fixtures/sample_tests_success.py", "fixtures/sample_tests_marks_earned.py"]
+    specs = {
+        "test_data": {
+            "script_files": script_files,
+            "category": ["instructor"],
+            "timeout": 30,
+            "tester": "pytest",
+            "output_verbosity": "short",
+        }
+    }
+    serial_results = PyTester(specs=TestSpecs(specs)).run_python_tests()
+    specs["test_data"]["parallel_workers"] = 2
+    monkeypatch.setattr("os.sched_getaffinity", lambda pid: {0, 1})
+    parallel_results = PyTester(specs=TestSpecs(specs)).run_python_tests()
+    assert list(parallel_results) == script_files
+    assert parallel_results == serial_results
+
+
+def test_parallel_worker_exception(request, monkeypatch, capsys) -> None:
+    """Test that an exception raised in a parallel worker is reported with its traceback."""
+    monkeypatch.chdir(request.fspath.dirname)
+    script_files = ["fixtures/sample_tests_success.py", "fixtures/sample_tests_marks_earned.py"]
+    specs = {
+        "test_data": {
+            "script_files": script_files,
+            "category": ["instructor"],
+            "timeout": 30,
+            "tester": "pytest",
+            "output_verbosity": "short",
+            "parallel_workers": 2,
+        }
+    }
+    monkeypatch.setattr("os.sched_getaffinity", lambda pid: {0, 1})
+    monkeypatch.setattr(PyTester, "_run_pytest_session", lambda self, files: 1 / 0)
+    results = PyTester(specs=TestSpecs(specs)).run_python_tests()
+    for script_file in script_files:
+        (result,) = results[script_file]
+        assert result["status"] == "error"
+        assert "ZeroDivisionError" in result["errors"]
+    assert capsys.readouterr().err.count("ZeroDivisionError: division by zero") == 2
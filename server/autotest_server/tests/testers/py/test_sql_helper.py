@@ -0,0 +1,172 @@
+import pytest
+
+from ....testers.py.lib.sql_helper import PSQLTest
+
+
+def _quote(value):
+    return value.getquoted().decode() if hasattr(value, "getquoted") else repr(value)
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def execute(self, query, args=None):
+        query = " ".join(query.split())
+        if isinstance(args, dict):
+            query %= {k: _quote(v) for k, v in args.items()}
+        elif args is not None:
+            query %= tuple(_quote(v) for v in args)
+        self.conn.execute(query)
+
+    def fetchall(self):
+        return [(table,) for table in self.conn.tables]
+
+
+class FakeConnection:
+    """
+    A connection that keeps the statements run in its current transaction (in pending) and the statements
+    that have been committed, rolling pending statements back to savepoints like postgres does.
+    """
+
+    def __init__(self):
+        self.committed = []
+        self.pending = []
+        self.savepoints = []
+        self.tables = ["t"]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+        return False
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def execute(self, query):
+        command, _, name = query.rstrip(";").rpartition(" ")
+        if command == "SAVEPOINT":
+            self.savepoints.append((name, len(self.pending)))
+        elif command == "ROLLBACK TO SAVEPOINT":
+            index = [n for n, _ in self.savepoints].index(name)
+            start = self.savepoints[index][1]
+            del self.pending[start:]
+            end = index + 1
+            self.savepoints = self.savepoints[:end]
+        elif command == "RELEASE SAVEPOINT":
+            index = [n for n, _ in self.savepoints].index(name)
+            del self.savepoints[index:]
+        else:
+            self.pending.append(query)
+
+    def commit(self):
+        self.committed.extend(self.pending)
+        self.pending = []
+        self.savepoints = []
+
+    def rollback(self):
+        self.pending = []
+        self.savepoints = []
+
+
+@pytest.fixture
+def conn(monkeypatch):
+    conn = FakeConnection()
+    monkeypatch.setattr(PSQLTest, "connection", conn)
+    yield conn
+    assert PSQLTest._isolation_depth == 0
+    assert PSQLTest._copied_schemas == []
+
+
+def _write(statement):
+    with PSQLTest.cursor() as curr:
+        curr.execute(statement)
+
+
+def _copies(conn):
+    return [s for s in conn.pending + conn.committed if s.startswith("CREATE TABLE")]
+
+
+def test_cursor_commits_outside_isolated(conn):
+    _write("INSERT 1")
+    assert conn.committed == ["INSERT 1"]
+
+
+def test_isolated_rolls_back_writes(conn):
+    with PSQLTest.isolated():
+        _write("INSERT 1")
+        assert conn.pending == ["INSERT 1"]
+    assert conn.pending == conn.committed == []
+
+
+def test_nested_isolated_rolls_back_inner_writes(conn):
+    with PSQLTest.isolated():
+        _write("INSERT 1")
+        with PSQLTest.isolated():
+            _write("INSERT 2")
+            with PSQLTest.isolated():
+                _write("INSERT 3")
+            assert conn.pending == ["INSERT 1", "INSERT 2"]
+        assert conn.pending == ["INSERT 1"]
+        with PSQLTest.isolated():
+            _write("INSERT 4")
+            assert conn.pending == ["INSERT 1", "INSERT 4"]
+    assert conn.committed == []
+
+
+def test_cursor_error_rolls_back_only_its_writes(conn):
+    with PSQLTest.isolated():
+        _write("INSERT 1")
+        with pytest.raises(ValueError):
+            with PSQLTest.cursor() as curr:
+                curr.execute("INSERT 2")
+                raise ValueError
+        assert conn.pending == ["INSERT 1"]
+
+
+def test_copy_schema_cached_reused_in_nested_blocks(conn):
+    with PSQLTest.isolated():
+        PSQLTest.copy_schema("copy", cached=True)
+        assert len(_copies(conn)) == 1
+        for _ in range(2):
+            with PSQLTest.isolated():
+                PSQLTest.copy_schema("copy", cached=True)
+                assert len(_copies(conn)) == 1
+
+
+def test_copy_schema_cached_invalidated_when_block_exits(conn):
+    with PSQLTest.isolated():
+        with PSQLTest.isolated():
+            PSQLTest.copy_schema("copy", cached=True)
+        # the copy was rolled back with the nested block so it is made again
+        PSQLTest.copy_schema("copy", cached=True)
+        assert len(_copies(conn)) == 1
+    with PSQLTest.isolated():
+        PSQLTest.copy_schema("copy", cached=True)
+        assert len(_copies(conn)) == 1
+
+
+def test_copy_schema_cached_key_includes_arguments(conn):
+    with PSQLTest.isolated():
+        PSQLTest.copy_schema("copy", cached=True)
+        PSQLTest.copy_schema("copy", tables=["t"], cached=True)
+        PSQLTest.copy_schema("other", cached=True)
+        assert len(_copies(conn)) == 3
+
+
+def test_copy_schema_not_cached_by_default(conn):
+    with PSQLTest.isolated():
+        PSQLTest.copy_schema("copy")
+        PSQLTest.copy_schema("copy")
+        assert len(_copies(conn)) == 2
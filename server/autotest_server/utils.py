@@ -3,10 +3,17 @@ import resource
 import os
 import zipfile
 import shutil
+import fcntl
+import time
+import threading
 from io import BytesIO
-from typing import Type, Optional, Tuple, List, Generator
+from contextlib import contextmanager
+from typing import Type, Optional, Tuple, List, Generator, Union, BinaryIO, Dict
 from .config import _Config
 
+_CHUNK_SIZE = 1024 * 1024
+FICLONE = 0x40049409
+
 
 def loads_partial_json(json_string: str, expected_type: Optional[Type] = None) -> Tuple[List, bool]:
     """
@@ -79,21 +86,48 @@ def get_resource_settings(config: _Config) -> list[tuple[int, tuple[int, int]]]:
     return resource_settings
 
 
-def extract_zip_stream(zip_byte_stream: bytes, destination: str) -> None:
+class ArchiveLimitError(Exception):
+    """Error raised when a zip archive exceeds the configured size or member limits"""
+
+
+def extract_zip_stream(
+    zip_byte_stream: Union[bytes, BinaryIO],
+    destination: str,
+    max_size: Optional[int] = None,
+    max_members: Optional[int] = None,
+) -> None:
     """
     Extract files in a zip archive's content <zip_byte_stream> to <destination>, a path to a local directory.
+
+    <zip_byte_stream> may be the archive content as bytes or a seekable binary file object. Each member is
+    copied to disk in chunks so that no decompressed member is held in memory in its entirety.
+
+    Raise an ArchiveLimitError if the archive contains more than <max_members> members or if the total
+    uncompressed size of its members is more than <max_size> bytes.
     """
-    with zipfile.ZipFile(BytesIO(zip_byte_stream)) as zf:
-        for fname in zf.namelist():
-            *dpaths, bname = fname.split(os.sep)
+    if isinstance(zip_byte_stream, bytes):
+        zip_byte_stream = BytesIO(zip_byte_stream)
+    with zipfile.ZipFile(zip_byte_stream) as zf:
+        members = zf.infolist()
+        if max_members is not None and len(members) > max_members:
+            raise ArchiveLimitError(f"archive contains more than {max_members} files")
+        if max_size is not None and sum(m.file_size for m in members) > max_size:
+            raise ArchiveLimitError(f"archive is larger than {max_size} bytes when uncompressed")
+        total_size = 0
+        for member in members:
+            *dpaths, bname = member.filename.split(os.sep)
             dest = os.path.join(destination, *dpaths)
             filename = os.path.join(dest, bname)
             if filename.endswith("/"):
                 os.makedirs(filename, exist_ok=True)
             else:
                 os.makedirs(dest, exist_ok=True)
-                with open(filename, "wb") as f:
-                    f.write(zf.read(fname))
+                with zf.open(member) as src, open(filename, "wb") as f:
+                    while chunk := src.read(_CHUNK_SIZE):
+                        total_size += len(chunk)
+                        if max_size is not None and total_size > max_size:
+                            raise ArchiveLimitError(f"archive is larger than {max_size} bytes when uncompressed")
+                        f.write(chunk)
 
 
 def recursive_iglob(root_dir: str) -> Generator[Tuple[str, str], None, None]:
@@ -112,14 +146,39 @@ def recursive_iglob(root_dir: str) -> Generator[Tuple[str, str], None, None]:
         raise FileNotFoundError("directory does not exist: {}".format(root_dir))
 
 
-def copy_tree(src: str, dst: str, exclude: Tuple = tuple()) -> List[Tuple[str, str]]:
+def clone_file(src: str, dst: str) -> None:
+    """
+    Copy the file at src to dst (including metadata like shutil.copy2). If the filesystem supports it,
+    the copy is made with a reflink so that the file's data is shared by src and dst until one of them
+    is modified.
+    """
+    try:
+        with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    except OSError:
+        shutil.copy2(src, dst)
+    else:
+        shutil.copystat(src, dst)
+
+
+def _can_share(mode: int) -> bool:
+    """Return True if mode lets all users read and execute a file but only its owner write to it."""
+    return mode & 0o555 == 0o555 and not mode & 0o022
+
+
+def copy_tree(src: str, dst: str, exclude: Tuple = tuple(), link: bool = False) -> List[Tuple[str, str]]:
     """
     Recursively copy all files and subdirectories in the path
     indicated by src to the path indicated by dst. If directories
     don't exist, they are created. Do not copy files or directories
     in the exclude list.
+
+    If link is True, files owned by the current user are hard linked instead of copied where possible if all
+    users may already read and execute (but not write to) them, since a linked file shares its permissions
+    with the original. Linked files are reported with "l" instead of "f" in the returned list.
     """
     copied = []
+    uid = os.getuid()
     for fd, file_or_dir in recursive_iglob(src):
         src_path = os.path.relpath(file_or_dir, src)
         if src_path in exclude or any(os.path.relpath(src_path, ex) for ex in exclude):
@@ -129,6 +188,48 @@ def copy_tree(src: str, dst: str, exclude: Tuple = tuple()) -> List[Tuple[str, s
             os.makedirs(target, exist_ok=True)
         else:
             os.makedirs(os.path.dirname(target), exist_ok=True)
-            shutil.copy2(file_or_dir, target)
+            src_stat = os.stat(file_or_dir)
+            if link and src_stat.st_uid == uid and _can_share(src_stat.st_mode):
+                if os.path.lexists(target):
+                    os.remove(target)
+                try:
+                    os.link(file_or_dir, target)
+                    fd = "l"
+                except OSError:
+                    clone_file(file_or_dir, target)
+            else:
+                clone_file(file_or_dir, target)
         copied.append((fd, target))
     return copied
+
+
+class PhaseTimer:
+    """
+    Accumulate the time (in seconds, measured with a monotonic clock) spent in each named phase of a test run.
+
+    Phases can be timed from multiple threads at once; the time spent in a phase that is entered more than once
+    (for example once per test group) is added up.
+    """
+
+    def __init__(self) -> None:
+        self._timings: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def add(self, phase: str, seconds: float) -> None:
+        """Add seconds to the time spent in phase"""
+        with self._lock:
+            self._timings[phase] = self._timings.get(phase, 0.0) + seconds
+
+    @contextmanager
+    def phase(self, phase: str) -> Generator[None, None, None]:
+        """Context manager that adds the time spent in its body to the time spent in phase"""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add(phase, time.monotonic() - start)
+
+    def to_dict(self) -> Dict[str, float]:
+        """Return the time spent in each phase, rounded to the nearest millisecond"""
+        with self._lock:
+            return {phase: round(seconds, 3) for phase, seconds in self._timings.items()}
@@ -0,0 +1,33 @@
+import rq
+from rq.job import Job
+from rq.queue import Queue
+
+from . import prepare_settings, invalidate_settings, scheduler
+
+
+class AutotestWorker(rq.Worker):
+    """
+    An rq worker that loads the test settings for a test job before forking the work horse that runs it.
+
+    Work horses exit after running a single job, so anything they cache is lost. Loading the settings (and
+    building the commands for their testers) in the worker process itself means that they are cached for as
+    long as the worker runs and are inherited by every work horse that it forks.
+
+    After each test job, the worker also dispatches batch jobs from the scheduler queues (see scheduler.py). The work
+    horse does this itself when a test run finishes, but not if it is killed (for example, when the job times out).
+    """
+
+    def execute_job(self, job: Job, queue: Queue) -> None:
+        if job.func_name == "autotest_server.run_test":
+            try:
+                prepare_settings(job.kwargs["settings_id"], self.connection)
+            except Exception:
+                # any errors are reported when the job itself loads the settings
+                pass
+        elif job.func_name == "autotest_server.update_test_settings":
+            invalidate_settings(job.kwargs["settings_id"])
+        try:
+            super().execute_job(job, queue)
+        finally:
+            if job.func_name == "autotest_server.run_test":
+                scheduler.dispatch(self.connection)
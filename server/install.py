@@ -9,7 +9,7 @@ import subprocess
 import getpass
 import redis
 from autotest_server.config import config
-from autotest_server import run_test_command
+from autotest_server import run_test_command, migrate_legacy_settings, LEGACY_SETTINGS_KEY
 from autotest_server.testers import install as install_testers
 from redis.retry import Retry
 from redis.exceptions import TimeoutError, ConnectionError
@@ -36,12 +36,27 @@ def check_dependencies():
     for w in config["workers"]:
         pgurl = w.get("resources", {}).get("postgresql_url")
         username = w["user"]
+        concurrency = w.get("concurrency", 1)
+        if concurrency > 1:
+            _print(f"checking if resources can be shared by {concurrency} slots for worker with username {username}")
+            if pgurl is not None:
+                raise Exception(f"worker with username {username} cannot share a postgres database between slots")
+            port = w.get("resources", {}).get("port")
+            if port is not None and port["max"] - port["min"] + 1 < concurrency:
+                raise Exception(f"worker with username {username} does not have a port for each slot")
         if pgurl is not None:
             _print(f"checking if postgres url is valid for worker with username {username}")
             try:
                 psycopg2.connect(pgurl)
             except Exception as e:
                 raise Exception(f"Cannot connect to postgres database with url: {pgurl}") from e
+    cgroup_root = (config.get("cgroups") or {}).get("root")
+    if cgroup_root is not None:
+        _print(f"checking if cgroups can be created in {cgroup_root}")
+        if not os.path.isfile(os.path.join(cgroup_root, "cgroup.procs")):
+            raise Exception(f"{cgroup_root} is not a cgroup v2 directory")
+        if not os.access(cgroup_root, os.W_OK):
+            raise Exception(f"user {getpass.getuser()} cannot create cgroups in {cgroup_root}")
 
 
 def check_users_exist():
@@ -87,12 +102,27 @@ def install_all_testers():
     REDIS_CONNECTION.set("autotest:schema", json.dumps(skeleton))
 
 
+def migrate_settings():
+    """
+    Move test settings stored as a single json string per settings id in the autotest:settings hash
+    (used by previous versions of the autotester) to a settings hash and a settings spec.
+
+    Settings that are not migrated here are migrated when they are first loaded (see migrate_legacy_settings).
+    """
+    settings_ids = REDIS_CONNECTION.hkeys(LEGACY_SETTINGS_KEY) or []
+    if settings_ids:
+        _print(f"migrating {len(settings_ids)} test settings to the current format")
+    for settings_id in settings_ids:
+        migrate_legacy_settings(settings_id.decode(), REDIS_CONNECTION)
+
+
 def install():
     check_dependencies()
     check_users_exist()
     create_workspace()
     create_worker_log_dir()
     install_all_testers()
+    migrate_settings()
 
 
 if __name__ == "__main__":
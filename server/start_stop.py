@@ -1,5 +1,4 @@
 import argparse
-import json
 import os
 import shutil
 import time
@@ -7,7 +6,9 @@ import redis
 import sys
 import signal
 import subprocess
+from datetime import datetime
 from autotest_server.config import config
+from autotest_server import scheduler, SETTINGS_SPEC_KEY
 from redis.retry import Retry
 from redis.exceptions import TimeoutError, ConnectionError
 from redis.backoff import FullJitterBackoff
@@ -33,13 +34,14 @@ supervisor.rpcinterface_factory = supervisor.rpcinterface:make_main_rpcinterface
 """
 
 CONTENT = """[program:rq_worker_{worker_user}]
-environment=WORKERUSER={worker_user}
+environment=WORKERUSER={worker_user}{slot_environment}
 command={rq} worker {worker_args} settings {queues}
-process_name=rq_worker_{worker_user}
+process_name=rq_worker_{worker_user}_%(process_num)d
 numprocs={numprocs}
 directory={directory}
 stopsignal=TERM
-autostart=true
+stopwaitsecs={stopwaitsecs}
+autostart={autostart}
 autorestart=true
 stopasgroup=true
 killasgroup=true
@@ -52,6 +54,20 @@ stderr_logfile_backups=10
 
 """
 
+AUTOSCALER_CONTENT = """[program:autoscaler]
+command={python} -m autotest_server.autoscaler
+directory={directory}
+autostart=true
+autorestart=true
+stdout_logfile={stdout_logfile}
+stdout_logfile_maxbytes=1MB
+stdout_logfile_backups=10
+stderr_logfile={stderr_logfile}
+stderr_logfile_maxbytes=1MB
+stderr_logfile_backups=10
+
+"""
+
 REDIS_CONNECTION = redis.Redis.from_url(
     config["redis_url"],
     decode_responses=True,
@@ -62,24 +78,44 @@ REDIS_CONNECTION = redis.Redis.from_url(
 
 
 def create_enqueuer_wrapper(rq):
+    autoscale = config.get("autoscale")
+    directory = os.path.dirname(os.path.realpath(__file__))
     with open(_CONF_FILE, "w") as f:
         f.write(HEADER)
         for worker_data in config["workers"]:
+            concurrency = worker_data.get("concurrency", 1)
+            # workers that run one job at a time keep the workspace and log paths used before worker slots existed
+            log_name = f'{worker_data["user"]}_%(process_num)d' if concurrency > 1 else worker_data["user"]
             c = CONTENT.format(
                 worker_user=worker_data["user"],
                 rq=rq,
-                worker_args=f'--url {config["redis_url"]}',
+                worker_args=f'--url {config["redis_url"]} --worker-class autotest_server.worker.AutotestWorker',
                 queues=" ".join(worker_data["queues"]),
-                numprocs=1,
-                directory=os.path.dirname(os.path.realpath(__file__)),
-                stdout_logfile=os.path.join(_THIS_DIR, f'{config["worker_log_dir"]}/{worker_data["user"]}_stdout.log'),
-                stderr_logfile=os.path.join(_THIS_DIR, f'{config["worker_log_dir"]}/{worker_data["user"]}_stderr.log'),
+                slot_environment=",WORKERSLOT=%(process_num)d" if concurrency > 1 else "",
+                numprocs=concurrency,
+                # let the autoscaler stop workers without killing a test run in progress
+                stopwaitsecs=config.get("max_test_timeout", 3600) + 60 if autoscale else 10,
+                autostart="false" if autoscale else "true",
+                directory=directory,
+                stdout_logfile=os.path.join(_THIS_DIR, f'{config["worker_log_dir"]}/{log_name}_stdout.log'),
+                stderr_logfile=os.path.join(_THIS_DIR, f'{config["worker_log_dir"]}/{log_name}_stderr.log'),
+            )
+            f.write(c)
+        if autoscale:
+            c = AUTOSCALER_CONTENT.format(
+                python=sys.executable,
+                directory=directory,
+                stdout_logfile=os.path.join(_THIS_DIR, f'{config["worker_log_dir"]}/autoscaler_stdout.log'),
+                stderr_logfile=os.path.join(_THIS_DIR, f'{config["worker_log_dir"]}/autoscaler_stderr.log'),
             )
             f.write(c)
 
 
 def start(rq, supervisord, extra_args):
     create_enqueuer_wrapper(rq)
+    # set the depth of the batch queue and move any batch jobs that were waiting while the workers were stopped
+    scheduler.store_script(REDIS_CONNECTION)
+    scheduler.dispatch(REDIS_CONNECTION, scheduler.batch_queue_depth(config["workers"]))
     subprocess.run([supervisord, "-c", _CONF_FILE, *extra_args], check=True, cwd=_THIS_DIR)
 
 
@@ -94,23 +130,45 @@ def stop():
 
 def stat(rq, extra_args):
     subprocess.run([rq, "info", "--url", config["redis_url"], *extra_args], check=True)
+    if config.get("archive_cache"):
+        cache_stats = REDIS_CONNECTION.hgetall("autotest:archive_cache") or {}
+        print(f'archive cache: {cache_stats.get("hits", 0)} hits, {cache_stats.get("misses", 0)} misses')
+    backlog = scheduler.backlog(REDIS_CONNECTION)
+    print(f"scheduler backlog: {sum(n for _, n, _ in backlog)} batch tests waiting to be dispatched")
+    for settings_id, n, deadline in backlog:
+        deadline = "" if deadline is None else f" (deadline {datetime.fromtimestamp(deadline).isoformat()})"
+        print(f"  settings {settings_id}: {n} tests{deadline}")
+
+
+def _delete_settings_specs(settings_id, before_version):
+    for spec_key in REDIS_CONNECTION.scan_iter(SETTINGS_SPEC_KEY.format(settings_id, "*")):
+        if int(spec_key.split(":")[-1]) < before_version:
+            REDIS_CONNECTION.delete(spec_key)
 
 
 def clean(age, dry_run):
-    for settings_id, settings in dict(REDIS_CONNECTION.hgetall("autotest:settings") or {}).items():
-        settings = json.loads(settings)
-        last_access_timestamp = settings.get("_last_access")
+    for key in REDIS_CONNECTION.scan_iter("autotest:settings:*"):
+        settings_id = key.split(":")[-1]
+        version = int(REDIS_CONNECTION.hget(key, "_version") or 0)
+        last_access_timestamp = REDIS_CONNECTION.hget(key, "_last_access")
+        last_access_timestamp = None if last_access_timestamp is None else int(last_access_timestamp)
         access = int(time.time() - (last_access_timestamp or 0))
         if last_access_timestamp is None or (access > (age * SECONDS_PER_DAY)):
             dir_path = os.path.join(config["workspace"], "scripts", str(settings_id))
-            if dry_run and os.path.isdir(dir_path):
-                last_access = "UNKNOWN" if last_access_timestamp is None else access // SECONDS_PER_DAY
-                print(f"{dir_path} -> last accessed {last_access or '< 1'} days ago")
+            if dry_run:
+                if os.path.isdir(dir_path):
+                    last_access = "UNKNOWN" if last_access_timestamp is None else access // SECONDS_PER_DAY
+                    print(f"{dir_path} -> last accessed {last_access or '< 1'} days ago")
             else:
-                settings["_error"] = "the settings for this test have expired, please re-upload the settings."
-                REDIS_CONNECTION.hset("autotest:settings", key=settings_id, value=json.dumps(settings))
+                error = "the settings for this test have expired, please re-upload the settings."
+                REDIS_CONNECTION.hset(key, "_error", error)
+                REDIS_CONNECTION.delete(f"autotest:timings:{settings_id}")
+                _delete_settings_specs(settings_id, version + 1)
                 if os.path.isdir(dir_path):
                     shutil.rmtree(dir_path)
+        elif not dry_run:
+            # the previous version is kept (until it expires) for jobs that loaded the settings before they changed
+            _delete_settings_specs(settings_id, version - 1)
 
 
 def _exec_type(path):